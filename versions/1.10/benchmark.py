@@ -0,0 +1,386 @@
+"""下载流程性能基准测试
+
+端到端基准连接本地测试服务器(fakeImapServer)完成完整的下载流程；微基准分别测量
+邮件解析、FETCH响应解析、附件解码、文件名解码和写盘的速度。每个端到端场景在独立的
+子进程中运行，峰值内存互不影响。
+
+报告内容: 邮件数/秒、MB/秒、峰值内存(RSS)、各阶段耗时的分位数。
+
+用法:
+    python benchmark.py                          # 运行全部基准
+    python benchmark.py --only micro             # 只运行名称中包含micro的基准
+    python benchmark.py --save 1.10              # 结果另存为基线 benchmarks/1.10.json
+    python benchmark.py --compare 1.10           # 与基线比较，有退化时返回码为1
+
+作者: Himalaya
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import wraps
+from multiprocessing import get_context
+from typing import Optional, Tuple, Dict, List, Callable, Any
+
+from fakeImapServer import FakeIMAPServer, MailboxSpec, NetworkProfile
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+ACCOUNT = ('bench@example.com', 'bench')
+
+logger = logging.getLogger(__name__)
+
+# 端到端场景: 名称 -> (下载引擎, 按需获取, 网络状况)；'process'为线程引擎加每个CPU一个解析子进程
+SCENARIOS: Dict[str, Tuple[str, bool, NetworkProfile]] = {
+    'e2e_thread': ('thread', False, NetworkProfile()),
+    'e2e_thread_wan': ('thread', False, NetworkProfile(latency=0.02, bandwidth=20 * 1024 * 1024)),
+    'e2e_asyncio_wan': ('asyncio', False, NetworkProfile(latency=0.02, bandwidth=20 * 1024 * 1024)),
+    'e2e_selective': ('thread', True, NetworkProfile()),
+    'e2e_processes': ('process', False, NetworkProfile()),
+    'e2e_single_message': ('single', False, NetworkProfile()),
+}
+
+
+def headless_options(selective: bool = False, processes: int = 0) -> Any:
+    """下载流程使用的选项: 不使用断点续传，保存HTML正文"""
+    from emailCore import DownloadOptions
+    return DownloadOptions(resume=False, download_html=True, selective_fetch=selective, processes=processes)
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """返回耗时样本(秒)的分位数(毫秒)"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def at(fraction: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'p50': at(0.50), 'p90': at(0.90), 'p99': at(0.99), 'max': round(ordered[-1] * 1000, 3),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 3)
+    }
+
+
+def peak_rss() -> Optional[int]:
+    """当前进程的峰值常驻内存(字节)，无法获取时为None"""
+    try:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == 'darwin' else usage * 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    except ImportError:
+        return None
+
+
+def throughput(messages: int, nbytes: int, seconds: float) -> Dict[str, float]:
+    seconds = max(seconds, 1e-9)
+    return {
+        'seconds': round(seconds, 4),
+        'msgs_per_s': round(messages / seconds, 2),
+        'mb_per_s': round(nbytes / seconds / 1024 / 1024, 3)
+    }
+
+
+class PhaseTimer:
+    """临时包装下载流程中的函数，记录每次调用的耗时"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self._patched: List[Tuple[Any, str, Any]] = []
+
+    def patch(self, owner: Any, name: str, phase: str) -> None:
+        original = owner.__dict__[name]
+        function = original.__func__ if isinstance(original, staticmethod) else original
+        samples = self.samples.setdefault(phase, [])
+
+        @wraps(function)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - started)
+
+        setattr(owner, name, staticmethod(timed) if isinstance(original, staticmethod) else timed)
+        self._patched.append((owner, name, original))
+
+    def restore(self) -> None:
+        for owner, name, original in reversed(self._patched):
+            setattr(owner, name, original)
+        self._patched.clear()
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        return {phase: percentiles(samples) for phase, samples in self.samples.items() if samples}
+
+
+def _corpus(messages: int, seed: int) -> List[bytes]:
+    """生成微基准使用的邮件原文(与测试服务器生成的邮件相同)"""
+    server = FakeIMAPServer(MailboxSpec(messages=messages, seed=seed))
+    return [message.raw for message in server.folders['INBOX'].messages]
+
+
+REPEAT = 3
+
+
+def _measure(
+    items: List[Any],
+    function: Callable[[Any], Any],
+    size: Callable[[Any], int],
+    repeat: int = REPEAT
+) -> Dict[str, Any]:
+    """对每个样本计时，重复repeat轮，吞吐量取最快的一轮以减少干扰"""
+    samples = []
+    nbytes = sum(size(item) for item in items)
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for item in items:
+            begin = time.perf_counter()
+            function(item)
+            samples.append(time.perf_counter() - begin)
+        best = min(best, time.perf_counter() - started)
+    result = throughput(len(items), nbytes, best)
+    result['latency'] = percentiles(samples)
+    return result
+
+
+def run_micro(messages: int, seed: int, repeat: int = REPEAT) -> Dict[str, Dict[str, Any]]:
+    """微基准: 解析、FETCH响应解析、解码、文件名解码、写盘"""
+    import emailCore
+    from email.parser import BytesParser
+    EmailDownload, Tools = emailCore.EmailDownload, emailCore.Tools
+
+    raws = _corpus(messages, seed)
+    parsed = [BytesParser().parsebytes(raw) for raw in raws]
+    attachments = [part for msg in parsed for part in msg.walk() if part.get_filename()]
+    parts = [part for msg in parsed for part in msg.walk() if not part.is_multipart()]
+    decoded = {id(part): len(part.get_payload(decode=True) or b'') for part in attachments}
+    batches = []
+    for start in range(0, len(raws), EmailDownload.FETCH_BATCH_SIZE):
+        batch = []
+        for uid, raw in enumerate(raws[start:start + EmailDownload.FETCH_BATCH_SIZE], start + 1):
+            batch += [(f'{uid} (UID {uid} RFC822 {{{len(raw)}}}'.encode(), raw), b')']
+        batches.append(batch)
+
+    results = {
+        'micro_parse': _measure(raws, BytesParser().parsebytes, len, repeat),
+        'micro_fetch_response': _measure(
+            batches, lambda data: list(Tools.parse_fetch_response(data)),
+            lambda data: sum(len(item[1]) for item in data if isinstance(item, tuple)), repeat
+        ),
+        'micro_decode': _measure(
+            attachments, lambda part: part.get_payload(decode=True), lambda part: decoded[id(part)], repeat
+        ),
+        'micro_filename': _measure(
+            attachments, lambda part: Tools.decode_header_value(part.get_filename()), lambda part: 0, repeat
+        ),
+    }
+
+    options = headless_options()
+    directory = tempfile.mkdtemp(prefix='bench-')
+    try:
+        results['micro_process_part'] = _measure(
+            parts, lambda part: EmailDownload._process_email_part(part, directory, 'bench', options),
+            lambda part: len(part.as_bytes()) if part.get_content_maintype() == 'text' else 0, repeat
+        )
+        results['micro_save_attachment'] = _measure(
+            attachments, lambda part: EmailDownload._save_attachment(part, directory),
+            lambda part: decoded[id(part)], repeat
+        )
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            numbered = list(enumerate(raws, 1))
+            results['micro_save_message'] = _measure(
+                numbered, lambda item: EmailDownload._save_message(str(item[0]).encode(), item[1], ACCOUNT[0], options),
+                lambda item: len(item[1]), repeat
+            )
+            results['micro_streaming_save'] = _measure(
+                numbered,
+                lambda item: EmailDownload._save_message(str(item[0]).encode(), io.BytesIO(item[1]), ACCOUNT[0], options, 'Stream'),
+                lambda item: len(item[1]), repeat
+            )
+        finally:
+            os.chdir(cwd)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    for result in results.values():
+        result['peak_rss'] = peak_rss()
+    return results
+
+
+def run_scenario(name: str, messages: int, seed: int) -> Dict[str, Any]:
+    """在当前进程中运行一个端到端场景(由子进程调用)"""
+    import emailCore
+    EmailDownload, DownloadPlan = emailCore.EmailDownload, emailCore.DownloadPlan
+    logging.getLogger('emailCore').setLevel(logging.WARNING)
+    logging.getLogger('fakeImapServer').setLevel(logging.WARNING)
+
+    engine, selective, network = SCENARIOS[name]
+    directory = tempfile.mkdtemp(prefix='bench-')
+    os.chdir(directory)
+    timer = PhaseTimer()
+    timer.patch(EmailDownload, '_uid_search', 'search')
+    timer.patch(DownloadPlan, 'prefetch', 'prefetch')
+    timer.patch(EmailDownload, 'download_batch', 'batch')
+    timer.patch(EmailDownload, '_parse_message', 'parse')
+    timer.patch(EmailDownload, '_save_message', 'save_message')
+    try:
+        with FakeIMAPServer(MailboxSpec(messages=messages, seed=seed), network=network) as server:
+            EmailDownload.SSL_CONTEXT = server.client_context
+            with open('imap_servers.json', 'w') as f:
+                json.dump(server.server_config(ACCOUNT[0].split('@')[1]), f)
+            nbytes = sum(len(message.raw) for message in server.folders['INBOX'].messages)
+            options = headless_options(selective, (os.cpu_count() or 1) if engine == 'process' else 0)
+            progress = emailCore.ProgressSignal()
+            started = time.perf_counter()
+            if engine == 'single':
+                # 逐封调用download_email(旧版本的下载方式)
+                server_limits = EmailDownload.get_server_limits(EmailDownload.get_imap_server('example.com'))
+                with emailCore.IMAPConnectionPool(*ACCOUNT, server_limits[1]) as pool:
+                    for uid in server.folders['INBOX'].uids:
+                        EmailDownload.download_email(str(uid).encode(), *ACCOUNT, options, pool=pool)
+                downloaded = messages
+            else:
+                EmailDownload.ENGINE = 'thread' if engine == 'process' else engine
+                stats = EmailDownload.download_folder(*ACCOUNT, options, progress)
+                downloaded = stats.success if stats else 0
+            result = throughput(downloaded, nbytes, time.perf_counter() - started)
+            result.update({
+                'messages': downloaded,
+                'commands': sum(server.stats['commands'].values()),
+                'connections': server.stats['connections'],
+                'phases': timer.report(),
+                'peak_rss': peak_rss()
+            })
+            return result
+    finally:
+        timer.restore()
+        os.chdir(tempfile.gettempdir())
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run_all(only: Optional[str], messages: int, seed: int, repeat: int = REPEAT) -> Dict[str, Any]:
+    results: Dict[str, Any] = {}
+    if not only or only.startswith('micro') or 'micro'.startswith(only):
+        results.update({name: value for name, value in run_micro(messages, seed, repeat).items() if not only or only in name})
+    for name in SCENARIOS:
+        if only and only not in name:
+            continue
+        # 每个场景使用新的子进程，峰值内存和全局状态互不影响
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            results[name] = executor.submit(run_scenario, name, messages, seed).result()
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'messages': messages,
+        'seed': seed,
+        'results': results
+    }
+
+
+def _flatten(results: Dict[str, Any], prefix: str = '') -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> List[str]:
+    """逐项比较两次结果
+    
+    只比较吞吐量(*_per_s，越大越好)、耗时分位数和峰值内存(越小越好)。
+    
+    Returns:
+        list: 超过阈值的退化项
+    """
+    old, new = _flatten(baseline['results']), _flatten(current['results'])
+    regressions = []
+    print(f"\n{'指标':<52}{'基线':>14}{'本次':>14}{'变化':>10}")
+    for key in sorted(old.keys() & new.keys()):
+        metric = key.rsplit('.', 1)[-1]
+        higher_is_better = metric.endswith('_per_s')
+        if not (higher_is_better or metric in ('p50', 'p90', 'p99', 'peak_rss', 'seconds')):
+            continue
+        before, after = old[key], new[key]
+        if not before:
+            continue
+        change = (after - before) / before
+        worse = -change if higher_is_better else change
+        mark = ''
+        if worse > threshold:
+            mark = '  退化'
+            regressions.append(key)
+        elif worse < -threshold:
+            mark = '  提升'
+        print(f"{key:<52}{before:>14.3f}{after:>14.3f}{change:>+10.1%}{mark}")
+    return regressions
+
+
+def print_summary(report: Dict[str, Any]) -> None:
+    print(f"\n{'基准':<26}{'邮件/秒':>12}{'MB/秒':>10}{'峰值内存MB':>12}  阶段耗时 p50/p99 (ms)")
+    for name, result in report['results'].items():
+        rss = result.get('peak_rss')
+        phases = result.get('phases') or {'': result.get('latency', {})}
+        timing = ', '.join(
+            f"{phase + ' ' if phase else ''}{values.get('p50')}/{values.get('p99')}"
+            for phase, values in phases.items() if values
+        )
+        print(
+            f"{name:<26}{result['msgs_per_s']:>12.1f}{result['mb_per_s']:>10.2f}"
+            f"{(rss / 1024 / 1024 if rss else 0):>12.1f}  {timing}"
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='邮件下载流程性能基准测试')
+    parser.add_argument('--only', help='只运行名称中包含该字符串的基准')
+    parser.add_argument('--messages', type=int, default=200, help='测试邮箱中的邮件数量')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='微基准的重复轮数')
+    parser.add_argument('--save', metavar='NAME', help='把结果另存为基线 benchmarks/NAME.json')
+    parser.add_argument('--compare', metavar='NAME', help='与基线 benchmarks/NAME.json 比较')
+    parser.add_argument('--threshold', type=float, default=0.10, help='判定为退化的相对变化(默认10%%)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    report = run_all(args.only, args.messages, args.seed, max(args.repeat, 1))
+    print_summary(report)
+
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    names = ['latest'] + ([args.save] if args.save else [])
+    for name in names:
+        with open(os.path.join(BENCHMARK_DIR, f"{name}.json"), 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(os.path.join(BENCHMARK_DIR, f"{args.compare}.json"), 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} 项指标退化超过 {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
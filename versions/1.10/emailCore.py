@@ -0,0 +1,5312 @@
+"""邮箱下载工具 - 下载核心
+
+不依赖PyQt5的下载逻辑，图形界面(emailDownload.py)、命令行和其他脚本共用。
+下载选项通过DownloadOptions传入，进度通过ProgressSignal的回调发送。
+
+命令行用法(可在没有显示器的服务器上由cron调用):
+    python -m emailCore download --account a@qq.com --folder INBOX --folder "工作/*"
+    python -m emailCore batch --config accounts.json
+
+作者: Himalaya
+版本: 1.1.0
+"""
+
+import argparse
+import array
+import asyncio
+import collections
+import email
+import email.header
+import email.message
+import fnmatch
+import getpass
+import hashlib
+import imaplib
+import sys
+import os
+import re
+import select
+import shlex
+import json
+import time
+import logging
+import threading
+import binascii
+import codecs
+import bisect
+import io
+import itertools
+import multiprocessing
+import shutil
+import ssl
+import tempfile
+import weakref
+from typing import Optional, Tuple, Dict, List, Union, Callable, Any, Generator, Iterable, Iterator, BinaryIO, Set
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from datetime import datetime
+from email.parser import BytesParser
+from email.utils import parsedate_to_datetime , parseaddr
+from email.header import make_header, decode_header
+from pathlib import Path
+from threading import Lock , Thread
+from dataclasses import dataclass, replace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class DownloadStats:
+    total: int = 0
+    success: int = 0
+    failed: int = 0
+    attachments: int = 0
+
+    def add(self, other: Optional['DownloadStats']) -> 'DownloadStats':
+        """累加另一份统计(多文件夹、多账号汇总时使用)"""
+        if other:
+            self.total += other.total
+            self.success += other.success
+            self.failed += other.failed
+            self.attachments += other.attachments
+        return self
+
+@dataclass
+class DownloadOptions:
+    """下载选项
+    
+    图形界面在开始下载前从控件读取一次(见EmailDownloadUI.download_options)，
+    下载线程只读取这里的值，不再访问界面控件；命令行由参数构造。
+    
+    Attributes:
+        folders: 文件夹筛选模式(见EmailDownload.parse_folder_patterns)
+        search_filter: 邮件筛选规则(见SearchFilter)
+        resume: 是否断点续传
+        download_html: 是否保存HTML正文
+        seen_after_download: 下载后是否标记为已读
+        selective_fetch: 是否只获取需要的MIME部分
+        incremental: 是否增量同步
+        processes: 解析和保存邮件使用的子进程数，0表示在下载进程的线程中处理(见SavePipeline)
+        dedup_attachments: 是否把附件按内容去重保存(见AttachmentStore)，默认关闭
+        on_status: 状态文字(如"下载完成!")的回调，图形界面显示在标题栏
+    """
+    folders: str = 'INBOX'
+    search_filter: str = ''
+    resume: bool = True
+    download_html: bool = False
+    seen_after_download: bool = False
+    selective_fetch: bool = False
+    incremental: bool = False
+    processes: int = 0
+    dedup_attachments: bool = False
+    on_status: Optional[Callable[[str], None]] = None
+
+    def status(self, text: str) -> None:
+        """报告下载状态"""
+        if self.on_status:
+            self.on_status(text)
+
+class Tools:
+    """邮件处理工具类"""
+    
+    @staticmethod
+    def rename(email_id: bytes, msg: email.message.Message, base_path: str) -> str:
+        """重命名邮件文件路径，包含时间戳和邮件ID
+        
+        Args:
+            email_id: 邮件ID
+            msg: 邮件消息对象
+            base_path: 基础路径
+            
+        Returns:
+            str: 格式化后的路径字符串
+            
+        Raises:
+            Exception: 如果日期解析失败
+        """
+        try:
+            if msg['Date']:
+                email_time = parsedate_to_datetime(msg['Date']).strftime('%Y-%m-%d %H-%M-%S')
+                return f"{base_path}_{email_time}_{email_id.decode('utf-8')}"
+            return f"{base_path}_{email_id.decode('utf-8')}"
+        except Exception as e:
+            logger.error(f"重命名邮件失败: {e}")
+            return f"{base_path}_{int(time.time())}_{email_id.decode('utf-8')}"
+
+    @staticmethod
+    def quote_string(value: str) -> str:
+        """把字符串写成IMAP带引号字符串"""
+        return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    @staticmethod
+    def quote_mailbox(name: str) -> str:
+        """按需为文件夹名称加引号(imaplib不会自动加引号)"""
+        if name and re.fullmatch(r'[^\s()"{}%*\\\]]+', name):
+            return name
+        return Tools.quote_string(name)
+
+    @staticmethod
+    def decode_folder_name(name: str) -> str:
+        """解码IMAP文件夹名称使用的修改版UTF-7(RFC 3501 5.1.3)
+        
+        如 "&UXZO1mWHTvZZOQ-" 解码为 "其他文件夹"，"&-" 解码为 "&"。
+        """
+        def decode(match: re.Match) -> str:
+            encoded = match.group(1)
+            if not encoded:
+                return '&'
+            encoded = encoded.replace(',', '/')
+            return binascii.a2b_base64(encoded + '=' * (-len(encoded) % 4)).decode('utf-16-be')
+        try:
+            return re.sub(r'&([A-Za-z0-9+,]*)-', decode, name)
+        except (binascii.Error, UnicodeDecodeError):
+            return name
+
+    @staticmethod
+    def decode_header_value(value: Optional[str]) -> str:
+        """解码RFC 2047编码的邮件头，解码失败时返回原文"""
+        if value is None:
+            return ''
+        try:
+            return str(make_header(decode_header(value)))
+        except Exception:
+            return str(value)
+
+    @staticmethod
+    def format_size(size: float) -> str:
+        """把字节数格式化为便于阅读的字符串，如 12.3 MB"""
+        for unit in ('B', 'KB', 'MB', 'GB'):
+            if size < 1024 or unit == 'GB':
+                return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+            size /= 1024
+        return f"{size:.1f} GB"
+
+    @staticmethod
+    def format_duration(seconds: float) -> str:
+        """把秒数格式化为 时:分:秒"""
+        seconds = int(max(seconds, 0))
+        return f"{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+    @staticmethod
+    def compress_uids(uids: Iterable[Union[bytes, str, int]]) -> str:
+        """将UID列表压缩为IMAP序列集合字符串
+        
+        Args:
+            uids: UID列表(无需有序)
+        
+        Returns:
+            str: 序列集合，如 "1:50,73,80:120"
+        """
+        return str(uids if isinstance(uids, UIDSet) else UIDSet(uids))
+
+    @staticmethod
+    def literal_bytes(value: Any) -> bytes:
+        """把FETCH数据项的值统一转换为bytes(空内容可能以""或NIL返回)"""
+        if isinstance(value, bytes):
+            return value
+        if hasattr(value, 'read'):
+            value.seek(0)
+            return value.read()
+        if isinstance(value, str):
+            return value.encode('utf-8')
+        return b''
+
+    @staticmethod
+    def response_size(data: List[Any]) -> int:
+        """统计FETCH响应中字面量的总字节数(用于吞吐量测量)"""
+        total = 0
+        for item in data or []:
+            if isinstance(item, tuple) and len(item) >= 2:
+                literal = item[1]
+                if hasattr(literal, 'seek'):
+                    position = literal.tell()
+                    total += literal.seek(0, os.SEEK_END)
+                    literal.seek(position)
+                elif isinstance(literal, (bytes, str)):
+                    total += len(literal)
+        return total
+
+    _FETCH_TOKEN_RE = re.compile(
+        rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"\[]+(?:\[[^\]]*\](?:<[^>]*>)?)?))'
+    )
+    _LITERAL_SUFFIX_RE = re.compile(rb'\{\d+\}\s*$')
+
+    @staticmethod
+    def _fetch_tokens(data: List[Any]) -> Generator[Tuple[str, Any], None, None]:
+        """将imaplib返回的FETCH数据切分为词法单元
+        
+        imaplib把字面量(literal)拆成 (前缀, 内容) 元组，其余部分为普通bytes。
+        """
+        for item in data:
+            if isinstance(item, tuple):
+                head, literal = item[0], item[1]
+                head = Tools._LITERAL_SUFFIX_RE.sub(b'', head)
+            elif isinstance(item, bytes):
+                head, literal = item, None
+            else:
+                continue
+            for match in Tools._FETCH_TOKEN_RE.finditer(head):
+                opening, closing, quoted, atom = match.groups()
+                if opening:
+                    yield ('(', None)
+                elif closing:
+                    yield (')', None)
+                elif quoted is not None:
+                    yield ('str', re.sub(rb'\\(.)', rb'\1', quoted).decode('utf-8', 'replace'))
+                elif atom:
+                    yield ('atom', atom.decode('utf-8', 'replace'))
+            if literal is not None:
+                yield ('literal', literal)
+
+    @staticmethod
+    def parse_fetch_response(data: List[Any]) -> Generator[Tuple[int, Dict[str, Any]], None, None]:
+        """逐条解析FETCH命令的无标签响应
+        
+        Args:
+            data: imaplib fetch/uid('FETCH')返回的数据列表
+        
+        Yields:
+            (序号, 数据项字典)，如 (1, {'UID': 5, 'RFC822': b'...'})。
+            原子中的纯数字转换为int，NIL转换为None，括号列表转换为list，
+            字面量保持为bytes。
+        """
+        tokens = Tools._fetch_tokens(data)
+
+        def read_value(kind: str, value: Any) -> Any:
+            if kind == '(':
+                items = []
+                for sub_kind, sub_value in tokens:
+                    if sub_kind == ')':
+                        return items
+                    items.append(read_value(sub_kind, sub_value))
+                return items
+            if kind == 'atom':
+                if value.isdigit():
+                    return int(value)
+                if value.upper() == 'NIL':
+                    return None
+            return value
+
+        for kind, value in tokens:
+            if kind != 'atom' or not value.isdigit():
+                continue
+            sequence = int(value)
+            kind, value = next(tokens, (None, None))
+            if kind != '(':
+                continue
+            items = read_value(kind, value)
+            fields = {}
+            for i in range(0, len(items) - 1, 2):
+                key = items[i]
+                if isinstance(key, str):
+                    fields[key.upper()] = items[i + 1]
+            yield sequence, fields
+
+class _Signal:
+    """不依赖Qt的信号，接口与pyqtSignal相同(connect/emit)，回调在发送信号的线程中执行"""
+
+    def __init__(self) -> None:
+        self._slots: List[Callable[..., None]] = []
+
+    def connect(self, slot: Callable[..., None]) -> None:
+        self._slots.append(slot)
+
+    def emit(self, *args: Any) -> None:
+        for slot in self._slots:
+            slot(*args)
+
+class ProgressSignal:
+    """进度信号类
+    
+    下载线程通过它发送进度；图形界面把这些信号转接到Qt信号上(见emailDownload.DownloadThread)，
+    由Qt排队送到界面线程，命令行则直接在回调中输出。
+    
+    Signals:
+        progress (int): 下载进度百分比
+        stats_updated (dict): 下载统计信息更新
+        plan_ready (dict): 下载计划完成(邮件数、总字节数、预计耗时)
+        error_occurred (str): 错误发生时发送信号
+    """
+
+    def __init__(self) -> None:
+        self.progress = _Signal()
+        self.stats_updated = _Signal()
+        self.plan_ready = _Signal()
+        self.error_occurred = _Signal()
+
+class PhaseHistogram:
+    """单个阶段的耗时直方图
+    
+    按固定的毫秒桶计数(桶边界与Prometheus的le一致，落在最后一个边界之外的计入+Inf)，
+    同时记录次数、总耗时、最小/最大耗时和处理的字节数，百分位数按桶上界估算。
+    """
+    BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(self.BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min: Optional[float] = None
+        self.max = 0.0
+        self.bytes = 0
+
+    def add(self, seconds: float, nbytes: int = 0) -> None:
+        """记录一次耗时
+        
+        Args:
+            seconds: 耗时(秒)
+            nbytes: 本次处理的字节数
+        """
+        self.counts[bisect.bisect_left(self.BOUNDS_MS, seconds * 1000)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.bytes += nbytes
+
+    def merge(self, other: 'PhaseHistogram') -> None:
+        """累加另一个直方图(合并各线程的指标分片时使用)"""
+        self.counts = [a + b for a, b in zip(self.counts, list(other.counts))]
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.bytes += other.bytes
+
+    def percentile(self, q: float) -> float:
+        """估算百分位数(秒)，取所在桶的上界，不超过实际最大值"""
+        if not self.count:
+            return 0.0
+        rank = max(1, int(q / 100 * self.count + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        if index >= len(self.BOUNDS_MS):
+            return self.max
+        return min(self.BOUNDS_MS[index] / 1000, self.max)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为运行报告中的字典"""
+        return {
+            'count': self.count,
+            'total_s': round(self.total, 6),
+            'mean_ms': round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            'min_ms': round((self.min or 0.0) * 1000, 3),
+            'max_ms': round(self.max * 1000, 3),
+            'p50_ms': round(self.percentile(50) * 1000, 3),
+            'p90_ms': round(self.percentile(90) * 1000, 3),
+            'p99_ms': round(self.percentile(99) * 1000, 3),
+            'bytes': self.bytes,
+            'buckets': {
+                **{str(bound): count for bound, count in zip(self.BOUNDS_MS, self.counts)},
+                '+Inf': self.counts[-1],
+            },
+        }
+
+class RunReport:
+    """按阶段统计下载热路径耗时并在结束时输出运行报告
+    
+    download_emails(以及批量下载)用 session() 包住一次运行，期间各热路径
+    (建立连接、登录、SELECT、SEARCH、FETCH、解析、保存、续传记录、STORE)
+    通过 phase()/timed() 把耗时汇总到 PhaseHistogram 中。最外层的 session()
+    结束时把报告写入 downloads/reports/run_<时间>.json，并在日志中输出一行摘要。
+    
+    没有进行中的运行时只计入进程级的Metrics，不生成报告，单独调用下载函数(如基准测试)不受影响。
+    """
+    DIRECTORY = Path('./downloads/reports')
+
+    _lock = Lock()
+    _depth = 0
+    _started: Optional[float] = None
+    _started_at: Optional[datetime] = None
+    _phases: Dict[str, PhaseHistogram] = {}
+    _stats = DownloadStats()
+    _counters: Dict[str, int] = {}
+    _last: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    @contextmanager
+    def session(cls, skip_empty: bool = False) -> Generator[None, None, None]:
+        """统计一次运行，嵌套调用(批量下载中的各账号)合并到最外层的报告中
+        
+        Args:
+            skip_empty: 没有下载任何邮件时不写出报告(监视模式的每轮同步，避免空轮询产生大量报告文件)
+        """
+        Metrics.inc('runs_active')
+        with cls._lock:
+            cls._depth += 1
+            if cls._depth == 1:
+                cls._started = time.perf_counter()
+                cls._started_at = datetime.now()
+                cls._phases = {}
+                cls._stats = DownloadStats()
+                cls._counters = collections.defaultdict(int)
+        try:
+            yield
+        finally:
+            with cls._lock:
+                cls._depth -= 1
+                report = cls._snapshot() if cls._depth == 0 else None
+                if report is not None:
+                    cls._started = None
+                    cls._last = report
+            Metrics.inc('runs_active', -1)
+            if report is not None and not (skip_empty and not report['messages']['total']):
+                cls._emit(report)
+
+    @classmethod
+    def active(cls) -> bool:
+        """是否有进行中的运行"""
+        return cls._depth > 0
+
+    @classmethod
+    @contextmanager
+    def phase(cls, name: str) -> Generator[Dict[str, int], None, None]:
+        """测量一段代码的耗时
+        
+        Args:
+            name: 阶段名称
+            
+        Yields:
+            dict: 调用方可把处理的字节数写入 sample['bytes']
+        """
+        sample = {'bytes': 0}
+        start = time.perf_counter()
+        try:
+            yield sample
+        finally:
+            cls.record(name, time.perf_counter() - start, sample['bytes'])
+
+    @classmethod
+    def timed(cls, name: str) -> Callable[[Callable], Callable]:
+        """把整个函数计入指定阶段的装饰器"""
+        def decorator(func: Callable) -> Callable:
+            def wrapper(*args, **kwargs):
+                with cls.phase(name):
+                    return func(*args, **kwargs)
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            wrapper.__wrapped__ = func
+            return wrapper
+        return decorator
+
+    @classmethod
+    def record(cls, name: str, seconds: float, nbytes: int = 0) -> None:
+        """直接记录一次耗时(异步引擎等无法使用with的地方)
+        
+        Args:
+            name: 阶段名称
+            seconds: 耗时(秒)
+            nbytes: 处理的字节数
+        """
+        Metrics.observe(name, seconds, nbytes)
+        if not cls._depth:
+            return
+        with cls._lock:
+            if not cls._depth:
+                return
+            histogram = cls._phases.get(name)
+            if histogram is None:
+                histogram = cls._phases[name] = PhaseHistogram()
+            histogram.add(seconds, nbytes)
+
+    @classmethod
+    def count(cls, name: str, value: int = 1) -> None:
+        """累加本次运行的一个计数(如附件去重节省的字节数)"""
+        if not cls._depth:
+            return
+        with cls._lock:
+            if cls._depth:
+                cls._counters[name] += value
+
+    @classmethod
+    def add_stats(cls, stats: Optional[DownloadStats]) -> None:
+        """把一个文件夹的下载统计计入报告"""
+        with cls._lock:
+            if cls._depth:
+                cls._stats.add(stats)
+
+    @classmethod
+    def last(cls) -> Optional[Dict[str, Any]]:
+        """最近一次运行的报告"""
+        return cls._last
+
+    @classmethod
+    def _snapshot(cls) -> Dict[str, Any]:
+        """生成报告字典(调用方持有_lock)"""
+        elapsed = time.perf_counter() - cls._started
+        phases = sorted(cls._phases.items(), key=lambda item: item[1].total, reverse=True)
+        return {
+            'started_at': cls._started_at.isoformat(timespec='seconds'),
+            'elapsed_s': round(elapsed, 3),
+            'engine': EmailDownload.ENGINE,
+            'messages': {
+                'total': cls._stats.total,
+                'success': cls._stats.success,
+                'failed': cls._stats.failed,
+                'attachments': cls._stats.attachments,
+            },
+            'counters': dict(cls._counters),
+            'phases': {name: histogram.to_dict() for name, histogram in phases},
+        }
+
+    @classmethod
+    def _emit(cls, report: Dict[str, Any]) -> None:
+        """写出JSON报告并在日志中输出摘要"""
+        summary = ' | '.join(
+            f"{name} {phase['count']}次 {phase['total_s']:.2f}s p50 {phase['p50_ms']:.0f}ms p99 {phase['p99_ms']:.0f}ms"
+            for name, phase in report['phases'].items()
+        )
+        messages = report['messages']
+        counters = report['counters']
+        dedup = (
+            f"，附件去重 {counters['attachments_deduplicated']} 个，"
+            f"节省 {Tools.format_size(counters.get('attachment_bytes_saved', 0))}"
+        ) if counters.get('attachments_deduplicated') else ''
+        logger.info(
+            f"运行报告: 耗时 {report['elapsed_s']:.2f}s，成功 {messages['success']} 封，"
+            f"失败 {messages['failed']} 封{dedup}" + (f" | {summary}" if summary else '')
+        )
+        try:
+            cls.DIRECTORY.mkdir(parents=True, exist_ok=True)
+            name = report['started_at'].replace(':', '-').replace('T', '_')
+            path = cls.DIRECTORY / f"run_{name}.json"
+            path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding='utf-8')
+        except OSError as e:
+            logger.warning(f"写入运行报告失败: {e}")
+
+class _ThreadShards:
+    """每个线程独占一个分片的计数容器
+    
+    写入方只修改自己线程的分片，不需要加锁；读取方遍历所有分片求和。
+    只有线程第一次写入时才加锁登记分片。线程结束时它的分片并入基础分片并移除，
+    分片数不超过同时存活的线程数，监视模式每轮新建的线程不会让分片无限增长。
+    """
+
+    class _Owner:
+        """放在线程局部存储中的对象，线程结束时被回收，以此触发分片合并"""
+        __slots__ = ('shard', '__weakref__')
+
+        def __init__(self, shard: Any):
+            self.shard = shard
+
+    def __init__(self, factory: Callable[[], Any], merge: Optional[Callable[[Any, Any], None]] = None):
+        """初始化
+        
+        Args:
+            factory: 创建空分片的函数
+            merge: 把第二个分片累加到第一个分片上的函数，默认按元素相加(用于列表分片)
+        """
+        self._factory = factory
+        self._merge = merge or self._add
+        self._local = threading.local()
+        self._base = factory()
+        self._shards: List[Any] = []
+        self._lock = Lock()
+
+    @staticmethod
+    def _add(total: List[float], shard: List[float]) -> None:
+        for i, value in enumerate(shard):
+            total[i] += value
+
+    def local(self) -> Any:
+        """当前线程的分片"""
+        owner = getattr(self._local, 'owner', None)
+        if owner is None:
+            owner = self._local.owner = self._Owner(self._factory())
+            with self._lock:
+                self._shards.append(owner.shard)
+            # 回调只持有弱引用，不会让已不再使用的容器(如每次下载的ProgressTracker)一直存活
+            finalizer = weakref.finalize(owner, _ThreadShards._retire, weakref.ref(self), owner.shard)
+            finalizer.atexit = False
+        return owner.shard
+
+    @staticmethod
+    def _retire(ref: 'weakref.ref[_ThreadShards]', shard: Any) -> None:
+        """线程已结束，把它的分片并入基础分片"""
+        self = ref()
+        if self is None:
+            return
+        with self._lock:
+            self._merge(self._base, shard)
+            self._shards.remove(shard)
+
+    def all(self) -> List[Any]:
+        """所有分片(已结束线程的分片合并为一个)"""
+        with self._lock:
+            # 复制基础分片，读取期间有线程结束也不会重复计数
+            base = self._factory()
+            self._merge(base, self._base)
+            return [base] + self._shards
+
+class _MetricShard:
+    """一个线程独占的指标分片，只有所属线程写入"""
+    __slots__ = ('counters', 'phases')
+
+    def __init__(self) -> None:
+        self.counters: Dict[str, float] = collections.defaultdict(int)
+        self.phases: Dict[str, PhaseHistogram] = {}
+
+    def merge(self, other: '_MetricShard') -> None:
+        """把other累加到本分片(用于合并已结束线程的分片)"""
+        for name, value in dict(other.counters).items():
+            self.counters[name] += value
+        for name, histogram in dict(other.phases).items():
+            merged = self.phases.get(name)
+            if merged is None:
+                merged = self.phases[name] = PhaseHistogram()
+            merged.merge(histogram)
+
+class Metrics:
+    """进程级下载指标，可选地通过HTTP以Prometheus文本格式导出
+    
+    每个线程写入自己的分片(见_ThreadShards)，计数时不加锁；导出时把所有分片相加。
+    仪表盘类指标(打开的连接数、队列深度等)同样按增量记录，各线程的增减相加即为当前值。
+    各阶段耗时由RunReport.record转发，不论是否处于一次运行中都会累计。
+    
+    账号列表(accounts.json)中设置 "metrics_port" 时批量下载会自动启动导出服务，
+    也可以直接调用 Metrics.serve(port)。
+    
+    Attributes:
+        PREFIX (str): 指标名称前缀
+        HOST (str): 导出服务监听的地址，默认只允许本机访问
+        COUNTERS (dict): 计数器名称 -> (类型, 说明)
+        TRANSFER_PHASES (tuple): 字节数计入 bytes_downloaded_total 的阶段
+    """
+    PREFIX = 'mailbox_downloader'
+    HOST = '127.0.0.1'
+    COUNTERS = {
+        'messages_total': ('counter', '找到的待下载邮件数'),
+        'messages_downloaded_total': ('counter', '成功下载的邮件数'),
+        'messages_failed_total': ('counter', '下载失败的邮件数'),
+        'messages_skipped_total': ('counter', '断点续传跳过的已下载邮件数'),
+        'attachments_saved_total': ('counter', '保存的附件数'),
+        'attachments_deduplicated_total': ('counter', '内容与已保存的附件相同、只建立链接的附件数'),
+        'attachment_bytes_saved_total': ('counter', '附件去重节省的磁盘字节数'),
+        'bytes_downloaded_total': ('counter', '从服务器获取的字节数'),
+        'retries_total': ('counter', '网络错误后重试的FETCH次数'),
+        'connections_open': ('gauge', '打开的IMAP连接数'),
+        'connections_active': ('gauge', '正在使用的IMAP连接数'),
+        'queue_depth': ('gauge', '等待下载的批次数'),
+        'pipeline_bytes': ('gauge', '流水线中等待解析和保存的字节数'),
+        'runs_active': ('gauge', '进行中的下载任务数'),
+    }
+    TRANSFER_PHASES = ('prefetch', 'structure', 'fetch')
+
+    _shards = _ThreadShards(_MetricShard, _MetricShard.merge)
+    _server: Optional[Any] = None
+    _server_lock = Lock()
+
+    @classmethod
+    def _shard(cls) -> _MetricShard:
+        return cls._shards.local()
+
+    @classmethod
+    def inc(cls, name: str, value: float = 1) -> None:
+        """计数器加value(仪表盘类指标可以为负数)"""
+        cls._shard().counters[name] += value
+
+    @classmethod
+    def observe(cls, phase: str, seconds: float, nbytes: int = 0) -> None:
+        """记录一次阶段耗时
+        
+        Args:
+            phase: 阶段名称
+            seconds: 耗时(秒)
+            nbytes: 本次处理的字节数，网络阶段的计入 bytes_downloaded_total
+        """
+        shard = cls._shard()
+        histogram = shard.phases.get(phase)
+        if histogram is None:
+            histogram = shard.phases[phase] = PhaseHistogram()
+        histogram.add(seconds, nbytes)
+        if nbytes and phase in cls.TRANSFER_PHASES:
+            shard.counters['bytes_downloaded_total'] += nbytes
+
+    @classmethod
+    @contextmanager
+    def gauge(cls, name: str, value: float = 1) -> Generator[None, None, None]:
+        """在with块内把仪表盘类指标加value"""
+        cls.inc(name, value)
+        try:
+            yield
+        finally:
+            cls.inc(name, -value)
+
+    @classmethod
+    def snapshot(cls) -> Tuple[Dict[str, float], Dict[str, PhaseHistogram]]:
+        """合并所有分片，返回(计数器, 各阶段直方图)"""
+        shards = cls._shards.all()
+        counters: Dict[str, float] = collections.defaultdict(int)
+        phases: Dict[str, PhaseHistogram] = {}
+        for shard in shards:
+            # dict()复制在GIL下是原子的，所属线程同时写入也不会出错
+            for name, value in dict(shard.counters).items():
+                counters[name] += value
+            for name, histogram in dict(shard.phases).items():
+                merged = phases.get(name)
+                if merged is None:
+                    merged = phases[name] = PhaseHistogram()
+                merged.merge(histogram)
+        return counters, phases
+
+    @classmethod
+    def render(cls) -> str:
+        """生成Prometheus文本格式(0.0.4)的指标"""
+        counters, phases = cls.snapshot()
+        lines = []
+        for name, (kind, help_text) in cls.COUNTERS.items():
+            metric = f'{cls.PREFIX}_{name}'
+            lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} {kind}', f'{metric} {counters.get(name, 0)}']
+
+        metric = f'{cls.PREFIX}_phase_seconds'
+        lines += [f'# HELP {metric} 各阶段耗时', f'# TYPE {metric} histogram']
+        for phase, histogram in sorted(phases.items()):
+            cumulative = 0
+            for bound, count in zip(PhaseHistogram.BOUNDS_MS, histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{phase="{phase}",le="{bound / 1000:g}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{phase="{phase}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{metric}_sum{{phase="{phase}"}} {histogram.total}')
+            lines.append(f'{metric}_count{{phase="{phase}"}} {histogram.count}')
+
+        metric = f'{cls.PREFIX}_phase_bytes_total'
+        lines += [f'# HELP {metric} 各阶段处理的字节数', f'# TYPE {metric} counter']
+        for phase, histogram in sorted(phases.items()):
+            lines.append(f'{metric}{{phase="{phase}"}} {histogram.bytes}')
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def serve(cls, port: int, host: Optional[str] = None) -> Any:
+        """在后台线程中启动导出服务(GET /metrics)，已启动时直接返回
+        
+        Args:
+            port: 监听端口，0表示随机端口
+            host: 监听地址，默认为HOST
+            
+        Returns:
+            ThreadingHTTPServer: 导出服务，server_address[1]为实际端口
+        """
+        with cls._server_lock:
+            if cls._server is not None:
+                return cls._server
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self) -> None:
+                    if self.path.split('?')[0] not in ('/', '/metrics'):
+                        self.send_error(404)
+                        return
+                    body = Metrics.render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format: str, *args: Any) -> None:
+                    pass  # 抓取请求不写入下载日志
+
+            server = ThreadingHTTPServer((host or cls.HOST, port), Handler)
+            server.daemon_threads = True
+            Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+            cls._server = server
+        logger.info(f"指标导出服务已启动: http://{server.server_address[0]}:{server.server_address[1]}/metrics")
+        return server
+
+    @classmethod
+    def shutdown(cls) -> None:
+        """停止导出服务"""
+        with cls._server_lock:
+            server, cls._server = cls._server, None
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+class SpoolingIMAP4_SSL(imaplib.IMAP4_SSL):
+    """把大字面量暂存到磁盘的IMAP4_SSL
+    
+    imaplib会把每个字面量(如RFC822邮件原文)整体读入内存。超过SPOOL_THRESHOLD
+    的字面量改为按CHUNK_SIZE分块写入临时文件，FETCH结果中返回该文件对象。
+    
+    Attributes:
+        SPOOL_THRESHOLD (int): 暂存到磁盘的字面量大小阈值(字节)
+    """
+
+    SPOOL_THRESHOLD = 1024 * 1024  # 1MB
+
+    def __init__(self, host: str = '', port: int = imaplib.IMAP4_SSL_PORT, timeout: Optional[float] = None):
+        super().__init__(host, port, ssl_context=EmailDownload.SSL_CONTEXT, timeout=timeout)
+
+    def read(self, size: int) -> Union[bytes, BinaryIO]:
+        if size <= self.SPOOL_THRESHOLD:
+            return imaplib.IMAP4.read(self, size)
+        spool = tempfile.TemporaryFile()
+        remaining = size
+        while remaining:
+            chunk = imaplib.IMAP4.read(self, min(remaining, EmailDownload.CHUNK_SIZE))
+            if not chunk:
+                spool.close()
+                raise self.abort('socket error: EOF')
+            spool.write(chunk)
+            remaining -= len(chunk)
+        spool.seek(0)
+        return spool
+
+
+class SpoolingIMAP4(imaplib.IMAP4):
+    """不加密的SpoolingIMAP4_SSL，仅用于本地测试服务器(imap://地址)"""
+
+    SPOOL_THRESHOLD = SpoolingIMAP4_SSL.SPOOL_THRESHOLD
+    read = SpoolingIMAP4_SSL.read
+
+
+class PooledConnection:
+    """连接池中的单个IMAP会话
+    
+    Attributes:
+        mail: IMAP连接对象
+        selected: 当前已选中的邮箱文件夹(未选中时为None)
+        uidvalidity: 当前文件夹的UIDVALIDITY
+        last_used: 最近一次使用的时间(time.monotonic)
+        broken: 连接是否已损坏(归还时将被丢弃)
+    """
+
+    def __init__(self, mail: imaplib.IMAP4_SSL):
+        self.mail = mail
+        self.selected: Optional[str] = None
+        self.uidvalidity: Optional[int] = None
+        self.last_used = time.monotonic()
+        self.broken = False
+
+    def select(self, mailbox: str = "INBOX") -> None:
+        """选中邮箱文件夹，已选中同一文件夹时不再重复发送SELECT
+        
+        Args:
+            mailbox: 邮箱文件夹名称
+            
+        Raises:
+            imaplib.IMAP4.error: 服务器拒绝SELECT时抛出
+        """
+        if self.selected == mailbox:
+            return
+        with RunReport.phase('select'):
+            status, data = self.mail.select(Tools.quote_mailbox(mailbox))
+        if status != 'OK':
+            self.selected = None
+            raise imaplib.IMAP4.error(f"选择邮箱 {mailbox} 失败: {data}")
+        self.selected = mailbox
+        _, data = self.mail.response('UIDVALIDITY')
+        self.uidvalidity = int(data[0]) if data and data[0] else None
+
+    def noop(self) -> bool:
+        """发送NOOP检查连接是否存活
+        
+        Returns:
+            bool: 连接是否可用
+        """
+        try:
+            status, _ = self.mail.noop()
+        except Exception as e:
+            logger.debug(f"NOOP失败: {e}")
+            status = 'NO'
+        if status != 'OK':
+            self.broken = True
+            return False
+        self.last_used = time.monotonic()
+        return True
+
+    _EXISTS_RE = re.compile(rb'^\* \d+ EXISTS', re.IGNORECASE)
+
+    def idle(self, timeout: float, stop: Optional[threading.Event] = None) -> bool:
+        """发送IDLE(RFC 2177)并等待服务器推送新邮件
+        
+        收到EXISTS、超过timeout或stop被设置时发送DONE结束IDLE。连接需已选中文件夹，
+        未处于IDLE期间到达的邮件会在下次进入IDLE时由服务器补发EXISTS，因此不会遗漏。
+        
+        Args:
+            timeout: 最长等待时间(秒)，应小于服务器的IDLE超时(通常为30分钟)
+            stop: 设置后尽快结束等待
+            
+        Returns:
+            bool: 是否有新邮件到达
+            
+        Raises:
+            imaplib.IMAP4.abort: 连接中断时抛出
+            imaplib.IMAP4.error: 服务器拒绝IDLE时抛出
+        """
+        mail = self.mail
+        tag = mail._new_tag()
+        mail.send(tag + b' IDLE\r\n')
+        arrived = False
+        line = self._readline()
+        while line.startswith(b'* '):
+            arrived = arrived or bool(self._EXISTS_RE.match(line))
+            line = self._readline()
+        if not line.startswith(b'+'):
+            raise imaplib.IMAP4.error(f"IDLE失败: {line.decode('utf-8', 'replace').strip()}")
+
+        deadline = time.monotonic() + timeout
+        while not arrived and not (stop and stop.is_set()):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if self._wait_readable(min(remaining, 1.0)):
+                arrived = bool(self._EXISTS_RE.match(self._readline()))
+
+        mail.send(b'DONE\r\n')
+        while True:
+            line = self._readline()
+            if line.startswith(tag):
+                break
+            arrived = arrived or bool(self._EXISTS_RE.match(line))
+        if line[len(tag):].split()[:1] != [b'OK']:
+            raise imaplib.IMAP4.error(f"IDLE失败: {line.decode('utf-8', 'replace').strip()}")
+        self.last_used = time.monotonic()
+        return arrived
+
+    def _readline(self) -> bytes:
+        line = self.mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("服务器关闭了连接")
+        return line
+
+    def _wait_readable(self, timeout: float) -> bool:
+        """等待连接上有数据可读
+        
+        imaplib的读缓冲区和SSL层中可能已有数据而套接字本身不可读，
+        因此先以非阻塞方式窥视缓冲区，再对套接字select。
+        """
+        sock = self.mail.sock
+        previous_timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            if self.mail.file.peek(1):
+                return True
+        except (ssl.SSLWantReadError, BlockingIOError):
+            pass
+        finally:
+            sock.settimeout(previous_timeout)
+        return bool(select.select([sock], [], [], timeout)[0])
+
+    def logout(self) -> None:
+        """关闭连接，忽略关闭过程中的错误"""
+        try:
+            if self.selected and not self.broken:
+                self.mail.close()
+        except Exception as e:
+            logger.debug(f"关闭邮箱文件夹时出错: {e}")
+        try:
+            self.mail.logout()
+        except Exception as e:
+            logger.debug(f"注销IMAP连接时出错: {e}")
+
+
+class ConnectionBudget:
+    """多账号共享的IMAP连接预算
+    
+    同时下载多个账号时限制实际打开的连接数：总数不超过total；同一服务器上所有账号
+    合计不超过该服务器的上限(imap_servers.json中的max_connections，许多QQ邮箱账号
+    共用同一个限制)；每个账号不超过公平份额，即所在服务器上限和总数分别按活跃账号数
+    均分后的较小值。账号结束后份额自动增大，超出份额的空闲连接在归还时关闭，让给其他账号。
+    """
+
+    def __init__(self, total: int):
+        """初始化
+        
+        Args:
+            total: 所有账号合计的最大连接数
+        """
+        self.total = total
+        self._cond = threading.Condition()
+        self._open_total = 0
+        self._open_server: Dict[str, int] = collections.Counter()
+        self._open_account: Dict[str, int] = collections.Counter()
+        self._accounts: Dict[str, str] = {}  # 正在下载的账号 -> 服务器
+        self._servers: Dict[str, str] = {}   # 所有登记过的账号 -> 服务器(账号结束后仍有连接待关闭)
+        self._limits: Dict[str, int] = {}
+
+    def register(self, account: str, server: str) -> None:
+        """登记一个正在下载的账号"""
+        with self._cond:
+            self._accounts[account] = server
+            self._servers[account] = server
+            if server not in self._limits:
+                self._limits[server] = EmailDownload.get_server_limits(server)[1]
+
+    def unregister(self, account: str) -> None:
+        """账号下载结束，其份额由其他账号分享"""
+        with self._cond:
+            self._accounts.pop(account, None)
+            self._cond.notify_all()
+
+    def share(self, account: str) -> int:
+        """账号当前可以打开的连接数"""
+        server = self._servers.get(account)
+        peers = sum(1 for s in self._accounts.values() if s == server) or 1
+        server_share = -(-self._limits.get(server, self.total) // peers)
+        total_share = -(-self.total // (len(self._accounts) or 1))
+        return max(1, min(server_share, total_share))
+
+    def acquire(self, account: str, timeout: Optional[float] = None) -> bool:
+        """申请打开一个连接
+        
+        Args:
+            account: 账号
+            timeout: 最长等待时间(秒)，为None时一直等待
+            
+        Returns:
+            bool: 是否申请成功
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            server = self._servers.get(account)
+            while not (
+                self._open_total < self.total
+                and self._open_server[server] < self._limits.get(server, self.total)
+                and self._open_account[account] < self.share(account)
+            ):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            self._open_total += 1
+            self._open_server[server] += 1
+            self._open_account[account] += 1
+            return True
+
+    def release(self, account: str) -> None:
+        """连接已关闭"""
+        with self._cond:
+            server = self._servers.get(account)
+            self._open_total -= 1
+            self._open_server[server] -= 1
+            self._open_account[account] -= 1
+            self._cond.notify_all()
+
+    def over_share(self, account: str) -> bool:
+        """账号打开的连接是否超过了当前份额"""
+        with self._cond:
+            return self._open_account[account] > self.share(account)
+
+    def wake(self) -> None:
+        """有连接归还到空闲列表时唤醒等待者，让它们重新检查"""
+        with self._cond:
+            self._cond.notify_all()
+
+
+class IMAPConnectionPool:
+    """IMAP连接池
+    
+    为同一账号维护一组已登录的IMAP会话，供下载线程租用和归还，
+    避免每封邮件都重新进行TLS握手和LOGIN。
+    
+    Attributes:
+        KEEPALIVE_INTERVAL (int): 空闲连接发送NOOP保活的间隔(秒)
+    """
+
+    KEEPALIVE_INTERVAL = 60
+    BUDGET_WAIT = 0.5
+
+    def __init__(
+        self,
+        email_address: str,
+        password: str,
+        size: Optional[int] = None,
+        keepalive_interval: Optional[float] = None,
+        budget: Optional[ConnectionBudget] = None
+    ):
+        """初始化连接池
+        
+        Args:
+            email_address: 邮箱地址
+            password: 邮箱密码
+            size: 最大连接数，默认为EmailDownload.MAX_WORKERS
+            keepalive_interval: 保活间隔(秒)，默认为KEEPALIVE_INTERVAL
+            budget: 多账号共享的连接预算，为None时只受size限制
+        """
+        self.email_address = email_address
+        self.password = password
+        self.size = size or EmailDownload.MAX_WORKERS
+        self.keepalive_interval = keepalive_interval or self.KEEPALIVE_INTERVAL
+        self.budget = budget
+        if budget:
+            budget.register(email_address, EmailDownload.get_imap_server(email_address.split("@")[1]))
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = Lock()
+        self._idle: List[PooledConnection] = []
+        self._open = 0
+        self._closed = threading.Event()
+        self._keepalive_thread = Thread(target=self._keepalive_loop, name='imap-keepalive', daemon=True)
+        self._keepalive_thread.start()
+
+    def __enter__(self) -> 'IMAPConnectionPool':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @contextmanager
+    def lease(self, mailbox: Optional[str] = "INBOX") -> Generator[PooledConnection, None, None]:
+        """租用一个连接，使用完毕后自动归还
+        
+        Args:
+            mailbox: 需要选中的邮箱文件夹，为None时不发送SELECT
+            
+        Yields:
+            PooledConnection: 已登录(并已选中文件夹)的连接
+            
+        Raises:
+            Exception: 连接或登录失败时抛出异常
+        """
+        if self._closed.is_set():
+            raise RuntimeError("连接池已关闭")
+        self._slots.acquire()
+        conn = None
+        try:
+            conn = self._acquire()
+            if mailbox:
+                conn.select(mailbox)
+            with Metrics.gauge('connections_active'):
+                yield conn
+        except (imaplib.IMAP4.abort, OSError):
+            # 连接已断开，归还时丢弃，下次租用时自动重连
+            if conn:
+                conn.broken = True
+            raise
+        finally:
+            if conn:
+                self._release(conn)
+            self._slots.release()
+
+    def reserve(self) -> None:
+        """为池外建立的连接(asyncio引擎的连接)占用一个名额，名额或预算不足时阻塞
+        
+        与lease()共用连接数上限和多账号预算，池中的空闲连接在需要时先关闭让出位置。
+        使用完毕后必须调用release_reservation()。
+        
+        Raises:
+            RuntimeError: 连接池已关闭
+        """
+        if self._closed.is_set():
+            raise RuntimeError("连接池已关闭")
+        self._slots.acquire()
+        try:
+            # 租用中的连接和预留名额合计不超过size，关闭多余的空闲连接即可保证打开的连接数不超限；
+            # 其他线程正在注销的连接仍计入_open，等它们关闭后再继续
+            while True:
+                self.trim(self.size - 1)
+                with self._lock:
+                    if self._open < self.size:
+                        break
+                time.sleep(0.05)
+            while self.budget and not self.budget.acquire(self.email_address, self.BUDGET_WAIT):
+                if self._closed.is_set():
+                    raise RuntimeError("连接池已关闭")
+                self.trim(0)  # 预算被本账号的空闲连接占用
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._open += 1
+
+    def release_reservation(self) -> None:
+        """池外的连接已关闭，归还reserve()占用的名额"""
+        with self._lock:
+            self._open -= 1
+        if self.budget:
+            self.budget.release(self.email_address)
+        self._slots.release()
+
+    def close(self) -> None:
+        """关闭连接池及所有空闲连接"""
+        self._closed.set()
+        if self._keepalive_thread.is_alive() and self._keepalive_thread is not threading.current_thread():
+            self._keepalive_thread.join(timeout=5)
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+        if self.budget:
+            self.budget.unregister(self.email_address)
+
+    def trim(self, max_open: int) -> None:
+        """关闭多余的空闲连接，使打开的连接数不超过max_open(并发上限下调时使用)
+        
+        Args:
+            max_open: 允许保持打开的连接数
+        """
+        with self._lock:
+            surplus = []
+            while self._idle and self._open - len(surplus) > max_open:
+                surplus.append(self._idle.pop(0))
+        for conn in surplus:
+            self._discard(conn)
+
+    def _discard(self, conn: PooledConnection) -> None:
+        conn.logout()
+        Metrics.inc('connections_open', -1)
+        with self._lock:
+            self._open -= 1
+        if self.budget:
+            self.budget.release(self.email_address)
+
+    def _acquire(self) -> PooledConnection:
+        """取出一个健康的空闲连接，没有则新建"""
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                if self.budget and not self.budget.acquire(self.email_address, self.BUDGET_WAIT):
+                    continue  # 预算已用完，稍后再看是否有本账号的连接归还
+                # 建立连接期间就计入_open，reserve()才不会在此期间多放出一个名额
+                with self._lock:
+                    self._open += 1
+                try:
+                    conn = PooledConnection(EmailDownload._open_connection(self.email_address, self.password))
+                except Exception:
+                    with self._lock:
+                        self._open -= 1
+                    if self.budget:
+                        self.budget.release(self.email_address)
+                    raise
+                Metrics.inc('connections_open')
+                return conn
+            if time.monotonic() - conn.last_used < self.keepalive_interval or conn.noop():
+                return conn
+            logger.info("检测到失效的IMAP连接，正在重新连接")
+            self._discard(conn)
+
+    def _release(self, conn: PooledConnection) -> None:
+        """归还连接，损坏的连接及超出预算份额的连接直接关闭"""
+        if conn.broken or self._closed.is_set() or (self.budget and self.budget.over_share(self.email_address)):
+            self._discard(conn)
+            return
+        conn.last_used = time.monotonic()
+        with self._lock:
+            self._idle.append(conn)
+        if self.budget:
+            self.budget.wake()
+
+    def _keepalive_loop(self) -> None:
+        """后台线程：定期对空闲连接发送NOOP，丢弃已失效的连接"""
+        while not self._closed.wait(self.keepalive_interval / 2):
+            now = time.monotonic()
+            with self._lock:
+                stale = [c for c in self._idle if now - c.last_used >= self.keepalive_interval]
+                self._idle = [c for c in self._idle if c not in stale]
+            for conn in stale:
+                if conn.noop():
+                    self._release(conn)
+                else:
+                    self._discard(conn)
+
+
+class ConcurrencyController:
+    """AIMD并发控制器
+    
+    根据每次FETCH的耗时、吞吐量和服务器错误动态调整同时活动的连接数：
+    每完成一轮(当前上限次)FETCH，若吞吐量没有下降且延迟未明显升高则上限加一(加性增)；
+    若吞吐量下降则回退一；遇到连接被断开、"too many connections"、限流BYE等错误时
+    上限减半(乘性减)。上限始终保持在 [min_limit, max_limit] 之间。
+    
+    Attributes:
+        THROTTLE_PATTERNS (tuple): 视为服务器限流的错误信息片段(小写)
+        THROUGHPUT_TOLERANCE (float): 判定吞吐量下降的容差比例
+        LATENCY_FACTOR (float): 平均延迟超过最低延迟的倍数时停止增加并发
+    """
+
+    THROTTLE_PATTERNS = (
+        'too many', 'connection limit', 'maximum number of connections', 'throttl',
+        'rate limit', 'try again later', 'exceeded', 'temporarily unavailable'
+    )
+    THROUGHPUT_TOLERANCE = 0.05
+    LATENCY_FACTOR = 3.0
+
+    def __init__(
+        self,
+        min_limit: int,
+        max_limit: int,
+        initial: Optional[int] = None,
+        on_change: Optional[Callable[[int], None]] = None
+    ):
+        """初始化
+        
+        Args:
+            min_limit: 并发下限
+            max_limit: 并发上限
+            initial: 初始并发数，默认为min_limit
+            on_change: 并发上限变化时的回调，参数为新的上限
+        """
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = min(max(initial or self.min_limit, self.min_limit), self.max_limit)
+        self.on_change = on_change
+        self.errors = 0
+        self.latency: Optional[float] = None
+        self._best_latency: Optional[float] = None
+        self._active = 0
+        self._cond = threading.Condition()
+        self._window_count = 0
+        self._window_bytes = 0
+        self._window_start = time.monotonic()
+        self._last_throughput = 0.0
+
+    @contextmanager
+    def slot(self) -> Generator[None, None, None]:
+        """占用一个并发名额，名额已满时等待"""
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify()
+
+    @contextmanager
+    def track(self) -> Generator[Dict[str, int], None, None]:
+        """占用名额并测量一次FETCH
+        
+        Yields:
+            dict: 调用方把获取到的字节数写入 sample['bytes']
+        """
+        with self.slot():
+            sample = {'bytes': 0}
+            start = time.monotonic()
+            try:
+                yield sample
+            except Exception as e:
+                self.record_error(e)
+                raise
+            self.record_success(time.monotonic() - start, sample['bytes'])
+
+    def record_success(self, latency: float, nbytes: int) -> None:
+        """记录一次成功的FETCH
+        
+        Args:
+            latency: 耗时(秒)
+            nbytes: 获取的字节数
+        """
+        changed = False
+        with self._cond:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            self._best_latency = self.latency if self._best_latency is None else min(self._best_latency, self.latency)
+            self._window_count += 1
+            self._window_bytes += nbytes
+            if self._window_count < self.limit:
+                return
+            now = time.monotonic()
+            throughput = self._window_bytes / max(now - self._window_start, 1e-6)
+            congested = self.latency > self.LATENCY_FACTOR * self._best_latency
+            if throughput < self._last_throughput * (1 - self.THROUGHPUT_TOLERANCE):
+                changed = self._set_limit(self.limit - 1)
+            elif not congested:
+                changed = self._set_limit(self.limit + 1)
+            self._last_throughput = throughput
+            self._reset_window(now)
+        if changed:
+            self._notify_change()
+
+    def record_error(self, error: BaseException) -> bool:
+        """记录一次失败，服务器限流或断开连接时并发上限减半
+        
+        Args:
+            error: 捕获到的异常
+            
+        Returns:
+            bool: 是否判定为限流
+        """
+        message = str(error).lower()
+        throttled = isinstance(error, (imaplib.IMAP4.abort, ConnectionError)) or any(
+            pattern in message for pattern in self.THROTTLE_PATTERNS
+        )
+        changed = False
+        with self._cond:
+            self.errors += 1
+            if throttled:
+                logger.warning(f"服务器限流或断开连接，并发数降为 {max(self.min_limit, self.limit // 2)}: {error}")
+                changed = self._set_limit(self.limit // 2)
+                self._last_throughput = 0.0
+                self._reset_window(time.monotonic())
+        if changed:
+            self._notify_change()
+        return throttled
+
+    def _set_limit(self, limit: int) -> bool:
+        """在持有_cond时修改上限，返回上限是否变化(变化时由调用方在释放锁后调用_notify_change)"""
+        limit = min(max(limit, self.min_limit), self.max_limit)
+        if limit == self.limit:
+            return False
+        self.limit = limit
+        self._cond.notify_all()
+        return True
+
+    def _notify_change(self) -> None:
+        # on_change(如连接池的trim)可能需要网络往返，不能在持有_cond时调用，否则会阻塞所有等待名额的线程；
+        # 传入调用时的最新上限，多个线程先后调整时以最后的结果为准
+        if self.on_change:
+            self.on_change(self.limit)
+
+    def _reset_window(self, now: float) -> None:
+        self._window_count = 0
+        self._window_bytes = 0
+        self._window_start = now
+
+
+class UIDSet:
+    """以有序区间列表保存的UID集合
+    
+    连续的UID合并为一个区间，50万封连续邮件只占一个区间；
+    查找通过二分完成，复杂度与区间数(而非UID数)相关。
+    """
+
+    def __init__(self, uids: Iterable[Union[bytes, str, int]] = ()):
+        self._starts: List[int] = []
+        self._ends: List[int] = []
+        self._count = 0
+        for uid in sorted({int(uid) for uid in uids}):
+            self.add(uid)
+
+    def __contains__(self, uid: int) -> bool:
+        i = bisect.bisect_right(self._starts, uid) - 1
+        return i >= 0 and uid <= self._ends[i]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[int]:
+        for start, end in zip(self._starts, self._ends):
+            yield from range(start, end + 1)
+
+    def __str__(self) -> str:
+        return ','.join(str(lo) if lo == hi else f"{lo}:{hi}" for lo, hi in self.ranges())
+
+    def ranges(self) -> List[Tuple[int, int]]:
+        """返回 (起始UID, 结束UID) 区间列表"""
+        return list(zip(self._starts, self._ends))
+
+    @classmethod
+    def parse(cls, sequence_set: Union[bytes, str]) -> 'UIDSet':
+        """解析IMAP序列集合，如 "1:50,73,80:120"(ESEARCH的ALL结果)"""
+        if isinstance(sequence_set, bytes):
+            sequence_set = sequence_set.decode('ascii')
+        uids = cls()
+        for item in filter(None, sequence_set.split(',')):
+            start, _, end = item.partition(':')
+            start, end = int(start), int(end or start)
+            uids.add_range(min(start, end), max(start, end))
+        return uids
+
+    @classmethod
+    def from_search(cls, data: Iterable[Any]) -> 'UIDSet':
+        """逐个扫描SEARCH响应中的UID并合并为区间，不生成中间的UID列表
+        
+        Args:
+            data: imaplib返回的SEARCH响应数据(以空格分隔的UID)
+        """
+        uids = cls()
+        start = end = None
+        for chunk in data:
+            if not isinstance(chunk, (bytes, str)):
+                continue
+            if isinstance(chunk, str):
+                chunk = chunk.encode('ascii')
+            for match in re.finditer(rb'\d+', chunk):
+                uid = int(match.group())
+                if start is not None and uid == end + 1:
+                    end = uid
+                    continue
+                if start is not None:
+                    uids.add_range(start, end)
+                start = end = uid
+        if start is not None:
+            uids.add_range(start, end)
+        return uids
+
+    def copy(self) -> 'UIDSet':
+        uids = UIDSet()
+        uids._starts, uids._ends, uids._count = list(self._starts), list(self._ends), self._count
+        return uids
+
+    def difference_update(self, other: 'UIDSet') -> None:
+        """移除other中的所有UID，按区间进行"""
+        for start, end in other.ranges():
+            self.discard_range(start, end)
+
+    def add(self, uid: int) -> None:
+        self.add_range(uid, uid)
+
+    def add_range(self, start: int, end: int) -> None:
+        """加入闭区间[start, end]，与相交或相邻的区间合并"""
+        if start > end:
+            return
+        lo = bisect.bisect_left(self._ends, start - 1)
+        hi = bisect.bisect_right(self._starts, end + 1)
+        covered = 0
+        if lo < hi:
+            covered = sum(e - s + 1 for s, e in zip(self._starts[lo:hi], self._ends[lo:hi]))
+            start, end = min(start, self._starts[lo]), max(end, self._ends[hi - 1])
+        self._starts[lo:hi] = [start]
+        self._ends[lo:hi] = [end]
+        self._count += end - start + 1 - covered
+
+    def discard(self, uid: int) -> None:
+        self.discard_range(uid, uid)
+
+    def discard_range(self, start: int, end: int) -> None:
+        """移除闭区间[start, end]内的UID，必要时拆分区间"""
+        lo = bisect.bisect_left(self._ends, start)
+        hi = bisect.bisect_right(self._starts, end)
+        if start > end or lo >= hi:
+            return
+        self._count -= sum(min(e, end) - max(s, start) + 1 for s, e in zip(self._starts[lo:hi], self._ends[lo:hi]))
+        starts, ends = [], []
+        if self._starts[lo] < start:
+            starts.append(self._starts[lo])
+            ends.append(start - 1)
+        if self._ends[hi - 1] > end:
+            starts.append(end + 1)
+            ends.append(self._ends[hi - 1])
+        self._starts[lo:hi] = starts
+        self._ends[lo:hi] = ends
+
+    def clear(self) -> None:
+        self._starts, self._ends, self._count = [], [], 0
+
+    def chunks(self, size: int) -> Iterator['UIDSet']:
+        """按UID顺序切分为每组最多size个UID的子集合，按区间切分，不展开UID"""
+        chunk = UIDSet()
+        for start, end in self.ranges():
+            while start <= end:
+                stop = min(end, start + size - len(chunk) - 1)
+                chunk.add_range(start, stop)
+                start = stop + 1
+                if len(chunk) >= size:
+                    yield chunk
+                    chunk = UIDSet()
+        if chunk:
+            yield chunk
+
+
+class ResumeJournal:
+    """断点续传日志
+    
+    取代每封邮件都整体重写一次的resume.json。断点以 (UIDVALIDITY, UID) 为键：
+    日志记录所属文件夹的UIDVALIDITY("V值")，每条结果以一行追加
+    ("+UID"表示已完成，"-UID"表示失败)；服务器UIDVALIDITY变化说明原有UID已失效，
+    旧记录随之作废。追加为O(1)，fsync按条数和时间批量进行；内存中用UIDSet保存状态。
+    日志中的冗余记录超过一定比例时写入按区间压缩的快照并原子替换。
+    
+    Attributes:
+        FSYNC_EVERY (int): 累计多少条记录后执行一次fsync
+        FSYNC_INTERVAL (float): 距上次fsync超过多少秒后执行fsync
+        COMPACT_MIN_RECORDS (int): 触发压缩的最少日志行数
+    """
+
+    FSYNC_EVERY = 64
+    FSYNC_INTERVAL = 1.0
+    COMPACT_MIN_RECORDS = 1024
+    FILENAME = 'resume.journal'
+
+    def __init__(self, directory: Path):
+        """打开(必要时创建)日志并读取已有记录
+        
+        Args:
+            directory: 邮箱下载目录
+        """
+        self.directory = Path(directory)
+        self.path = self.directory / self.FILENAME
+        self.uidvalidity: Optional[int] = None
+        self.completed = UIDSet()
+        self.failed = UIDSet()
+        self._lock = Lock()
+        self._records = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if self.path.exists():
+            self._load()
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def __enter__(self) -> 'ResumeJournal':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def set_uidvalidity(self, uidvalidity: Optional[int]) -> None:
+        """设置当前文件夹的UIDVALIDITY，与日志中的不一致时清空旧记录
+        
+        Args:
+            uidvalidity: SELECT返回的UIDVALIDITY，服务器未提供时为None
+        """
+        if uidvalidity is None:
+            return
+        with self._lock:
+            if self.uidvalidity == uidvalidity:
+                return
+            if self.uidvalidity is not None:
+                logger.warning(f"UIDVALIDITY已变化({self.uidvalidity} -> {uidvalidity})，断点记录作废")
+                self.completed.clear()
+                self.failed.clear()
+            self.uidvalidity = uidvalidity
+            self._sync()
+            self._file.close()
+            self._write_snapshot()
+            self._file = open(self.path, 'a', encoding='utf-8')
+
+    def record(self, uid: int, success: bool) -> None:
+        """追加一条下载结果
+        
+        Args:
+            uid: 邮件UID
+            success: 是否成功下载
+        """
+        with self._lock:
+            if success:
+                self.completed.add(uid)
+                self.failed.discard(uid)
+            elif uid not in self.completed:
+                self.failed.add(uid)
+            self._file.write(f"{'+' if success else '-'}{uid}\n")
+            self._records += 1
+            self._unsynced += 1
+            if self._unsynced >= self.FSYNC_EVERY or time.monotonic() - self._last_sync >= self.FSYNC_INTERVAL:
+                self._sync()
+            if self._needs_compaction():
+                self._compact()
+
+    def flush(self) -> None:
+        """把缓冲中的记录写入磁盘"""
+        with self._lock:
+            self._sync()
+
+    def close(self) -> None:
+        """写入剩余记录，必要时压缩后关闭日志"""
+        with self._lock:
+            if self._file.closed:
+                return
+            self._sync()
+            if self._needs_compaction():
+                self._compact()
+            self._file.close()
+
+    def _load(self) -> None:
+        """顺序读取日志；进程崩溃导致的不完整末行和无法识别的行会被忽略"""
+        with open(self.path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if not line.endswith('\n') or len(line) < 3:
+                    continue
+                op, value = line[0], line[1:-1]
+                try:
+                    start, _, end = value.partition(':')
+                    start, end = int(start), int(end or start)
+                except ValueError:
+                    continue
+                self._records += 1
+                if op == 'V':
+                    if self.uidvalidity is not None and self.uidvalidity != start:
+                        self.completed.clear()
+                        self.failed.clear()
+                    self.uidvalidity = start
+                elif op == '+':
+                    self.completed.add_range(start, end)
+                    self.failed.discard_range(start, end)
+                elif op == '-' and (start != end or start not in self.completed):
+                    # 快照中的失败区间与已完成区间不相交，只需检查单条记录
+                    self.failed.add_range(start, end)
+        if self._needs_compaction():
+            self._write_snapshot()
+
+    def _sync(self) -> None:
+        self._file.flush()
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _needs_compaction(self) -> bool:
+        live = len(self.completed.ranges()) + len(self.failed.ranges()) + 1
+        return self._records >= self.COMPACT_MIN_RECORDS and self._records > 2 * live
+
+    def _compact(self) -> None:
+        self._sync()
+        self._file.close()
+        self._write_snapshot()
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def _write_snapshot(self) -> None:
+        """把当前状态按区间写入临时文件后原子替换日志"""
+        temp_path = self.path.with_suffix('.tmp')
+        lines = [f"V{self.uidvalidity}\n"] if self.uidvalidity is not None else []
+        for op, uids in (('+', self.completed), ('-', self.failed)):
+            lines += [f"{op}{lo}\n" if lo == hi else f"{op}{lo}:{hi}\n" for lo, hi in uids.ranges()]
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self._records = len(lines)
+
+
+class SyncState:
+    """增量同步状态
+    
+    按文件夹记录上次同步开始时服务器报告的UIDVALIDITY、UIDNEXT和HIGHESTMODSEQ，
+    保存在 downloads/<邮箱>/sync_state.json。下次同步先用一条STATUS命令比较这些值：
+    UIDVALIDITY和UIDNEXT都未变说明没有新邮件，直接结束；UIDVALIDITY未变时只需
+    UID SEARCH UID <上次UIDNEXT>:* 取得新邮件；UIDVALIDITY变化则退回全量同步。
+    
+    HIGHESTMODSEQ仅在服务器支持CONDSTORE(或QRESYNC)时获取并记录，用于区分
+    "邮箱完全没有变化"和"只有已有邮件的标志或删除发生变化"；后者同样不需要下载。
+    """
+
+    FILENAME = 'sync_state.json'
+    STATUS_ITEMS = ('UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ')
+
+    def __init__(self, directory: Path):
+        """读取同步状态文件
+        
+        Args:
+            directory: 邮箱的下载目录
+        """
+        self.path = Path(directory) / self.FILENAME
+        self.folders: Dict[str, Dict[str, int]] = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.folders = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"读取同步状态失败，将执行全量同步: {e}")
+
+    def get(self, folder: str) -> Optional[Dict[str, int]]:
+        return self.folders.get(folder)
+
+    def update(self, folder: str, status: Dict[str, int]) -> None:
+        """记录文件夹本次同步开始时的状态并立即保存"""
+        self.folders[folder] = dict(status)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_suffix('.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.folders, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    @staticmethod
+    def query(mail: imaplib.IMAP4_SSL, folder: str) -> Dict[str, int]:
+        """用一条STATUS命令获取文件夹的UIDVALIDITY、UIDNEXT及HIGHESTMODSEQ
+        
+        Args:
+            mail: IMAP连接
+            folder: 文件夹名称
+            
+        Returns:
+            dict: 状态项到数值的映射
+        """
+        items = [item for item in SyncState.STATUS_ITEMS
+                 if item != 'HIGHESTMODSEQ' or {'CONDSTORE', 'QRESYNC'} & set(mail.capabilities)]
+        status, data = mail.status(Tools.quote_mailbox(folder), f"({' '.join(items)})")
+        if status != 'OK' or not data or not data[0]:
+            raise Exception(f"获取文件夹状态失败: {status}")
+        text = Tools.literal_bytes(data[0]).decode('utf-8', 'replace')
+        return {key.upper(): int(value) for key, value in re.findall(r'(\w+) (\d+)', text[text.rfind('('):])}
+
+    @staticmethod
+    def has_new_messages(previous: Optional[Dict[str, int]], current: Dict[str, int]) -> bool:
+        """判断文件夹自上次同步以来是否可能有新邮件"""
+        return not previous or any(
+            previous.get(key) != current.get(key) for key in ('UIDVALIDITY', 'UIDNEXT')
+        )
+
+    @staticmethod
+    def search_criteria(
+        previous: Optional[Dict[str, int]],
+        current: Dict[str, int],
+        retry: Optional['UIDSet'] = None
+    ) -> Tuple[str, ...]:
+        """生成增量同步的UID SEARCH条件
+        
+        Args:
+            previous: 上次同步的状态
+            current: 本次STATUS得到的状态
+            retry: 上次下载失败、需要重试的UID
+            
+        Returns:
+            tuple: UID SEARCH的参数；无可用状态或UIDVALIDITY变化时为 ('ALL',)
+        """
+        if not previous or previous.get('UIDVALIDITY') != current.get('UIDVALIDITY'):
+            return ('ALL',)
+        criteria = f"UID {previous.get('UIDNEXT', 1)}:*"
+        if retry:
+            return ('OR', f"UID {retry}", criteria)
+        return (criteria,)
+
+
+class SeenFlagUpdater:
+    """下载后标记已读
+    
+    收集下载成功的UID，合并为UID区间后由后台线程以
+    UID STORE <区间> +FLAGS.SILENT (\\Seen) 批量提交：攒够BATCH_SIZE封或距上次提交
+    超过FLUSH_INTERVAL秒即提交一次，结束时提交剩余部分。提交失败的UID保留到下次重试，
+    因此中途崩溃时已提交的部分仍然有效。
+    
+    Attributes:
+        BATCH_SIZE (int): 触发立即提交的累计邮件数
+        FLUSH_INTERVAL (float): 定期提交的间隔(秒)
+    """
+
+    BATCH_SIZE = 500
+    FLUSH_INTERVAL = 5.0
+
+    def __init__(self, pool: IMAPConnectionPool, mailbox: str = "INBOX"):
+        """初始化并启动后台提交线程
+        
+        Args:
+            pool: IMAP连接池
+            mailbox: 邮件所在的文件夹
+        """
+        self.pool = pool
+        self.mailbox = mailbox
+        self.flagged = 0
+        self._pending = UIDSet()
+        self._lock = Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = Thread(target=self._flush_loop, name='seen-flag-updater', daemon=True)
+        self._thread.start()
+
+    def __enter__(self) -> 'SeenFlagUpdater':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def add(self, uid: int) -> None:
+        """加入一封已下载完成的邮件"""
+        with self._lock:
+            self._pending.add(uid)
+            if len(self._pending) >= self.BATCH_SIZE:
+                self._wakeup.set()
+
+    def flush(self) -> None:
+        """立即提交所有待标记的邮件"""
+        with self._lock:
+            uids, self._pending = self._pending, UIDSet()
+        if not uids:
+            return
+        try:
+            with self.pool.lease(self.mailbox) as conn:
+                with RunReport.phase('store'):
+                    status, data = conn.mail.uid('STORE', str(uids), '+FLAGS.SILENT', '(\\Seen)')
+            if status != 'OK':
+                raise imaplib.IMAP4.error(f"{status} {data}")
+            self.flagged += len(uids)
+        except Exception as e:
+            logger.error(f"标记邮件为已读失败: {e}")
+            with self._lock:
+                for lo, hi in uids.ranges():
+                    self._pending.add_range(lo, hi)
+
+    def close(self) -> None:
+        """停止后台线程并提交剩余部分"""
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        if len(self._pending):
+            logger.error(f"{len(self._pending)} 封邮件未能标记为已读")
+        logger.info(f"成功标记 {self.flagged} 封邮件为已读")
+
+    def _flush_loop(self) -> None:
+        while not self._closed:
+            self._wakeup.wait(self.FLUSH_INTERVAL)
+            self._wakeup.clear()
+            if not self._closed:
+                self.flush()
+
+
+@dataclass
+class PlannedMessage:
+    uid: int
+    size: int = 0
+    path: Optional[str] = None
+    valid_subject: Optional[str] = None
+    subject: str = ''
+    sender: str = ''
+    message_id: str = ''
+    content_type: str = ''
+
+
+class SearchFilter:
+    """邮件筛选规则
+    
+    规则写成一行，多个条件之间为"且"，同一字段出现多次为"或"：
+        since:2024-01-01 before:2024-07-01 from:boss@example.com from:hr@example.com
+        subject:发票 larger:100K smaller:20M has:attachment
+    
+    能用IMAP SEARCH表达的条件编译为 SINCE/BEFORE/FROM/SUBJECT/LARGER/SMALLER 及OR树，
+    由服务器完成筛选；服务器无法表达的条件(含非ASCII字符的发件人或主题——imaplib
+    只能发送ASCII命令；没有X-GM-EXT-1扩展时的"有附件")在下载计划阶段取回的邮件头上判断。
+    判断"有附件"时把 multipart/mixed 类型的邮件视为带附件。
+    """
+
+    _MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+    _SIZE_UNITS = {'': 1, 'B': 1, 'K': 1024, 'KB': 1024, 'M': 1024 ** 2, 'MB': 1024 ** 2, 'G': 1024 ** 3, 'GB': 1024 ** 3}
+
+    def __init__(self):
+        self.since: Optional[datetime] = None
+        self.before: Optional[datetime] = None
+        self.senders: List[str] = []
+        self.subjects: List[str] = []
+        self.min_size: Optional[int] = None
+        self.max_size: Optional[int] = None
+        self.has_attachment = False
+
+    def __bool__(self) -> bool:
+        return any((self.since, self.before, self.senders, self.subjects,
+                    self.min_size is not None, self.max_size is not None, self.has_attachment))
+
+    @staticmethod
+    def parse(text: Optional[str]) -> 'SearchFilter':
+        """解析筛选规则
+        
+        Args:
+            text: 筛选规则，空字符串表示不筛选
+            
+        Returns:
+            SearchFilter: 筛选规则对象
+            
+        Raises:
+            ValueError: 规则格式错误时抛出
+        """
+        search_filter = SearchFilter()
+        for term in shlex.split(text or ''):
+            key, sep, value = term.partition(':')
+            key = key.lower()
+            if not sep or not value:
+                raise ValueError(f"无法识别的筛选条件: {term}")
+            if key in ('since', 'before'):
+                try:
+                    setattr(search_filter, key, datetime.strptime(value, '%Y-%m-%d'))
+                except ValueError:
+                    raise ValueError(f"日期格式应为YYYY-MM-DD: {term}")
+            elif key == 'from':
+                search_filter.senders.append(value)
+            elif key == 'subject':
+                search_filter.subjects.append(value)
+            elif key in ('larger', 'smaller'):
+                match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([KMG]?B?)', value.upper())
+                if not match:
+                    raise ValueError(f"无法识别的大小: {term}")
+                size = int(float(match.group(1)) * SearchFilter._SIZE_UNITS[match.group(2)])
+                if key == 'larger':
+                    search_filter.min_size = size
+                else:
+                    search_filter.max_size = size
+            elif key == 'has' and value.lower() == 'attachment':
+                search_filter.has_attachment = True
+            else:
+                raise ValueError(f"无法识别的筛选条件: {term}")
+        return search_filter
+
+    def criteria(self, capabilities: Iterable[str] = ()) -> List[str]:
+        """编译为UID SEARCH的条件(与其他条件之间为"且")
+        
+        Args:
+            capabilities: 服务器的CAPABILITY
+            
+        Returns:
+            list: SEARCH条件，无服务器端条件时为空列表
+        """
+        criteria: List[str] = []
+        if self.since:
+            criteria += ['SINCE', self._imap_date(self.since)]
+        if self.before:
+            criteria += ['BEFORE', self._imap_date(self.before)]
+        if self.min_size is not None:
+            criteria += ['LARGER', str(max(self.min_size - 1, 0))]
+        if self.max_size is not None:
+            criteria += ['SMALLER', str(self.max_size + 1)]
+        for key, values in (('FROM', self.senders), ('SUBJECT', self.subjects)):
+            if values and all(value.isascii() for value in values):
+                criteria += self._or_tree(key, values)
+        if self.has_attachment and 'X-GM-EXT-1' in capabilities:
+            criteria += ['X-GM-RAW', Tools.quote_string('has:attachment')]
+        return criteria
+
+    def needs_headers(self, capabilities: Iterable[str] = ()) -> bool:
+        """是否有需要在客户端根据邮件头判断的条件"""
+        return (
+            any(not value.isascii() for value in self.senders + self.subjects)
+            or (self.has_attachment and 'X-GM-EXT-1' not in capabilities)
+        )
+
+    def accepts(self, message: Optional[PlannedMessage], capabilities: Iterable[str] = ()) -> bool:
+        """在客户端判断服务器无法表达的条件
+        
+        Args:
+            message: 下载计划中的邮件(含邮件头)，没有邮件头时视为符合
+            capabilities: 服务器的CAPABILITY
+        """
+        if message is None or message.path is None:
+            return True
+        if self.senders and not all(value.isascii() for value in self.senders):
+            if not any(value.lower() in message.sender.lower() for value in self.senders):
+                return False
+        if self.subjects and not all(value.isascii() for value in self.subjects):
+            if not any(value.lower() in message.subject.lower() for value in self.subjects):
+                return False
+        if self.has_attachment and 'X-GM-EXT-1' not in capabilities:
+            if message.content_type != 'multipart/mixed':
+                return False
+        return True
+
+    @staticmethod
+    def _or_tree(key: str, values: List[str]) -> List[str]:
+        """把同一字段的多个值编译为 OR key a OR key b key c"""
+        criteria: List[str] = []
+        for value in values[:-1]:
+            criteria += ['OR', key, Tools.quote_string(value)]
+        return criteria + [key, Tools.quote_string(values[-1])]
+
+    @staticmethod
+    def _imap_date(value: datetime) -> str:
+        # IMAP日期中的月份固定为英文缩写，不能使用受区域设置影响的strftime('%b')
+        return f"{value.day:02d}-{SearchFilter._MONTHS[value.month - 1]}-{value.year}"
+
+
+class DownloadPlan:
+    """下载计划
+    
+    正式下载前按PREFETCH_CHUNK个UID一组发送UID FETCH，取回目标邮件的RFC822.SIZE和少量邮件头
+    (SUBJECT DATE FROM MESSAGE-ID CONTENT-TYPE)，据此预先确定每封邮件的保存目录、
+    按大小排好下载顺序，并在任何正文传输前给出总字节数和预计耗时。
+    
+    计划只保存每个UID的大小(按UID排序的两个array('I'))和保存目录，
+    邮件头在规划时用完即丢弃，message()按需构造PlannedMessage；百万封邮件的计划
+    主要开销是目录字符串本身。某一组获取失败时只有这一组在下载时再确定目录。
+    
+    计划在下载期间通过activate()登记，_prepare_directory会优先使用计划中的目录，
+    这样无主题、日期无法解析等依赖当前时间的目录名在整个下载过程中保持一致。
+    
+    Attributes:
+        HEADER_FIELDS (str): 规划阶段获取的邮件头字段
+        PREFETCH_CHUNK (int): 每条UID FETCH规划的邮件数
+        DEFAULT_THROUGHPUT (int): 尚无实测速度时用于估算耗时的速度(字节/秒)
+    """
+
+    HEADER_FIELDS = 'SUBJECT DATE FROM MESSAGE-ID CONTENT-TYPE'
+    PREFETCH_CHUNK = 2000
+    DEFAULT_THROUGHPUT = 1024 * 1024
+    _MAX_SIZE = 0xFFFFFFFF
+
+    _active: Dict[Tuple[str, str], 'DownloadPlan'] = {}
+    _active_lock = Lock()
+
+    def __init__(self, email_address: str, mailbox: str = "INBOX"):
+        """初始化空的下载计划
+        
+        Args:
+            email_address: 邮箱地址
+            mailbox: 邮件所在的文件夹
+        """
+        self.email_address = email_address
+        self.mailbox = mailbox
+        self._uids = array.array('I')
+        self._sizes = array.array('I')
+        self._directories: Dict[int, Tuple[str, str]] = {}
+        self.rejected = UIDSet()
+        self.total_bytes = 0
+        self.done_bytes = 0
+        self.started = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._uids)
+
+    def add(self, uid: int, size: int = 0, directory: Optional[Tuple[str, str]] = None) -> None:
+        """加入一封邮件(按UID递增加入时直接追加)
+        
+        Args:
+            uid: 邮件UID
+            size: 邮件大小(RFC822.SIZE)
+            directory: (保存路径, 有效主题)，没有邮件头时为None
+        """
+        size = min(max(size, 0), DownloadPlan._MAX_SIZE)
+        i = self._index(uid)
+        if i is not None:
+            self.total_bytes -= self._sizes[i]
+            self._sizes[i] = size
+        elif not self._uids or uid > self._uids[-1]:
+            self._uids.append(uid)
+            self._sizes.append(size)
+        else:
+            i = bisect.bisect_left(self._uids, uid)
+            self._uids.insert(i, uid)
+            self._sizes.insert(i, size)
+        self.total_bytes += size
+        if directory is not None:
+            self._directories[uid] = directory
+
+    def _index(self, uid: int) -> Optional[int]:
+        i = bisect.bisect_left(self._uids, uid)
+        return i if i < len(self._uids) and self._uids[i] == uid else None
+
+    def ordered(self, email_ids: Iterable[Union[bytes, int]]) -> 'array.array':
+        """按邮件大小从大到小排列下载队列
+        
+        大邮件先开始，小邮件最后填满各个连接，避免下载末尾只剩一封大邮件在传输。
+        按大小级别(2的幂，相差不到一倍的为同一级)分桶，同一级内保持原有顺序，
+        不做逐封比较的排序；各桶和结果都是array('I')，每个UID只占4字节。
+        """
+        buckets = [array.array('I') for _ in range(DownloadPlan._MAX_SIZE.bit_length() + 1)]
+        for email_id in email_ids:
+            uid = int(email_id)
+            buckets[self.size(uid).bit_length()].append(uid)
+        ordered = array.array('I')
+        while buckets:
+            ordered.extend(buckets.pop())
+        return ordered
+
+    def size(self, email_id: Union[bytes, int]) -> int:
+        i = self._index(int(email_id))
+        return self._sizes[i] if i is not None else 0
+
+    def directory(self, email_id: Union[bytes, int]) -> Optional[Tuple[str, str]]:
+        """返回计划中的 (保存路径, 有效主题)，不在计划内时返回None"""
+        return self._directories.get(int(email_id))
+
+    def message(self, email_id: Union[bytes, int]) -> Optional[PlannedMessage]:
+        """按需构造计划条目(只含大小和保存目录，邮件头在规划时已丢弃)，不在计划内时返回None"""
+        uid = int(email_id)
+        i = self._index(uid)
+        if i is None:
+            return None
+        path, valid_subject = self._directories.get(uid, (None, None))
+        return PlannedMessage(uid, self._sizes[i], path, valid_subject)
+
+    def record(self, email_id: Union[bytes, int]) -> None:
+        """记录一封邮件已处理完毕，用于计算实际速度"""
+        self.done_bytes += self.size(email_id)
+
+    def throughput(self) -> float:
+        """实测下载速度(字节/秒)，尚无数据时返回DEFAULT_THROUGHPUT"""
+        elapsed = time.monotonic() - self.started
+        if self.done_bytes and elapsed > 0:
+            return self.done_bytes / elapsed
+        return self.DEFAULT_THROUGHPUT
+
+    def eta(self) -> float:
+        """按当前速度估算剩余耗时(秒)"""
+        return max(self.total_bytes - self.done_bytes, 0) / self.throughput()
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'messages': len(self._uids),
+            'total_bytes': self.total_bytes,
+            'eta': self.eta()
+        }
+
+    @contextmanager
+    def activate(self) -> Generator['DownloadPlan', None, None]:
+        """在下载期间登记本计划，供_prepare_directory查询"""
+        self.started = time.monotonic()
+        key = (self.email_address, self.mailbox)
+        with DownloadPlan._active_lock:
+            DownloadPlan._active[key] = self
+        try:
+            yield self
+        finally:
+            with DownloadPlan._active_lock:
+                if DownloadPlan._active.get(key) is self:
+                    del DownloadPlan._active[key]
+
+    @staticmethod
+    def lookup(email_address: str, email_id: bytes, mailbox: str = "INBOX") -> Optional[Tuple[str, str]]:
+        """查询当前登记的计划中某封邮件的保存目录"""
+        plan = DownloadPlan._active.get((email_address, mailbox))
+        return plan.directory(email_id) if plan else None
+
+    @staticmethod
+    def prefetch(
+        mail: imaplib.IMAP4_SSL,
+        email_ids: Union[UIDSet, List[bytes]],
+        email_address: str,
+        mailbox: str = "INBOX",
+        accept: Optional[Callable[[PlannedMessage], bool]] = None
+    ) -> 'DownloadPlan':
+        """分组获取邮件的大小和邮件头并生成下载计划
+        
+        Args:
+            mail: 已选中文件夹的IMAP连接
+            email_ids: 邮件UID集合
+            email_address: 邮箱地址
+            mailbox: 邮件所在的文件夹
+            accept: 在邮件头上判断是否下载(如SearchFilter.accepts)，不符合的UID
+                记入plan.rejected且不进入计划；为None时不筛选
+            
+        Returns:
+            DownloadPlan: 下载计划，获取失败的组不在计划内(按数量分批、下载时再确定目录)
+            
+        Note:
+            连接断开时抛出异常，由调用方按连接失败处理
+        """
+        plan = DownloadPlan(email_address, mailbox=mailbox)
+        uids = email_ids if isinstance(email_ids, UIDSet) else UIDSet(email_ids)
+        for chunk in uids.chunks(DownloadPlan.PREFETCH_CHUNK):
+            try:
+                with RunReport.phase('prefetch') as sample:
+                    status, data = mail.uid(
+                        'FETCH', Tools.compress_uids(chunk),
+                        f'(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS ({DownloadPlan.HEADER_FIELDS})])'
+                    )
+                    sample['bytes'] = Tools.response_size(data)
+                if status != 'OK':
+                    raise Exception(f"获取邮件头失败: {status}")
+            except (imaplib.IMAP4.abort, ConnectionError):
+                raise
+            except Exception as e:
+                logger.warning(f"获取 {len(chunk)} 封邮件的邮件头失败，下载时再确定保存目录: {e}")
+                continue
+            plan._add_chunk(data, accept)
+        return plan
+
+    def _add_chunk(self, data: List[Any], accept: Optional[Callable[[PlannedMessage], bool]]) -> None:
+        """解析一组FETCH响应并加入计划(按UID排序后追加)"""
+        parser = BytesParser()
+        entries = []
+        for _, fields in Tools.parse_fetch_response(data):
+            uid = fields.get('UID')
+            if isinstance(uid, int):
+                entries.append((uid, fields))
+        entries.sort(key=lambda entry: entry[0])
+        for uid, fields in entries:
+            size = fields.get('RFC822.SIZE')
+            message = PlannedMessage(uid, size if isinstance(size, int) else 0)
+            header = next((value for key, value in fields.items() if key.startswith('BODY[HEADER')), None)
+            if header is not None:
+                try:
+                    headers = parser.parsebytes(Tools.literal_bytes(header), headersonly=True)
+                    message.path, message.valid_subject = EmailDownload._plan_directory(
+                        str(uid).encode(), headers, self.email_address, self.mailbox
+                    )
+                    if accept:
+                        message.subject = Tools.decode_header_value(headers.get('SUBJECT'))
+                        message.sender = Tools.decode_header_value(headers.get('FROM'))
+                        message.message_id = str(headers.get('MESSAGE-ID', '')).strip()
+                        message.content_type = headers.get_content_type() if headers.get('CONTENT-TYPE') else ''
+                except Exception as e:
+                    logger.warning(f"解析邮件 {uid} 的邮件头失败: {e}")
+            if accept and not accept(message):
+                self.rejected.add(uid)
+                continue
+            directory = (message.path, message.valid_subject) if message.path is not None else None
+            self.add(uid, message.size, directory)
+
+
+class ProgressTracker:
+    """一个文件夹的下载进度计数
+    
+    下载线程调用record()只写本线程独占的计数分片，不加锁也不发送信号；
+    ProgressPublisher定期调用counts()汇总后统一发送。
+    """
+
+    def __init__(self, total: int = 0, total_bytes: int = 0, skipped: int = 0):
+        """初始化
+        
+        Args:
+            total: 邮件总数(含断点续传跳过的)
+            total_bytes: 本次需要下载的字节数
+            skipped: 断点续传跳过的已下载邮件数，计入已下载但不计入速度
+        """
+        self.total = total
+        self.total_bytes = total_bytes
+        self.skipped = skipped
+        self._shards = _ThreadShards(lambda: [0, 0, 0])
+
+    def record(self, success: bool, nbytes: int = 0) -> None:
+        """记录一封邮件处理完毕
+        
+        Args:
+            success: 是否成功下载
+            nbytes: 邮件大小(字节)
+        """
+        shard = self._shards.local()
+        shard[0 if success else 1] += 1
+        shard[2] += nbytes
+
+    def counts(self) -> Tuple[int, int, int]:
+        """返回 (成功数, 失败数, 已处理字节数)，成功数不含断点续传跳过的邮件"""
+        success = failed = nbytes = 0
+        for shard in self._shards.all():
+            success += shard[0]
+            failed += shard[1]
+            nbytes += shard[2]
+        return success, failed, nbytes
+
+class ProgressPublisher:
+    """以固定频率发送下载进度
+    
+    各文件夹的ProgressTracker登记到同一个发布器，后台线程每INTERVAL秒汇总一次，
+    计算近几秒的下载速度和剩余时间，有变化时才通过ProgressSignal发送progress和stats_updated，
+    结束时再发送一次最终结果。下载线程本身不发送任何信号，邮件再多界面线程也只收到固定频率的更新。
+    
+    多文件夹、多账号共用上层的发布器(download_folder收到发布器时直接登记，
+    收到普通的ProgressSignal时自己创建一个)，界面上只看到一个总进度。
+    
+    Attributes:
+        INTERVAL (float): 发送间隔(秒)
+        RATE_WINDOW (float): 计算速度使用的时间窗口(秒)
+    """
+
+    INTERVAL = 0.1
+    RATE_WINDOW = 5.0
+
+    def __init__(self, progress_signal: ProgressSignal, interval: Optional[float] = None):
+        """初始化
+        
+        Args:
+            progress_signal: 进度信号对象
+            interval: 发送间隔(秒)，默认为INTERVAL
+        """
+        self.progress_signal = progress_signal
+        self.error_occurred = progress_signal.error_occurred
+        self.interval = interval or self.INTERVAL
+        self._trackers: List[ProgressTracker] = []
+        self._plans: Dict[str, Dict[str, Any]] = {}
+        self._lock = Lock()
+        self._samples: collections.deque = collections.deque()
+        self._last: Optional[Dict[str, Any]] = None
+        self._stop = threading.Event()
+        self._thread: Optional[Thread] = None
+
+    def __enter__(self) -> 'ProgressPublisher':
+        self._stop.clear()
+        self._thread = Thread(target=self._run, name='progress', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.publish()
+
+    def track(self, tracker: ProgressTracker) -> ProgressTracker:
+        """登记一个文件夹的进度计数"""
+        with self._lock:
+            self._trackers.append(tracker)
+        return tracker
+
+    def plan_ready(self, key: str, summary: Dict[str, Any]) -> None:
+        """登记一个文件夹的下载计划并发送合计的计划(每个文件夹只有一次)"""
+        with self._lock:
+            self._plans[key] = summary
+            combined = {
+                'messages': sum(p['messages'] for p in self._plans.values()),
+                'total_bytes': sum(p['total_bytes'] for p in self._plans.values()),
+                'eta': max(p['eta'] for p in self._plans.values()),
+                'folders': len(self._plans)
+            }
+        self.progress_signal.plan_ready.emit(combined)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """汇总所有文件夹的当前进度"""
+        with self._lock:
+            trackers = list(self._trackers)
+        total = downloaded = failed = skipped = total_bytes = done_bytes = 0
+        for tracker in trackers:
+            success, failures, nbytes = tracker.counts()
+            total += tracker.total
+            downloaded += success + tracker.skipped
+            failed += failures
+            skipped += tracker.skipped
+            total_bytes += tracker.total_bytes
+            done_bytes += nbytes
+
+        now = time.monotonic()
+        self._samples.append((now, done_bytes))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self.RATE_WINDOW:
+            self._samples.popleft()
+        first_time, first_bytes = self._samples[0]
+        throughput = (done_bytes - first_bytes) / (now - first_time) if now > first_time else 0.0
+        remaining = max(total_bytes - done_bytes, 0)
+        return {
+            'total': total,
+            'downloaded': downloaded,
+            'failed': failed,
+            'resume': skipped,
+            'total_bytes': total_bytes,
+            'downloaded_bytes': done_bytes,
+            'throughput': throughput,
+            'eta': remaining / throughput if throughput > 0 else None,
+            'folders': len(trackers)
+        }
+
+    def publish(self) -> None:
+        """立即发送当前进度(与上次相同时不发送)"""
+        stats = self.snapshot()
+        key = (stats['total'], stats['downloaded'], stats['failed'], stats['downloaded_bytes'])
+        if self._last == key:
+            return
+        self._last = key
+        done = stats['downloaded'] + stats['failed']
+        self.progress_signal.progress.emit(int(done / stats['total'] * 100) if stats['total'] else 0)
+        self.progress_signal.stats_updated.emit(stats)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.publish()
+            except Exception as e:
+                logger.warning(f"发送下载进度失败: {e}")
+
+
+class EmailDownload:
+    """邮件下载核心类
+    
+    Attributes:
+        MAX_RETRIES (int): 最大重试次数
+        RETRY_DELAY (int): 重试延迟(秒)
+        MAX_WORKERS (int): 初始并发连接数
+        MAX_CONNECTIONS (int): 未在imap_servers.json中配置时的最大并发连接数
+        CHUNK_SIZE (int): 文件分块大小(字节)
+        FETCH_BATCH_SIZE (int): 每条UID FETCH命令最多获取的邮件数
+        FETCH_BATCH_BYTES (int): 每条UID FETCH命令最多获取的累计字节数
+        ENGINE (str): 下载引擎，'thread'(线程池)或'asyncio'(单事件循环多路复用)
+        SUBSCRIBED_ONLY (bool): 是否只在已订阅的文件夹(LSUB)中查找
+        SSL_CONTEXT (ssl.SSLContext): 建立SSL连接使用的上下文，None时使用系统默认证书
+    """
+    
+    MAX_RETRIES = 3
+    RETRY_DELAY = 2
+    MAX_WORKERS = 4
+    MAX_CONNECTIONS = 8
+    CHUNK_SIZE = 1024 * 1024  # 1MB
+    FETCH_BATCH_SIZE = 50
+    FETCH_BATCH_BYTES = 32 * 1024 * 1024  # 32MB
+    ENGINE = 'thread'
+    SUBSCRIBED_ONLY = False
+    SSL_CONTEXT: Optional[ssl.SSLContext] = None
+    
+    @staticmethod
+    @contextmanager
+    def imap_connection(email_address: str, password: str) -> Generator[imaplib.IMAP4_SSL, None, None]:
+        """IMAP连接上下文管理器
+        
+        Args:
+            email_address: 邮箱地址
+            password: 邮箱密码
+            
+        Yields:
+            IMAP4_SSL: IMAP连接对象
+            
+        Raises:
+            Exception: 连接或登录失败时抛出异常
+        """
+        mail = None
+        try:
+            mail = EmailDownload._open_connection(email_address, password)
+            yield mail
+        except Exception as e:
+            logger.error(f"IMAP连接错误: {e}")
+            raise
+        finally:
+            if mail:
+                try:
+                    mail.close()
+                    mail.logout()
+                except Exception as e:
+                    logger.warning(f"关闭IMAP连接时出错: {e}")
+
+    @staticmethod
+    def _open_connection(email_address: str, password: str) -> imaplib.IMAP4_SSL:
+        """建立并登录一个新的IMAP连接
+        
+        Args:
+            email_address: 邮箱地址
+            password: 邮箱密码
+            
+        Returns:
+            IMAP4_SSL: 已登录的IMAP连接对象
+        """
+        domain = email_address.split("@")[1]
+        host, port, use_ssl = EmailDownload.server_address(EmailDownload.get_imap_server(domain))
+        with RunReport.phase('connect'):
+            mail = (SpoolingIMAP4_SSL if use_ssl else SpoolingIMAP4)(host, port, timeout=30)
+        try:
+            with RunReport.phase('login'):
+                mail.login(email_address, password)
+        except Exception:
+            mail.shutdown()
+            raise
+        return mail
+
+    @staticmethod
+    def get_server_limits(server: str) -> Tuple[int, int]:
+        """获取IMAP服务器允许的并发连接数范围
+        
+        Args:
+            server: IMAP服务器地址(如imap.qq.com)
+            
+        Returns:
+            (最少连接数, 最多连接数)
+            
+        Note:
+            读取imap_servers.json中的limits配置，未配置时为 (1, MAX_CONNECTIONS)
+        """
+        try:
+            with open('imap_servers.json', 'r') as f:
+                limits = json.load(f).get('limits', {}).get(server, {})
+        except Exception as e:
+            logger.warning(f"读取IMAP服务器并发配置失败，使用默认值: {e}")
+            limits = {}
+        return (
+            int(limits.get('min_connections', 1)),
+            int(limits.get('max_connections', EmailDownload.MAX_CONNECTIONS))
+        )
+
+    @staticmethod
+    def server_address(server: str) -> Tuple[str, int, bool]:
+        """解析imap_servers.json中的服务器地址
+        
+        Args:
+            server: "imap.qq.com"、"host:port"、"imaps://host:port" 或 "imap://host:port"(不加密)
+            
+        Returns:
+            (主机, 端口, 是否使用SSL)
+        """
+        use_ssl = not server.startswith('imap://')
+        host = server.split('://', 1)[-1]
+        host, _, port = host.rpartition(':') if ':' in host else (host, '', '')
+        default_port = imaplib.IMAP4_SSL_PORT if use_ssl else imaplib.IMAP4_PORT
+        return host, int(port) if port else default_port, use_ssl
+
+    @staticmethod
+    def get_imap_server(domain: str) -> str:
+        """获取IMAP服务器地址
+        
+        Args:
+            domain: 邮箱域名(如qq.com)
+            
+        Returns:
+            IMAP服务器地址
+            
+        Note:
+            优先从imap_servers.json读取配置，失败则使用内置默认值；
+            地址可以带端口和协议(见server_address)，用于连接本地的测试服务器
+        """
+        try:
+            with open('imap_servers.json', 'r') as f:
+                config = json.load(f)
+                return config['servers'].get(domain, f"imap.{domain}")
+        except Exception as e:
+            logger.warning(f"读取IMAP服务器配置失败，使用默认值: {e}")
+            default_servers = {
+                "qq.com": "imap.qq.com",
+                "gmail.com": "imap.gmail.com", 
+                "163.com": "imap.163.com",
+                "outlook.com": "imap-mail.outlook.com"
+            }
+            return default_servers.get(domain, f"imap.{domain}")
+
+    @staticmethod
+    def parse_folder_patterns(text: str) -> Tuple[List[str], List[str]]:
+        """解析文件夹筛选模式
+        
+        Args:
+            text: 逗号分隔的通配符模式，以!开头的为排除模式，如 "INBOX, 工作/*, !垃圾邮件"
+            
+        Returns:
+            (包含模式列表, 排除模式列表)，未给出包含模式时只包含INBOX
+        """
+        include, exclude = [], []
+        for pattern in re.split(r'[,，]', text or ''):
+            pattern = pattern.strip()
+            if pattern.startswith('!'):
+                exclude.append(pattern[1:].strip())
+            elif pattern:
+                include.append(pattern)
+        return include or ['INBOX'], [pattern for pattern in exclude if pattern]
+
+    @staticmethod
+    def list_folders(mail: imaplib.IMAP4_SSL, include: List[str], exclude: List[str]) -> List[str]:
+        """用LIST(或LSUB)列出服务器上的文件夹并按模式筛选
+        
+        Args:
+            mail: 已登录的IMAP连接
+            include: 包含模式(匹配原始名称或解码后的名称，不区分大小写)
+            exclude: 排除模式
+            
+        Returns:
+            list: 可选中的文件夹原始名称，按服务器返回的顺序
+        """
+        status, data = mail.lsub() if EmailDownload.SUBSCRIBED_ONLY else mail.list()
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"获取文件夹列表失败: {data}")
+
+        def matches(name: str, patterns: List[str]) -> bool:
+            names = {name.lower(), Tools.decode_folder_name(name).lower()}
+            return any(fnmatch.fnmatchcase(n, pattern.lower()) for n in names for pattern in patterns)
+
+        folders = []
+        for item in data:
+            if isinstance(item, tuple):
+                # 名称以字面量形式返回
+                line, name = item[0], item[1].decode('utf-8', 'replace')
+            elif isinstance(item, bytes):
+                line, name = item, None
+            else:
+                continue
+            match = re.match(rb'\((?P<flags>[^)]*)\) (?:NIL|"(?:[^"\\]|\\.)*") ?(?P<name>.*)', line)
+            if not match:
+                continue
+            if re.search(rb'\\(Noselect|NonExistent)\b', match.group('flags'), re.IGNORECASE):
+                continue
+            if name is None:
+                name = match.group('name').decode('utf-8', 'replace').strip()
+                if name.startswith('"') and name.endswith('"'):
+                    name = re.sub(r'\\(.)', r'\1', name[1:-1])
+            if matches(name, include) and not matches(name, exclude):
+                folders.append(name)
+        return folders
+
+    @staticmethod
+    def folder_directory(email_address: str, mailbox: str = "INBOX") -> Path:
+        """文件夹的下载目录
+        
+        INBOX保持原来的 downloads/<邮箱>/，其余文件夹保存在其下以文件夹名称(解码后)命名的子目录中，
+        层级分隔符"/"对应子目录。
+        """
+        directory = Path(f'./downloads/{email_address}')
+        if mailbox.upper() == 'INBOX':
+            return directory
+        for component in Tools.decode_folder_name(mailbox).split('/'):
+            component = re.sub(r'[\\:*?"<>|]', '', component).strip()
+            if component and component not in ('.', '..'):
+                directory /= component
+        return directory
+
+    @staticmethod
+    def download_emails(
+        email_address: str, 
+        password: str, 
+        options: DownloadOptions,
+        progress_signal: Union[ProgressSignal, ProgressPublisher],
+        engine: Optional[str] = None,
+        budget: Optional[ConnectionBudget] = None,
+        folders: Optional[str] = None,
+        filters: Optional[str] = None
+    ) -> Optional[DownloadStats]:
+        """下载选项中选定的所有文件夹中的邮件
+        
+        文件夹由LIST(SUBSCRIBED_ONLY时为LSUB)列出后按包含/排除模式筛选，
+        多个文件夹通过同一个连接池并发下载，各自保存断点续传状态和输出子目录。
+        
+        Args:
+            email_address: 邮箱地址
+            password: 邮箱密码
+            options: 下载选项
+            progress_signal: 进度信号对象，或上层共用的进度发布器
+            engine: 下载引擎，默认为ENGINE
+            budget: 多账号共享的连接预算
+            folders: 文件夹筛选模式，为None时使用options中的设置
+            filters: 邮件筛选规则(见SearchFilter)，为None时使用options中的设置
+            
+        Returns:
+            DownloadStats: 所有文件夹合计的下载统计信息
+            
+        Note:
+            各阶段耗时汇总为运行报告(见RunReport)，结束时写入 downloads/reports/
+        """
+        with RunReport.session(), EmailDownload._publisher(progress_signal) as publisher:
+            include, exclude = EmailDownload.parse_folder_patterns(
+                options.folders if folders is None else folders
+            )
+            try:
+                search_filter = SearchFilter.parse(options.search_filter if filters is None else filters)
+                server = EmailDownload.get_imap_server(email_address.split("@")[1])
+                _, max_connections = EmailDownload.get_server_limits(server)
+                with IMAPConnectionPool(email_address, password, max_connections, budget=budget) as pool:
+                    if include == ['INBOX'] and not exclude:
+                        folders = ['INBOX']
+                    else:
+                        with pool.lease(None) as conn:
+                            folders = EmailDownload.list_folders(conn.mail, include, exclude)
+                    if not folders:
+                        options.status('没有匹配的文件夹')
+                        return None
+                    if len(folders) == 1:
+                        stats = EmailDownload.download_folder(
+                            email_address, password, options, publisher, folders[0], engine, pool,
+                            search_filter=search_filter
+                        )
+                        RunReport.add_stats(stats)
+                        return stats
+
+                    logger.info(f"同步 {len(folders)} 个文件夹: {', '.join(Tools.decode_folder_name(f) for f in folders)}")
+                    totals = DownloadStats()
+                    with ThreadPoolExecutor(max_workers=min(len(folders), max_connections)) as executor:
+                        futures = {
+                            executor.submit(
+                                EmailDownload.download_folder,
+                                email_address, password, options, publisher, mailbox, engine, pool,
+                                search_filter=search_filter
+                            ): mailbox for mailbox in folders
+                        }
+                        for future in as_completed(futures):
+                            try:
+                                stats = future.result()
+                            except Exception as e:
+                                logger.error(f"同步文件夹 {Tools.decode_folder_name(futures[future])} 失败: {e}")
+                                continue
+                            totals.add(stats)
+                    options.status('下载完成!')
+                    logger.info(f"{len(folders)} 个文件夹同步完成: 成功 {totals.success} 封，失败 {totals.failed} 封")
+                    RunReport.add_stats(totals)
+                    return totals
+            except Exception as e:
+                logger.error(f"下载邮件失败: {e}")
+                options.status('错误')
+                return None
+
+    @staticmethod
+    def _publisher(progress_signal: Union[ProgressSignal, ProgressPublisher]) -> Any:
+        """上层已传入进度发布器时直接共用，否则为本次下载新建一个"""
+        if isinstance(progress_signal, ProgressPublisher):
+            return nullcontext(progress_signal)
+        return ProgressPublisher(progress_signal)
+
+    @staticmethod
+    def download_folder(
+        email_address: str, 
+        password: str, 
+        options: DownloadOptions,
+        progress_signal: Union[ProgressSignal, ProgressPublisher],
+        mailbox: str = "INBOX",
+        engine: Optional[str] = None,
+        pool: Optional[IMAPConnectionPool] = None,
+        incremental: Optional[bool] = None,
+        search_filter: Optional[SearchFilter] = None
+    ) -> Optional[DownloadStats]:
+        """下载一个文件夹中的未读邮件(增量同步时为新邮件)
+        
+        Args:
+            email_address: 邮箱地址
+            password: 邮箱密码
+            options: 下载选项
+            progress_signal: 进度信号对象，或上层共用的进度发布器
+            mailbox: 文件夹名称(服务器上的原始名称)
+            engine: 下载引擎，默认为ENGINE
+            pool: 复用的IMAP连接池(多文件夹同步或监视模式下共用)，为None时新建
+            incremental: 是否增量同步，为None时按options中的设置
+            search_filter: 邮件筛选规则，为None时使用options中的设置
+            
+        Returns:
+            DownloadStats: 下载统计信息
+        """
+        try:
+            if search_filter is None:
+                search_filter = SearchFilter.parse(options.search_filter)
+            server = EmailDownload.get_imap_server(email_address.split("@")[1])
+            min_connections, max_connections = EmailDownload.get_server_limits(server)
+            with EmailDownload._publisher(progress_signal) as publisher, \
+                    (nullcontext(pool) if pool else IMAPConnectionPool(email_address, password, max_connections)) as pool, \
+                    EmailDownload._check_resume_data(email_address, mailbox) as journal, \
+                    (SeenFlagUpdater(pool, mailbox) if options.seen_after_download else nullcontext()) as seen_updater:
+                if incremental is None:
+                    incremental = options.incremental
+                sync_state = SyncState(EmailDownload.folder_directory(email_address, mailbox)) if incremental else None
+                with pool.lease(mailbox) as conn:
+                    journal.set_uidvalidity(conn.uidvalidity)
+                    capabilities = conn.mail.capabilities
+                    filter_criteria = search_filter.criteria(capabilities)
+                    if incremental:
+                        status, email_list, sync_status = EmailDownload._incremental_search(
+                            conn, sync_state, journal, filter_criteria
+                        )
+                    else:
+                        status, email_list = EmailDownload._uid_search(conn.mail, 'UNSEEN', *filter_criteria)
+                if status != 'OK' or not email_list:
+                    if incremental and status == 'OK':
+                        sync_state.update(mailbox, sync_status)
+                    options.status('没有新邮件' if incremental else '没有未读邮件')
+                    return DownloadStats()
+
+                # 检查是否有上次未完成的下载
+                stats = DownloadStats(total=len(email_list))
+                if options.resume and journal.completed:
+                    # 上次失败的邮件会重新下载，不计入失败数
+                    remaining = email_list.copy()
+                    remaining.difference_update(journal.completed)
+                    if seen_updater:
+                        # 上次已下载但未来得及标记的邮件
+                        done = email_list.copy()
+                        done.difference_update(remaining)
+                        for uid in done:
+                            seen_updater.add(uid)
+                    stats = DownloadStats(
+                        total=len(email_list),
+                        success=len(email_list) - len(remaining)
+                    )
+                    email_list = remaining
+                
+                def update_progress(success: bool = True, email_id: Optional[bytes] = None):
+                    """更新进度和统计信息(在下载线程中调用，不加锁也不发送信号)
+                    
+                    Args:
+                        success: 是否成功下载
+                        email_id: 邮件ID(用于断点续传)
+                    """
+                    if email_id:
+                        EmailDownload._update_resume_data(journal, email_id, success)
+                        if success and seen_updater:
+                            seen_updater.add(int(email_id))
+                    Metrics.inc('messages_downloaded_total' if success else 'messages_failed_total')
+                    tracker.record(success, plan.size(email_id) if email_id else 0)
+
+                # 先只取邮件大小和邮件头，确定保存目录、下载顺序和预计耗时
+                # 服务器无法表达的筛选条件在规划时的邮件头上判断
+                needs_headers = search_filter.needs_headers(capabilities)
+                with pool.lease(mailbox) as conn:
+                    plan = DownloadPlan.prefetch(
+                        conn.mail, email_list, email_address, mailbox,
+                        (lambda message: search_filter.accepts(message, capabilities)) if needs_headers else None
+                    )
+                if needs_headers:
+                    rejected = len(plan.rejected)
+                    logger.info(f"按邮件头筛选: {len(email_list)} 封中 {len(email_list) - rejected} 封符合条件")
+                    stats.total -= rejected
+                    email_list.difference_update(plan.rejected)
+                Metrics.inc('messages_total', stats.total)
+                Metrics.inc('messages_skipped_total', stats.success)
+                tracker = publisher.track(ProgressTracker(stats.total, plan.total_bytes, stats.success))
+                email_list = plan.ordered(email_list)
+                summary = plan.summary()
+                publisher.plan_ready(f"{email_address}/{mailbox}", summary)
+                options.status(
+                    f"共 {len(email_list)} 封 {Tools.format_size(summary['total_bytes'])}，"
+                    f"预计 {Tools.format_duration(summary['eta'])}"
+                )
+                logger.info(
+                    f"下载计划: {len(email_list)} 封邮件，共 {Tools.format_size(summary['total_bytes'])}，"
+                    f"预计耗时 {Tools.format_duration(summary['eta'])}"
+                )
+
+                # 按数量和大小分批，每批一条UID FETCH命令，使用线程池并行下载
+                batches = EmailDownload._plan_batches(email_list, plan.size)
+                selective = options.selective_fetch
+                controller = ConcurrencyController(
+                    min_connections, max_connections, EmailDownload.MAX_WORKERS, on_change=pool.trim
+                )
+                with plan.activate():
+                    if (engine or EmailDownload.ENGINE) == 'asyncio':
+                        if selective:
+                            logger.info("asyncio引擎不支持按需获取邮件内容，将下载完整邮件")
+                        engine_connections = min(AsyncDownloadEngine.CONNECTIONS, max_connections)
+                        AsyncDownloadEngine(
+                            email_address, password, engine_connections, mailbox=mailbox,
+                            pool=pool, controller=controller
+                        ).run(batches, options, update_progress)
+                    else:
+
+                        def collect(done: Set[Any]) -> None:
+                            for future in done:
+                                Metrics.inc('queue_depth', -1)
+                                batch = running.pop(future)
+                                try:
+                                    future.result()
+                                except Exception as e:
+                                    # download_batch自己把未处理的邮件记为失败，不因下载或保存出错而抛出异常；
+                                    # 到这里的是进度回调本身出错等意外情况，整批记为失败以便断点续传日志记下这些UID
+                                    logger.error(f"批量下载 {len(batch)} 封邮件失败: {e}")
+                                    for email_id in batch:
+                                        update_progress(False, email_id)
+
+                        # 批次按需生成，同时提交的任务数有上限，不会一次展开全部UID；
+                        # 网络线程只负责获取，解析和保存由流水线中的线程完成
+                        with SavePipeline(email_address, options, update_progress, mailbox) as pipeline, \
+                                ThreadPoolExecutor(max_workers=max_connections) as executor:
+                            running: Dict[Any, List[bytes]] = {}
+                            for batch in batches:
+                                if len(running) >= max_connections * 2:
+                                    collect(wait(running, return_when=FIRST_COMPLETED).done)
+                                Metrics.inc('queue_depth')
+                                running[executor.submit(
+                                    EmailDownload.download_batch, batch, email_address, options, pool,
+                                    update_progress, selective, controller, mailbox, pipeline
+                                )] = batch
+                            collect(wait(running).done)
+
+                success, failed, _ = tracker.counts()
+                stats.success += success
+                stats.failed += failed
+                if incremental:
+                    # 记录的是本次开始时的状态，下载期间到达的邮件留给下次同步
+                    sync_state.update(mailbox, sync_status)
+
+                options.status('下载完成!')
+                logger.info(f"{Tools.decode_folder_name(mailbox)}: 成功下载 {len(email_list)} 封邮件")
+                return stats
+
+        except Exception as e:
+            logger.error(f"下载文件夹 {Tools.decode_folder_name(mailbox)} 失败: {e}")
+            options.status('错误')
+            return None
+    
+    @staticmethod
+    def _incremental_search(
+        conn: PooledConnection,
+        sync_state: SyncState,
+        journal: 'ResumeJournal',
+        filter_criteria: Optional[List[str]] = None
+    ) -> Tuple[str, UIDSet, Dict[str, int]]:
+        """增量同步：只查找上次同步后新到达的邮件和上次失败的邮件
+        
+        Args:
+            conn: 已选中文件夹的池化连接
+            sync_state: 增量同步状态
+            journal: 断点续传日志(提供上次失败的UID)
+            filter_criteria: 附加的SEARCH筛选条件
+            
+        Returns:
+            (状态, UID集合, 本次STATUS得到的文件夹状态)
+        """
+        current = SyncState.query(conn.mail, conn.selected)
+        previous = sync_state.get(conn.selected)
+        if not SyncState.has_new_messages(previous, current) and not journal.failed:
+            if previous.get('HIGHESTMODSEQ') == current.get('HIGHESTMODSEQ'):
+                logger.info(f"{conn.selected} 自上次同步以来没有变化")
+            else:
+                logger.info(f"{conn.selected} 没有新邮件，仅已有邮件的标志或删除有变化")
+            return 'OK', UIDSet(), current
+
+        criteria = SyncState.search_criteria(previous, current, journal.failed)
+        status, uids = EmailDownload._uid_search(conn.mail, *criteria, *(filter_criteria or []))
+        if status == 'OK' and criteria != ('ALL',) and uids:
+            # 没有新邮件时 UID n:* 仍会返回最大的UID，需要过滤
+            stale = UIDSet()
+            stale.add_range(1, previous['UIDNEXT'] - 1)
+            stale.difference_update(journal.failed)
+            uids.difference_update(stale)
+        return status, uids, current
+
+    @staticmethod
+    @RunReport.timed('search')
+    def _uid_search(mail: imaplib.IMAP4_SSL, *criteria: str) -> Tuple[str, UIDSet]:
+        """执行UID SEARCH，结果直接保存为UID区间
+        
+        服务器支持ESEARCH(RFC 4731)时使用 SEARCH RETURN (MIN MAX COUNT ALL)，
+        结果是形如 "1:50000,50002:99999" 的序列集合，大邮箱也只有几十个字节；
+        否则逐个扫描普通SEARCH响应中的UID合并为区间。
+        
+        Args:
+            mail: 已选中文件夹的IMAP连接
+            criteria: 搜索条件
+            
+        Returns:
+            (状态, UID集合)
+        """
+        if 'ESEARCH' in mail.capabilities:
+            status, _ = mail.uid('SEARCH', 'RETURN', '(MIN MAX COUNT ALL)', *criteria)
+            # imaplib只取出SEARCH类型的应答，ESEARCH应答留在untagged_responses中
+            responses = mail.untagged_responses.pop('ESEARCH', [])
+            uids = UIDSet()
+            for response in responses:
+                if not isinstance(response, bytes):
+                    continue
+                match = re.search(rb'\bALL\s+([\d:,]+)', response)
+                if match:
+                    uids = UIDSet.parse(match.group(1))
+                count = re.search(rb'\bCOUNT\s+(\d+)', response)
+                if count and int(count.group(1)) != len(uids):
+                    logger.warning(f"ESEARCH结果数量不一致: COUNT {int(count.group(1))}，实际 {len(uids)}")
+            return status, uids
+        status, data = mail.uid('SEARCH', None, *criteria)
+        return status, UIDSet.from_search(data or []) if status == 'OK' else UIDSet()
+
+    @staticmethod
+    def download_email(
+        email_id: bytes, 
+        email_address: str, 
+        password: str, 
+        options: DownloadOptions, 
+        progress_callback: Optional[Callable[[bool], None]] = None,
+        pool: Optional[IMAPConnectionPool] = None,
+        mailbox: str = "INBOX"
+    ) -> int:
+        """下载单个邮件
+        
+        Args:
+            email_id: 邮件ID
+            email_address: 邮箱地址
+            password: 邮箱密码
+            options: 下载选项
+            progress_callback: 进度回调函数
+            pool: IMAP连接池，为None时为本邮件单独建立连接
+            mailbox: 邮件所在的文件夹
+            
+        Returns:
+            int: 保存的附件数量
+            
+        Raises:
+            Exception: 下载失败时抛出异常
+        """
+        msg_content = None
+        
+        for attempt in range(EmailDownload.MAX_RETRIES):
+            try:
+                if pool is not None:
+                    with pool.lease(mailbox) as conn, RunReport.phase('fetch') as sample:
+                        status, msg_data = conn.mail.uid('FETCH', email_id, '(RFC822)')
+                        sample['bytes'] = Tools.response_size(msg_data)
+                else:
+                    with EmailDownload.imap_connection(email_address, password) as mail:
+                        with RunReport.phase('select'):
+                            mail.select(Tools.quote_mailbox(mailbox))
+                        with RunReport.phase('fetch') as sample:
+                            status, msg_data = mail.uid('FETCH', email_id, '(RFC822)')
+                            sample['bytes'] = Tools.response_size(msg_data)
+                if status != 'OK' or not msg_data or not msg_data[0]:
+                    raise Exception(f"获取邮件失败: {status}")
+                
+                # 确保msg_data是预期格式
+                if isinstance(msg_data[0], tuple) and len(msg_data[0]) >= 2:
+                    msg_content = msg_data[0][1]
+                    # 超过SPOOL_THRESHOLD的邮件原文是暂存文件
+                    if not isinstance(msg_content, (bytes, str)) and not hasattr(msg_content, 'read'):
+                        raise Exception("无效的邮件内容格式")
+                else:
+                    raise Exception("无效的邮件数据结构")
+                break
+            except (imaplib.IMAP4.abort, ConnectionError) as e:
+                if attempt < EmailDownload.MAX_RETRIES - 1:
+                    Metrics.inc('retries_total')
+                    time.sleep(EmailDownload.RETRY_DELAY)
+                    continue
+                logger.error(f"下载邮件失败(尝试 {EmailDownload.MAX_RETRIES} 次): {e}")
+                if progress_callback:
+                    progress_callback(False)
+                raise
+            except Exception as e:
+                logger.error(f"下载邮件时发生错误: {e}")
+                if progress_callback:
+                    progress_callback(False)
+                raise
+
+        try:
+            attachment_count = EmailDownload._save_message(email_id, msg_content, email_address, options, mailbox)
+        except Exception as e:
+            logger.error(f"处理邮件内容失败: {e}")
+            if progress_callback:
+                progress_callback(False)
+            raise
+        finally:
+            if hasattr(msg_content, 'close'):
+                msg_content.close()
+
+        if progress_callback:
+            progress_callback(True)
+        return attachment_count
+
+    @staticmethod
+    def download_batch(
+        email_ids: List[bytes],
+        email_address: str,
+        options: DownloadOptions,
+        pool: IMAPConnectionPool,
+        progress_callback: Optional[Callable[[bool, Optional[bytes]], None]] = None,
+        selective: bool = False,
+        controller: Optional[ConcurrencyController] = None,
+        mailbox: str = "INBOX",
+        pipeline: Optional['SavePipeline'] = None
+    ) -> int:
+        """用一条UID FETCH命令批量下载一组邮件
+        
+        Args:
+            email_ids: 邮件UID列表
+            email_address: 邮箱地址
+            options: 下载选项
+            pool: IMAP连接池
+            progress_callback: 进度回调函数，参数为(是否成功, 邮件UID)
+            selective: 是否先根据BODYSTRUCTURE只获取需要保存的邮件部分
+            controller: 并发控制器，为None时不限制并发
+            mailbox: 邮件所在的文件夹
+            pipeline: 解析/保存流水线，为None时在本线程中依次解析和保存
+            
+        Returns:
+            int: 保存的附件数量
+            
+        Note:
+            每封邮件只报告一次：pending是尚未报告的邮件，函数返回前其中剩余的邮件逐封记为失败，
+            包括服务器未返回(已被删除)和保存过程出错的邮件，因此不会因这些错误抛出异常。
+            连接中断时只重试尚未处理的邮件。
+            使用流水线时连接在交出邮件之前已经归还，流水线写满时本线程阻塞，不再获取新批次。
+        """
+        pending = {int(email_id): email_id for email_id in email_ids}
+        attachment_count = 0
+
+        def report(success: bool, email_id: bytes) -> None:
+            if progress_callback:
+                progress_callback(success, email_id)
+
+        if selective:
+            # 按需获取失败或不适用(非多部分邮件)的邮件仍留在pending中，走完整下载流程
+            attachment_count += EmailDownload._download_parts(
+                pending, email_address, options, pool, report, controller, mailbox
+            )
+            if not pending:
+                return attachment_count
+
+        for attempt in range(EmailDownload.MAX_RETRIES):
+            try:
+                with controller.track() if controller else nullcontext({}) as sample:
+                    with pool.lease(mailbox) as conn, RunReport.phase('fetch') as phase:
+                        status, msg_data = conn.mail.uid('FETCH', Tools.compress_uids(pending), '(UID RFC822)')
+                        sample['bytes'] = phase['bytes'] = Tools.response_size(msg_data)
+                if status != 'OK':
+                    raise Exception(f"获取邮件失败: {status}")
+            except (imaplib.IMAP4.abort, ConnectionError) as e:
+                if attempt < EmailDownload.MAX_RETRIES - 1:
+                    Metrics.inc('retries_total')
+                    time.sleep(EmailDownload.RETRY_DELAY)
+                    continue
+                logger.error(f"批量下载邮件失败(尝试 {EmailDownload.MAX_RETRIES} 次): {e}")
+                break
+            except Exception as e:
+                logger.error(f"批量下载邮件时发生错误: {e}")
+                break
+
+            try:
+                attachment_count += EmailDownload._save_fetched(
+                    msg_data, pending, email_address, options, report, mailbox, pipeline
+                )
+            except Exception as e:
+                logger.error(f"保存邮件时发生错误，剩余 {len(pending)} 封记为失败: {e}")
+                break
+            finally:
+                msg_data = None
+            if pending:
+                logger.warning(f"服务器未返回 {len(pending)} 封邮件，可能已被删除")
+            break
+
+        for email_id in pending.values():
+            report(False, email_id)
+        return attachment_count
+
+    @staticmethod
+    def _save_fetched(
+        msg_data: List[Any],
+        pending: Dict[int, bytes],
+        email_address: str,
+        options: DownloadOptions,
+        report: Callable[[bool, bytes], None],
+        mailbox: str = "INBOX",
+        pipeline: Optional['SavePipeline'] = None
+    ) -> int:
+        """逐条处理 UID FETCH (UID RFC822) 的无标签响应，同一批次中的邮件依次进入解析/保存流程
+        
+        Args:
+            msg_data: FETCH返回的数据列表
+            pending: UID到邮件ID的映射，已报告或已交给流水线的邮件会从中移除
+            email_address: 邮箱地址
+            options: 下载选项
+            report: 进度回调函数，参数为(是否成功, 邮件ID)
+            mailbox: 邮件所在的文件夹
+            pipeline: 解析/保存流水线，给出时邮件交给流水线处理并由流水线报告进度
+            
+        Returns:
+            int: 保存的附件数量(交给流水线的邮件不计入)
+            
+        Raises:
+            RuntimeError: 流水线已关闭，尚未交出的邮件仍留在pending中
+        """
+        attachment_count = 0
+        for _, fields in Tools.parse_fetch_response(msg_data):
+            uid, msg_content = fields.get('UID'), fields.get('RFC822')
+            if uid not in pending or not (isinstance(msg_content, bytes) or hasattr(msg_content, 'read')):
+                continue  # 例如服务器主动推送的FLAGS变更
+            email_id = pending[uid]
+            if pipeline is not None:
+                # 流水线接收后才从pending中移除，流水线已关闭时由调用方把剩余的邮件记为失败
+                try:
+                    pipeline.submit(email_id, msg_content)
+                except Exception:
+                    if hasattr(msg_content, 'close'):
+                        msg_content.close()
+                    raise
+                del pending[uid]
+                continue
+            del pending[uid]
+            try:
+                attachment_count += EmailDownload._save_message(email_id, msg_content, email_address, options, mailbox)
+                report(True, email_id)
+            except Exception as e:
+                logger.error(f"处理邮件 {email_id.decode()} 内容失败: {e}")
+                report(False, email_id)
+            finally:
+                if hasattr(msg_content, 'close'):
+                    msg_content.close()
+        return attachment_count
+
+    @staticmethod
+    def _download_parts(
+        pending: Dict[int, bytes],
+        email_address: str,
+        options: DownloadOptions,
+        pool: IMAPConnectionPool,
+        report: Callable[[bool, bytes], None],
+        controller: Optional[ConcurrencyController] = None,
+        mailbox: str = "INBOX"
+    ) -> int:
+        """根据BODYSTRUCTURE只获取需要保存的MIME部分
+        
+        先获取整批邮件的BODYSTRUCTURE，计算每封邮件需要的部分，
+        再把所需部分相同的邮件合并为一条 UID FETCH (BODY.PEEK[...]) 命令。
+        
+        Args:
+            pending: UID到邮件ID的映射，处理完成的邮件会从中移除
+            email_address: 邮箱地址
+            options: 下载选项
+            pool: IMAP连接池
+            report: 进度回调函数，参数为(是否成功, 邮件ID)
+            controller: 并发控制器，为None时不限制并发
+            mailbox: 邮件所在的文件夹
+            
+        Returns:
+            int: 保存的附件数量
+        """
+        download_html = options.download_html
+        attachment_count = 0
+        try:
+            with pool.lease(mailbox) as conn, RunReport.phase('structure') as phase:
+                status, data = conn.mail.uid('FETCH', Tools.compress_uids(pending), '(UID BODYSTRUCTURE)')
+                phase['bytes'] = Tools.response_size(data)
+            if status != 'OK':
+                raise Exception(f"获取邮件结构失败: {status}")
+
+            groups: Dict[Tuple[str, ...], List[int]] = {}
+            for _, fields in Tools.parse_fetch_response(data):
+                uid, structure = fields.get('UID'), fields.get('BODYSTRUCTURE')
+                if uid not in pending or not isinstance(structure, list) or not isinstance(structure[0], list):
+                    continue  # 非多部分邮件没有可省略的内容
+                sections = tuple(EmailDownload._needed_sections(structure, download_html))
+                groups.setdefault(sections, []).append(uid)
+
+            for sections, uids in groups.items():
+                items = ['UID', 'BODY.PEEK[HEADER]']
+                for section in sections:
+                    items += [f'BODY.PEEK[{section}.MIME]', f'BODY.PEEK[{section}]']
+                with controller.track() if controller else nullcontext({}) as sample:
+                    with pool.lease(mailbox) as conn, RunReport.phase('fetch') as phase:
+                        status, data = conn.mail.uid('FETCH', Tools.compress_uids(uids), f"({' '.join(items)})")
+                        sample['bytes'] = phase['bytes'] = Tools.response_size(data)
+                if status != 'OK':
+                    raise Exception(f"获取邮件部分失败: {status}")
+
+                for _, fields in Tools.parse_fetch_response(data):
+                    uid = fields.get('UID')
+                    if uid not in uids or uid not in pending:
+                        continue
+                    email_id = pending.pop(uid)
+                    try:
+                        with RunReport.phase('parse'):
+                            msg = BytesParser().parsebytes(Tools.literal_bytes(fields.get('BODY[HEADER]')), headersonly=True)
+                        entities = []
+                        for section in sections:
+                            mime = Tools.literal_bytes(fields.get(f'BODY[{section}.MIME]'))
+                            if mime and not mime.endswith((b'\r\n\r\n', b'\n\n')):
+                                mime += b'\r\n'
+                            entities.append((mime, fields.get(f'BODY[{section}]')))
+                        if any(hasattr(body, 'read') for _, body in entities):
+                            saver = StreamingMessageSaver(email_id, email_address, options, mailbox)
+                            attachment_count += saver.save_entities(msg, entities)
+                        else:
+                            parts = []
+                            with RunReport.phase('parse'):
+                                for mime, body in entities:
+                                    parts.extend(BytesParser().parsebytes(mime + Tools.literal_bytes(body)).walk())
+                            attachment_count += EmailDownload._save_parsed(
+                                email_id, msg, parts, email_address, options, mailbox
+                            )
+                        report(True, email_id)
+                    except Exception as e:
+                        logger.error(f"处理邮件 {email_id.decode()} 内容失败: {e}")
+                        report(False, email_id)
+                    finally:
+                        for value in fields.values():
+                            if hasattr(value, 'close'):
+                                value.close()
+        except Exception as e:
+            logger.warning(f"按需获取邮件部分失败，改为下载完整邮件: {e}")
+        return attachment_count
+
+    @staticmethod
+    def _needed_sections(structure: List[Any], download_html: bool, prefix: str = '') -> List[str]:
+        """根据BODYSTRUCTURE计算需要获取的MIME部分编号
+        
+        与 _process_email_part / _save_attachment 的保存规则保持一致：
+        纯文本、图片、带文件名的附件总是需要；HTML仅在勾选"下载HTML内容"时需要；
+        内嵌邮件(message/*)整体获取。
+        
+        Args:
+            structure: 解析后的BODYSTRUCTURE
+            download_html: 是否下载HTML内容
+            prefix: 当前多部分节点的部分编号
+            
+        Returns:
+            list: 部分编号列表，如 ['1.1', '2']
+        """
+        if isinstance(structure[0], list):
+            sections = []
+            for index, child in enumerate(structure, 1):
+                if not isinstance(child, list):
+                    break  # 子部分之后是multipart子类型及扩展数据
+                child_prefix = f"{prefix}.{index}" if prefix else str(index)
+                sections += EmailDownload._needed_sections(child, download_html, child_prefix)
+            return sections
+
+        section = prefix or '1'
+        maintype, subtype = str(structure[0]).lower(), str(structure[1]).lower()
+        params = structure[2] if isinstance(structure[2], list) else []
+        # 扩展数据(MD5之后为Content-Disposition)的位置取决于部分类型
+        if maintype == 'text':
+            disposition_index = 9
+        elif (maintype, subtype) == ('message', 'rfc822'):
+            disposition_index = 11
+        else:
+            disposition_index = 8
+        if len(structure) <= disposition_index or maintype == 'message':
+            return [section]
+
+        disposition = structure[disposition_index]
+        if isinstance(disposition, list) and len(disposition) > 1 and isinstance(disposition[1], list):
+            names = params[0::2] + disposition[1][0::2]
+            if any(str(name).lower().startswith(('name', 'filename')) for name in names):
+                return [section]
+
+        content_type = f"{maintype}/{subtype}"
+        if content_type == 'text/plain' or 'image' in content_type:
+            return [section]
+        if content_type == 'text/html' and download_html:
+            return [section]
+        return []
+
+    @staticmethod
+    def _plan_batches(
+        email_ids: Iterable[Union[bytes, int]],
+        size: Callable[[int], int],
+        max_count: Optional[int] = None,
+        max_bytes: Optional[int] = None
+    ) -> Iterator[List[bytes]]:
+        """按邮件数量和累计大小把UID划分为批次
+        
+        Args:
+            email_ids: 邮件UID序列
+            size: 返回邮件大小的函数(如DownloadPlan.size，未知的为0)
+            max_count: 每批最多邮件数，默认为FETCH_BATCH_SIZE
+            max_bytes: 每批最大累计字节数，默认为FETCH_BATCH_BYTES
+            
+        Yields:
+            list: 一个批次的UID，超过max_bytes的单封邮件单独成批
+        """
+        max_count = max_count or EmailDownload.FETCH_BATCH_SIZE
+        max_bytes = max_bytes or EmailDownload.FETCH_BATCH_BYTES
+        batch: List[bytes] = []
+        batch_bytes = 0
+        for email_id in email_ids:
+            email_size = size(int(email_id))
+            if batch and (len(batch) >= max_count or batch_bytes + email_size > max_bytes):
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(email_id if isinstance(email_id, bytes) else str(email_id).encode())
+            batch_bytes += email_size
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _save_message(
+        email_id: bytes,
+        msg_content: Union[bytes, str, BinaryIO],
+        email_address: str,
+        options: DownloadOptions,
+        mailbox: str = "INBOX"
+    ) -> int:
+        """解析邮件原文并保存正文、图片和附件
+        
+        Args:
+            email_id: 邮件ID
+            msg_content: RFC822邮件原文(bytes或暂存文件)
+            email_address: 邮箱地址
+            options: 下载选项
+            mailbox: 邮件所在的文件夹
+            
+        Returns:
+            int: 保存的附件数量
+        """
+        if hasattr(msg_content, 'read'):
+            # 超过SPOOL_THRESHOLD的邮件原文已暂存在磁盘上，流式解析以限制内存占用
+            msg_content.seek(0)
+            return StreamingMessageSaver(email_id, email_address, options, mailbox).save(msg_content)
+        msg, parts = EmailDownload._parse_message(msg_content)
+        return EmailDownload._save_parsed(email_id, msg, parts, email_address, options, mailbox)
+
+    @staticmethod
+    def _parse_message(msg_content: Union[bytes, str]) -> Tuple[email.message.Message, Optional[List[email.message.Message]]]:
+        """解析内存中的邮件原文
+        
+        Returns:
+            (邮件消息对象, 需要处理的邮件部分)，非多部分邮件的部分为None，与_save_parsed的参数对应
+        """
+        with RunReport.phase('parse') as sample:
+            raw = msg_content if isinstance(msg_content, bytes) else msg_content.encode()
+            sample['bytes'] = len(raw)
+            msg = BytesParser().parsebytes(raw)
+            parts = list(msg.walk()) if msg.is_multipart() else None
+        return msg, parts
+
+    @staticmethod
+    def _prepare_directory(
+        email_id: bytes,
+        msg: email.message.Message,
+        email_address: str,
+        mailbox: str = "INBOX"
+    ) -> Tuple[str, str]:
+        """创建邮件的保存目录，优先使用下载计划中预先确定的目录
+        
+        Args:
+            email_id: 邮件ID
+            msg: 邮件消息对象(只需要邮件头)
+            email_address: 邮箱地址
+            mailbox: 邮件所在的文件夹
+            
+        Returns:
+            (保存路径, 有效主题)
+        """
+        planned = DownloadPlan.lookup(email_address, email_id, mailbox)
+        path, valid_subject = planned or EmailDownload._plan_directory(email_id, msg, email_address, mailbox)
+        Path(path).mkdir(parents=True, exist_ok=True)
+        return path, valid_subject
+
+    @staticmethod
+    def _plan_directory(
+        email_id: bytes,
+        msg: email.message.Message,
+        email_address: str,
+        mailbox: str = "INBOX"
+    ) -> Tuple[str, str]:
+        """根据邮件主题和日期确定保存目录(不创建)
+        
+        Args:
+            email_id: 邮件ID
+            msg: 邮件消息对象(只需要邮件头)
+            email_address: 邮箱地址
+            mailbox: 邮件所在的文件夹
+            
+        Returns:
+            (保存路径, 有效主题)
+        """
+        subject = make_header(decode_header(msg['SUBJECT']))
+        subject = re.sub(r'[\\/:*?"<>|]', '', str(subject)).strip()
+        valid_subject = f'无主题_{int(time.time())}' if not subject or subject.isspace() else subject
+        
+        # 创建下载目录
+        download_dir = EmailDownload.folder_directory(email_address, mailbox)
+        path = Tools.rename(email_id, msg, str(download_dir / valid_subject))
+        return path, valid_subject
+
+    @staticmethod
+    def _save_parsed(
+        email_id: bytes,
+        msg: email.message.Message,
+        parts: Optional[List[email.message.Message]],
+        email_address: str,
+        options: DownloadOptions,
+        mailbox: str = "INBOX"
+    ) -> int:
+        """保存已解析邮件的正文、图片和附件
+        
+        Args:
+            email_id: 邮件ID
+            msg: 邮件消息对象(至少包含邮件头)
+            parts: 需要处理的邮件部分，为None时按非多部分邮件处理msg本身
+            email_address: 邮箱地址
+            options: 下载选项
+            mailbox: 邮件所在的文件夹
+            
+        Returns:
+            int: 保存的附件数量
+        """
+        path, valid_subject = EmailDownload._prepare_directory(email_id, msg, email_address, mailbox)
+
+        # 处理邮件内容
+        if parts is not None:
+            for part in parts:
+                EmailDownload._process_email_part(part, path, valid_subject, options)
+        else:
+            EmailDownload._save_text_content(msg, path, valid_subject)
+
+        # 处理附件
+        attachment_count = 0
+        for part in (parts if parts is not None else msg.walk()):
+            if part.get_content_maintype() == 'multipart' or part.get("Content-Disposition") is None:
+                continue
+            if EmailDownload._save_attachment(part, path, dedup=options.dedup_attachments):
+                attachment_count += 1
+                Metrics.inc('attachments_saved_total')
+        return attachment_count
+
+    @staticmethod
+    def _process_email_part(
+        part: email.message.Message, 
+        path: str, 
+        valid_subject: str, 
+        options: DownloadOptions
+    ) -> None:
+        """处理邮件各部分内容
+        
+        Args:
+            part: 邮件部分对象
+            path: 保存路径
+            valid_subject: 有效主题
+            options: 下载选项
+            
+        Note:
+            根据内容类型调用相应的保存方法
+        """
+        content_type = part.get_content_type()
+        charset = part.get_content_charset() or 'utf-8'
+
+        try:
+            if content_type == 'text/plain':
+                EmailDownload._save_text_file(part, path, valid_subject, charset)
+            elif content_type == 'text/html' and options.download_html:
+                EmailDownload._save_html_file(part, path, valid_subject, charset)
+            elif 'image' in content_type:
+                EmailDownload._save_image_file(part, path, valid_subject)
+
+        except Exception as e:
+            logger.warning(f"处理邮件部分内容失败: {e}")
+
+    @staticmethod
+    @RunReport.timed('save_text')
+    def _save_text_file(
+        part: email.message.Message, 
+        path: str, 
+        valid_subject: str, 
+        charset: str
+    ) -> None:
+        """保存纯文本内容
+        
+        Args:
+            part: 邮件部分对象
+            path: 保存路径
+            valid_subject: 有效主题
+            charset: 字符编码
+        """
+        txt_filepath = os.path.join(path, f'{valid_subject}.txt')
+        content = part.get_payload(decode=True).decode(charset)
+        with open(txt_filepath, 'w', encoding='UTF-8') as f:
+            f.write(content)
+
+    @staticmethod
+    @RunReport.timed('save_html')
+    def _save_html_file(
+        part: email.message.Message, 
+        path: str,
+        valid_subject: str, 
+        charset: str
+    ) -> None:
+        """保存HTML内容
+        
+        Args:
+            part: 邮件部分对象
+            path: 保存路径
+            valid_subject: 有效主题
+            charset: 字符编码
+        """
+        html_filepath = os.path.join(path, f'{valid_subject}.html')
+        content = part.get_payload(decode=True).decode(charset)
+        with open(html_filepath, 'w', encoding='UTF-8') as f:
+            f.write(content)
+
+    @staticmethod
+    @RunReport.timed('save_image')
+    def _save_image_file(
+        part: email.message.Message, 
+        path: str,
+        valid_subject: str
+    ) -> None:
+        """保存图片内容
+        
+        Args:
+            part: 邮件部分对象
+            path: 保存路径
+            valid_subject: 有效主题
+        """
+        content_type = part.get_content_type()
+        ext = content_type.split('/')[1]
+        image_filepath = os.path.join(path, f'{valid_subject}.{ext}')
+        with open(image_filepath, 'wb') as f:
+            payload = part.get_payload(decode=True)
+            if payload:
+                f.write(payload)
+
+    @staticmethod
+    @RunReport.timed('save_text')
+    def _save_text_content(
+        msg: email.message.Message, 
+        path: str,
+        valid_subject: str
+    ) -> None:
+        """保存非多部分邮件的文本内容
+        
+        Args:
+            msg: 邮件消息对象
+            path: 保存路径
+            valid_subject: 有效主题
+        """
+        txt_filepath = os.path.join(path, f'{valid_subject}.txt')
+        content = msg.get_payload(decode=True).decode(EmailDownload._text_charset(msg))
+        with open(txt_filepath, 'w', encoding='UTF-8') as f:
+            f.write(content)
+
+    @staticmethod
+    def _text_charset(msg: email.message.Message) -> str:
+        """非多部分邮件正文的字符集，未声明时为utf-8"""
+        charset = msg.get_charset()
+        if not charset:
+            content_type = msg.get('Content-Type', '').lower()
+            pos = content_type.find('charset=')
+            if pos >= 0:
+                charset = content_type[pos + 8:].strip()
+        return str(charset or 'utf-8')
+
+    @staticmethod
+    def _check_resume_data(email_address: str, mailbox: str = "INBOX") -> 'ResumeJournal':
+        """打开断点续传日志，一次顺序读取即可得到已完成和失败的邮件
+        
+        Args:
+            email_address: 邮箱地址
+            mailbox: 文件夹，每个文件夹在自己的下载目录中保存独立的日志
+            
+        Returns:
+            ResumeJournal: 断点续传日志
+        """
+        return ResumeJournal(EmailDownload.folder_directory(email_address, mailbox))
+
+    @staticmethod
+    @RunReport.timed('resume')
+    def _update_resume_data(
+        journal: 'ResumeJournal', 
+        email_id: bytes, 
+        success: bool
+    ) -> None:
+        """更新断点续传数据(追加一条日志记录)
+        
+        Args:
+            journal: 断点续传日志
+            email_id: 邮件UID
+            success: 是否成功下载
+        """
+        try:
+            journal.record(int(email_id), success)
+        except Exception as e:
+            logger.error(f"更新断点续传数据失败: {e}")
+
+    @staticmethod
+    @RunReport.timed('save_attachment')
+    def _save_attachment(
+        part: email.message.Message, 
+        path: str, 
+        dedup: bool = False
+    ) -> bool:
+        """保存邮件附件
+        
+        Args:
+            part: 邮件部分对象
+            path: 保存路径
+            dedup: 是否写入AttachmentStore，邮件目录中只保留链接
+            
+        Returns:
+            bool: 是否成功保存附件
+        """
+        filename = part.get_filename()
+        if not filename:
+            return False
+
+        decode_filename, decode = email.header.decode_header(filename)[0]
+        if isinstance(decode_filename, bytes):
+            decode_filename = decode_filename.decode(decode or 'utf-8')
+
+        content = part.get_payload(decode=True)
+        if not content:
+            return False
+
+        filepath = os.path.join(path, decode_filename)
+        with AttachmentStore.open(filepath, dedup) as f:
+            # 分块写入大文件(memoryview切片不复制数据)
+            chunk_size = EmailDownload.CHUNK_SIZE
+            view = memoryview(content)
+            for i in range(0, len(content), chunk_size):
+                f.write(view[i:i+chunk_size])
+        return True
+
+
+
+class AttachmentStore:
+    """按内容寻址的附件存储
+    
+    附件解码后的内容按SHA-256保存在 downloads/.attachments/<哈希前两位>/<哈希> 中，相同内容只存一份；
+    邮件目录中的附件是指向存储对象的硬链接，文件名和位置与不去重时相同。
+    哈希在写入时随解码结果一起计算，不需要再读一遍文件。文件系统不支持硬链接
+    (如FAT32、跨分区、链接数达到上限)时改为复制，每个邮件目录中仍有完整的附件。
+    
+    硬链接的文件共享同一份内容，直接修改某个邮件目录中的附件会影响其他邮件中的同一附件，
+    因此去重需要显式开启(DownloadOptions.dedup_attachments，界面上的"附件去重")。
+    重新下载同一封邮件时附件已经链接到同一存储对象，不计为去重。
+    
+    Attributes:
+        DIRECTORY (Path): 存储目录
+    """
+    DIRECTORY = Path('./downloads/.attachments')
+
+    _totals = _ThreadShards(lambda: [0, 0])
+
+    @classmethod
+    def open(cls, filepath: str, dedup: bool = False) -> Any:
+        """打开一个附件用于写入
+        
+        Args:
+            filepath: 附件在邮件目录中的路径
+            dedup: 是否写入存储，为False时直接写入filepath
+        
+        Returns:
+            可写入的文件对象，close()或退出with块时完成保存
+        """
+        if dedup:
+            return _StoreWriter(filepath)
+        if os.path.exists(filepath) and os.stat(filepath).st_nlink > 1:
+            # 以前去重保存的附件，直接覆盖会改写存储中的内容
+            os.unlink(filepath)
+        return open(filepath, 'wb')
+
+    @classmethod
+    def commit(cls, temp_path: str, digest: str, size: int, filepath: str) -> None:
+        """把写好的临时文件移入存储(内容已存在时丢弃)，再链接到filepath"""
+        target = cls.DIRECTORY / digest[:2] / digest
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            duplicate = target.stat().st_size == size
+        except FileNotFoundError:
+            duplicate = False
+        if duplicate:
+            os.unlink(temp_path)
+        else:
+            # 并发写入同一内容时原子替换，结果相同
+            os.replace(temp_path, target)
+        relinked = False
+        if os.path.lexists(filepath):
+            # 重新下载同一封邮件: 原文件已是指向同一存储对象的链接，不算作去重
+            relinked = duplicate and os.path.samefile(filepath, target)
+            os.unlink(filepath)
+        try:
+            os.link(target, filepath)
+        except OSError:
+            shutil.copyfile(target, filepath)
+            return
+        if duplicate and not relinked:
+            cls.record(1, size)
+
+    @classmethod
+    def record(cls, deduplicated: int, bytes_saved: int) -> None:
+        """记录去重的附件数和节省的字节数"""
+        if not deduplicated:
+            return
+        totals = cls._totals.local()
+        totals[0] += deduplicated
+        totals[1] += bytes_saved
+        Metrics.inc('attachments_deduplicated_total', deduplicated)
+        Metrics.inc('attachment_bytes_saved_total', bytes_saved)
+        RunReport.count('attachments_deduplicated', deduplicated)
+        RunReport.count('attachment_bytes_saved', bytes_saved)
+
+    @classmethod
+    def totals(cls) -> Tuple[int, int]:
+        """本进程累计的 (去重附件数, 节省的字节数)"""
+        shards = cls._totals.all()
+        return sum(shard[0] for shard in shards), sum(shard[1] for shard in shards)
+
+
+class _StoreWriter:
+    """写入AttachmentStore的一个附件: 先写入存储目录下的临时文件并计算哈希，关闭时提交"""
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.size = 0
+        self._hash = hashlib.sha256()
+        temp_dir = AttachmentStore.DIRECTORY / 'tmp'
+        temp_dir.mkdir(parents=True, exist_ok=True)
+        fd, self._temp_path = tempfile.mkstemp(dir=temp_dir)
+        self._file = os.fdopen(fd, 'wb')
+
+    def __enter__(self) -> '_StoreWriter':
+        return self
+
+    def __exit__(self, exc_type: Any, *exc_info: Any) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def abort(self) -> None:
+        """放弃写入，删除临时文件"""
+        self._file.close()
+        try:
+            os.unlink(self._temp_path)
+        except FileNotFoundError:
+            pass
+
+    def write(self, data: Union[bytes, memoryview]) -> None:
+        self._file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def close(self) -> None:
+        self._file.close()
+        AttachmentStore.commit(self._temp_path, self._hash.hexdigest(), self.size, self.filepath)
+
+
+class _DecodingSink:
+    """把一个MIME部分的正文按Content-Transfer-Encoding增量解码后写入文件
+    
+    只在第一次写入非空内容时创建文件，空附件不会留下空文件。
+    去重时写入AttachmentStore，内容哈希随解码结果一起计算。
+    """
+
+    _BASE64_NOISE_RE = re.compile(rb'[^A-Za-z0-9+/=]')
+
+    def __init__(self, filepath: str, encoding: str, dedup: bool = False):
+        self.filepath = filepath
+        self.encoding = encoding
+        self.dedup = dedup
+        self._pending = b''
+        self._file: Optional[Any] = None
+
+    def write(self, data: bytes) -> None:
+        if self.encoding == 'base64':
+            data = self._pending + self._BASE64_NOISE_RE.sub(b'', data)
+            usable = len(data) // 4 * 4
+            self._pending = data[usable:]
+            self._emit(binascii.a2b_base64(data[:usable]) if usable else b'')
+        elif self.encoding == 'quoted-printable':
+            # 软换行("="结尾)需要和换行符一起解码，因此只解码完整的行
+            data = self._pending + data
+            cut = data.rfind(b'\n') + 1
+            self._pending = data[cut:]
+            self._emit(binascii.a2b_qp(data[:cut]) if cut else b'')
+        else:
+            self._emit(data)
+
+    def close(self) -> bool:
+        """写入剩余内容并关闭文件
+        
+        Returns:
+            bool: 是否写入了内容
+        """
+        if self._pending:
+            if self.encoding == 'base64':
+                tail = self._pending + b'=' * (-len(self._pending) % 4)
+                try:
+                    self._emit(binascii.a2b_base64(tail))
+                except binascii.Error as e:
+                    logger.warning(f"附件末尾的base64数据无效: {e}")
+            else:
+                self._emit(binascii.a2b_qp(self._pending))
+            self._pending = b''
+        if self._file is None:
+            return False
+        self._file.close()
+        return True
+
+    def abort(self) -> None:
+        """解析中途出错时关闭并删除写了一半的文件"""
+        file, self._file = self._file, None
+        if file is None:
+            return
+        if isinstance(file, _StoreWriter):
+            file.abort()
+            return
+        file.close()
+        try:
+            os.unlink(self.filepath)
+        except FileNotFoundError:
+            pass
+
+    def _emit(self, data: bytes) -> None:
+        if not data:
+            return
+        if self._file is None:
+            self._file = AttachmentStore.open(self.filepath, self.dedup)
+        self._file.write(data)
+
+
+class _BufferSink:
+    """在内存中收集一个MIME部分的原始正文(用于正文、内嵌图片等较小的部分)"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> None:
+        self._chunks.append(data)
+
+    def getvalue(self) -> bytes:
+        return b''.join(self._chunks)
+
+
+class StreamingMessageSaver:
+    """流式解析并保存邮件
+    
+    逐行读取暂存在磁盘上的邮件原文，按MIME分隔线切分各部分。附件正文边读边解码
+    写入目标文件，内存中只保留当前行和少量解码余量；正文、内嵌图片等其余部分
+    收集后仍交给 _process_email_part / _save_attachment 处理，保存结果与
+    一次性解析整封邮件相同。非多部分邮件的正文同样边读边解码，再逐块转换为UTF-8文本。
+    """
+
+    def __init__(self, email_id: bytes, email_address: str, options: DownloadOptions, mailbox: str = "INBOX"):
+        """初始化
+        
+        Args:
+            email_id: 邮件ID
+            email_address: 邮箱地址
+            options: 下载选项
+            mailbox: 邮件所在的文件夹
+        """
+        self.email_id = email_id
+        self.email_address = email_address
+        self.options = options
+        self.mailbox = mailbox
+        self.path = ''
+        self.valid_subject = ''
+        self.attachment_count = 0
+        self._parts: List[email.message.Message] = []
+        self._lines: Iterator[bytes] = iter(())
+        self._at_line_start = True
+
+    @RunReport.timed('stream_save')
+    def save(self, source: BinaryIO) -> int:
+        """保存一封完整邮件
+        
+        Args:
+            source: 邮件原文文件对象
+            
+        Returns:
+            int: 保存的附件数量
+        """
+        self._lines = self._read_lines(source)
+        msg = self._read_headers()
+        self.path, self.valid_subject = EmailDownload._prepare_directory(
+            self.email_id, msg, self.email_address, self.mailbox
+        )
+        if msg.get_content_maintype() != 'multipart':
+            return self._save_single_part(msg)
+        self._parse_entity(msg, [])
+        return self._finish()
+
+    def _save_single_part(self, msg: email.message.Message) -> int:
+        """流式保存非多部分邮件，结果与 _save_text_content 及 _save_parsed 中的附件处理相同
+        
+        正文解码到临时文件后按声明的字符集逐块转换为UTF-8写入 <主题>.txt；
+        带文件名的附件型邮件再从临时文件复制一份附件。
+        """
+        fd, decoded = tempfile.mkstemp(suffix='.part')
+        os.close(fd)
+        sink = _DecodingSink(decoded, msg.get('Content-Transfer-Encoding', '7bit').strip().lower())
+        try:
+            self._copy_until_boundary([], sink)
+            sink.close()
+            chunk_size = EmailDownload.CHUNK_SIZE
+            decoder = codecs.getincrementaldecoder(EmailDownload._text_charset(msg))()
+            txt_filepath = os.path.join(self.path, f'{self.valid_subject}.txt')
+            with open(decoded, 'rb') as src, open(txt_filepath, 'w', encoding='UTF-8') as f:
+                for chunk in iter(lambda: src.read(chunk_size), b''):
+                    f.write(decoder.decode(chunk))
+                f.write(decoder.decode(b'', final=True))
+
+            filename = msg.get_filename()
+            if msg.get("Content-Disposition") is not None and filename and os.path.getsize(decoded):
+                decode_filename, decode = email.header.decode_header(filename)[0]
+                if isinstance(decode_filename, bytes):
+                    decode_filename = decode_filename.decode(decode or 'utf-8')
+                with open(decoded, 'rb') as src, \
+                        AttachmentStore.open(os.path.join(self.path, decode_filename), self.options.dedup_attachments) as f:
+                    for chunk in iter(lambda: src.read(chunk_size), b''):
+                        f.write(chunk)
+                self.attachment_count += 1
+                Metrics.inc('attachments_saved_total')
+        finally:
+            sink.abort()
+            try:
+                os.unlink(decoded)
+            except FileNotFoundError:
+                pass
+        return self.attachment_count
+
+    def save_entities(self, msg: email.message.Message, entities: List[Tuple[bytes, Any]]) -> int:
+        """保存按需获取的若干MIME部分
+        
+        Args:
+            msg: 只含邮件头的消息对象
+            entities: (部分MIME头, 部分正文) 列表，正文为bytes或暂存文件
+            
+        Returns:
+            int: 保存的附件数量
+        """
+        self.path, self.valid_subject = EmailDownload._prepare_directory(
+            self.email_id, msg, self.email_address, self.mailbox
+        )
+        for mime, body in entities:
+            if hasattr(body, 'read'):
+                body.seek(0)
+                stream = body
+            else:
+                stream = io.BytesIO(Tools.literal_bytes(body))
+            self._lines = itertools.chain(self._read_lines(io.BytesIO(mime)), self._read_lines(stream))
+            self._at_line_start = True
+            self._parse_entity(self._read_headers(), [])
+        return self._finish()
+
+    def _finish(self) -> int:
+        """处理收集到的非附件部分，规则与 _save_parsed 一致"""
+        for part in self._parts:
+            EmailDownload._process_email_part(part, self.path, self.valid_subject, self.options)
+        for part in self._parts:
+            if part.get("Content-Disposition") is None:
+                continue
+            if EmailDownload._save_attachment(part, self.path, dedup=self.options.dedup_attachments):
+                self.attachment_count += 1
+                Metrics.inc('attachments_saved_total')
+        self._parts = []
+        return self.attachment_count
+
+    @staticmethod
+    def _read_lines(source: BinaryIO) -> Generator[bytes, None, None]:
+        """按行读取，超长的行按CHUNK_SIZE切分"""
+        while True:
+            line = source.readline(EmailDownload.CHUNK_SIZE)
+            if not line:
+                return
+            yield line
+
+    def _next_line(self) -> Tuple[Optional[bytes], bool]:
+        """读取下一行
+        
+        Returns:
+            (行内容, 是否位于行首)，超长行被切分后的后续片段不在行首，不可能是分隔线
+        """
+        line = next(self._lines, None)
+        at_line_start = self._at_line_start
+        if line is not None:
+            self._at_line_start = line.endswith(b'\n')
+        return line, at_line_start
+
+    def _read_headers(self) -> email.message.Message:
+        """读取到空行为止的头部并解析"""
+        header_lines = []
+        while True:
+            line, _ = self._next_line()
+            if line is None or line in (b'\r\n', b'\n'):
+                break
+            header_lines.append(line)
+        return BytesParser().parsebytes(b''.join(header_lines), headersonly=True)
+
+    @staticmethod
+    def _match_boundary(line: bytes, boundaries: List[bytes]) -> Optional[Tuple[bytes, bool]]:
+        """判断一行是否为某个外层分隔线
+        
+        Returns:
+            (分隔符, 是否为结束分隔线)，不是分隔线时返回None
+        """
+        if not line.startswith(b'--'):
+            return None
+        stripped = line.rstrip()
+        for boundary in reversed(boundaries):
+            if stripped == b'--' + boundary:
+                return boundary, False
+            if stripped == b'--' + boundary + b'--':
+                return boundary, True
+        return None
+
+    def _copy_until_boundary(self, boundaries: List[bytes], sink: Any) -> Optional[bytes]:
+        """把正文写入sink直到遇到分隔线，返回该分隔线(文件结束时返回None)
+        
+        分隔线前的换行符属于分隔线本身，因此每行的换行符延迟到确认下一行不是分隔线后再写入。
+        """
+        newline = b''
+        while True:
+            line, at_line_start = self._next_line()
+            if line is None:
+                if sink is not None and newline:
+                    sink.write(newline)
+                return None
+            if at_line_start and self._match_boundary(line, boundaries):
+                return line
+            if sink is None:
+                continue
+            if newline:
+                sink.write(newline)
+            if line.endswith(b'\r\n'):
+                line, newline = line[:-2], b'\r\n'
+            elif line.endswith(b'\n'):
+                line, newline = line[:-1], b'\n'
+            else:
+                newline = b''
+            sink.write(line)
+
+    def _parse_entity(self, headers: email.message.Message, boundaries: List[bytes]) -> Optional[bytes]:
+        """解析一个MIME实体的正文，返回结束它的分隔线"""
+        if headers.get_content_maintype() == 'multipart' and headers.get_boundary():
+            boundary = headers.get_boundary().encode('utf-8', 'surrogateescape')
+            inner = boundaries + [boundary]
+            line = self._copy_until_boundary(inner, None)  # 跳过前导文本
+            while line is not None:
+                matched, closing = self._match_boundary(line, inner)
+                if matched != boundary:
+                    return line  # 外层分隔线提前出现，本实体结束
+                if closing:
+                    return self._copy_until_boundary(boundaries, None)  # 跳过结尾文本
+                line = self._parse_entity(self._read_headers(), inner)
+            return None
+
+        if headers.get_content_type() == 'message/rfc822':
+            # 与msg.walk()一致，继续处理内嵌邮件的各部分
+            return self._parse_entity(self._read_headers(), boundaries)
+
+        filename = headers.get_filename()
+        if headers.get("Content-Disposition") is not None and filename and headers.get_content_maintype() != 'text':
+            decode_filename, decode = email.header.decode_header(filename)[0]
+            if isinstance(decode_filename, bytes):
+                decode_filename = decode_filename.decode(decode or 'utf-8')
+            filepath = os.path.join(self.path, decode_filename)
+            sink = _DecodingSink(
+                filepath, headers.get('Content-Transfer-Encoding', '7bit').strip().lower(), self.options.dedup_attachments
+            )
+            try:
+                line = self._copy_until_boundary(boundaries, sink)
+                saved = sink.close()
+            except BaseException:
+                sink.abort()  # 不留下写了一半的附件或临时文件
+                raise
+            if saved:
+                self.attachment_count += 1
+                Metrics.inc('attachments_saved_total')
+                if 'image' in headers.get_content_type():
+                    # 与 _save_image_file 的结果保持一致
+                    ext = headers.get_content_type().split('/')[1]
+                    shutil.copyfile(filepath, os.path.join(self.path, f'{self.valid_subject}.{ext}'))
+            return line
+
+        sink = _BufferSink()
+        line = self._copy_until_boundary(boundaries, sink)
+        headers.set_payload(sink.getvalue().decode('ascii', 'surrogateescape'))
+        self._parts.append(headers)
+        return line
+
+
+class ByteBoundedQueue:
+    """按字节数限制容量的阻塞队列
+    
+    put()在队列中的字节数加上新条目会超过容量时阻塞，直到消费者取走足够的条目；
+    队列为空时总是允许放入，单个超过容量的条目不会永远阻塞。
+    close()之后get()在队列取空时返回None。
+    """
+
+    def __init__(self, capacity: int, metric: Optional[str] = None):
+        """初始化
+        
+        Args:
+            capacity: 容量(字节)
+            metric: 记录排队字节数的仪表盘指标名称
+        """
+        self.capacity = capacity
+        self.metric = metric
+        self._items: collections.deque = collections.deque()
+        self._bytes = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def put(self, item: Any, nbytes: int) -> None:
+        with self._cond:
+            while self._items and self._bytes + nbytes > self.capacity and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                raise RuntimeError("队列已关闭")
+            self._items.append((item, nbytes))
+            self._bytes += nbytes
+            self._cond.notify_all()
+        if self.metric:
+            Metrics.inc(self.metric, nbytes)
+
+    def get(self) -> Optional[Any]:
+        with self._cond:
+            while not self._items and not self._closed:
+                self._cond.wait()
+            if not self._items:
+                return None
+            item, nbytes = self._items.popleft()
+            self._bytes -= nbytes
+            self._cond.notify_all()
+        if self.metric:
+            Metrics.inc(self.metric, -nbytes)
+        return item
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class SavePipeline:
+    """获取 → 解析 → 保存 三段流水线
+    
+    网络线程取回邮件原文后调用submit()放入解析队列，随即可以发出下一条FETCH；
+    解析线程把原文解析为邮件对象后放入保存队列；保存线程创建目录、写入正文、图片和附件
+    并报告进度。两个队列的容量都按字节计算，磁盘比网络慢时队列写满，submit()阻塞，
+    网络线程随之停止获取新批次，缓存的邮件不会超过容量。
+    
+    暂存在磁盘上的大邮件不在解析线程中展开，直接交给保存线程流式处理(见StreamingMessageSaver)。
+    
+    解析、base64解码和字符集转换都要持有GIL，线程再多也只能用满一个CPU核心。
+    options.processes大于0时解析线程只负责转交，保存线程把邮件原文写入临时文件，
+    由子进程池按文件路径读取、解析并保存，只返回附件数量和耗时；邮件原文不经过pickle复制。
+    
+    Attributes:
+        PARSERS (int): 解析线程数
+        WRITERS (int): 保存线程数(使用子进程时至少与进程数相同)
+        CAPACITY (int): 每个队列最多缓存的字节数
+    """
+
+    PARSERS = 2
+    WRITERS = 4
+    CAPACITY = 64 * 1024 * 1024  # 64MB
+
+    def __init__(
+        self,
+        email_address: str,
+        options: DownloadOptions,
+        progress_callback: Optional[Callable[[bool, Optional[bytes]], None]] = None,
+        mailbox: str = "INBOX",
+        parsers: Optional[int] = None,
+        writers: Optional[int] = None,
+        capacity: Optional[int] = None,
+        processes: Optional[int] = None
+    ):
+        """初始化
+        
+        Args:
+            email_address: 邮箱地址
+            options: 下载选项
+            progress_callback: 进度回调函数，参数为(是否成功, 邮件ID)，在保存线程中调用
+            mailbox: 邮件所在的文件夹
+            parsers: 解析线程数，默认为PARSERS
+            writers: 保存线程数，默认为WRITERS
+            capacity: 每个队列的容量(字节)，默认为CAPACITY
+            processes: 子进程数，默认为options.processes
+        """
+        self.email_address = email_address
+        self.options = options
+        self.progress_callback = progress_callback
+        self.mailbox = mailbox
+        self.parsers = parsers or self.PARSERS
+        self.processes = options.processes if processes is None else processes
+        self.writers = max(writers or self.WRITERS, self.processes)
+        capacity = capacity or self.CAPACITY
+        self.attachment_count = 0
+        self._count_lock = Lock()
+        self._parse_queue = ByteBoundedQueue(capacity, 'pipeline_bytes')
+        self._write_queue = ByteBoundedQueue(capacity, 'pipeline_bytes')
+        self._parse_threads: List[Thread] = []
+        self._write_threads: List[Thread] = []
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def __enter__(self) -> 'SavePipeline':
+        if self.processes > 0:
+            # spawn: 下载进程中已有多个线程，fork出的子进程可能继承被占用的锁
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.processes, mp_context=multiprocessing.get_context('spawn')
+            )
+        self._parse_threads = [
+            Thread(target=self._parse_loop, name=f'parse-{i}', daemon=True) for i in range(self.parsers)
+        ]
+        self._write_threads = [
+            Thread(target=self._write_loop, name=f'write-{i}', daemon=True) for i in range(self.writers)
+        ]
+        for thread in self._parse_threads + self._write_threads:
+            thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def submit(self, email_id: bytes, msg_content: Union[bytes, str, BinaryIO]) -> None:
+        """交付一封邮件原文，流水线写满时阻塞
+        
+        Args:
+            email_id: 邮件ID
+            msg_content: RFC822邮件原文(bytes或暂存文件)，处理完毕后由流水线关闭
+        """
+        nbytes = self._size(msg_content)
+        self._parse_queue.put((email_id, msg_content, nbytes), nbytes)
+
+    def close(self) -> None:
+        """等待已交付的邮件全部保存完毕"""
+        self._parse_queue.close()
+        for thread in self._parse_threads:
+            thread.join()
+        self._write_queue.close()
+        for thread in self._write_threads:
+            thread.join()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    @staticmethod
+    def _size(msg_content: Union[bytes, str, BinaryIO]) -> int:
+        if hasattr(msg_content, 'seek'):
+            size = msg_content.seek(0, io.SEEK_END)
+            msg_content.seek(0)
+            return size
+        return len(msg_content)
+
+    def _report(self, success: bool, email_id: bytes) -> None:
+        if self.progress_callback:
+            self.progress_callback(success, email_id)
+
+    def _parse_loop(self) -> None:
+        while True:
+            item = self._parse_queue.get()
+            if item is None:
+                return
+            email_id, msg_content, nbytes = item
+            parsed = None
+            if self._pool is None and not hasattr(msg_content, 'read'):
+                try:
+                    parsed = EmailDownload._parse_message(msg_content)
+                except Exception as e:
+                    logger.error(f"解析邮件 {email_id.decode()} 失败: {e}")
+                    self._report(False, email_id)
+                    continue
+            self._write_queue.put((email_id, msg_content, parsed), nbytes)
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                return
+            email_id, msg_content, parsed = item
+            try:
+                if self._pool is not None:
+                    count = self._save_in_process(email_id, msg_content)
+                elif parsed is None:
+                    count = EmailDownload._save_message(
+                        email_id, msg_content, self.email_address, self.options, self.mailbox
+                    )
+                else:
+                    msg, parts = parsed
+                    count = EmailDownload._save_parsed(
+                        email_id, msg, parts, self.email_address, self.options, self.mailbox
+                    )
+                with self._count_lock:
+                    self.attachment_count += count
+                self._report(True, email_id)
+            except Exception as e:
+                logger.error(f"处理邮件 {email_id.decode()} 内容失败: {e}")
+                self._report(False, email_id)
+            finally:
+                if hasattr(msg_content, 'close'):
+                    msg_content.close()
+
+    def _save_in_process(self, email_id: bytes, msg_content: Union[bytes, str, BinaryIO]) -> int:
+        """把邮件原文写入临时文件交给子进程保存，返回附件数量"""
+        fd, path = tempfile.mkstemp(prefix='mail-', suffix='.eml')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if hasattr(msg_content, 'read'):
+                    msg_content.seek(0)
+                    shutil.copyfileobj(msg_content, f, EmailDownload.CHUNK_SIZE)
+                else:
+                    f.write(msg_content if isinstance(msg_content, bytes) else msg_content.encode())
+            # 状态回调可能绑定在界面上，不能也不需要传给子进程
+            options = replace(self.options, on_status=None)
+            planned = DownloadPlan.lookup(self.email_address, email_id, self.mailbox)
+            result = self._pool.submit(
+                SavePipeline._process_message, path, email_id, self.email_address, options, self.mailbox, planned
+            ).result()
+        finally:
+            os.unlink(path)
+        # 子进程中的指标和运行报告不会传回，在这里补记
+        RunReport.record('process_save', result['seconds'], result['bytes'])
+        Metrics.inc('attachments_saved_total', result['attachments'])
+        AttachmentStore.record(result['deduplicated'], result['bytes_saved'])
+        return result['attachments']
+
+    @staticmethod
+    def _process_message(
+        path: str,
+        email_id: bytes,
+        email_address: str,
+        options: DownloadOptions,
+        mailbox: str,
+        planned: Optional[Tuple[str, str]]
+    ) -> Dict[str, Any]:
+        """在子进程中解析并保存一封邮件
+        
+        Args:
+            path: 邮件原文所在的临时文件
+            email_id: 邮件ID
+            email_address: 邮箱地址
+            options: 下载选项
+            mailbox: 邮件所在的文件夹
+            planned: 下载计划中的 (保存路径, 有效主题)，子进程中没有下载进程登记的计划
+            
+        Returns:
+            dict: attachments(附件数量)、bytes(邮件大小)、seconds(耗时)、
+                deduplicated/bytes_saved(附件去重的数量和节省的字节数)
+        """
+        started = time.perf_counter()
+        deduplicated, bytes_saved = AttachmentStore.totals()
+        plan = DownloadPlan(email_address, mailbox=mailbox)
+        if planned:
+            plan.add(int(email_id), directory=planned)
+        with plan.activate(), open(path, 'rb') as source:
+            size = os.fstat(source.fileno()).st_size
+            # 大邮件按下载进程中的规则流式处理
+            content = source if size > SpoolingIMAP4_SSL.SPOOL_THRESHOLD else source.read()
+            attachments = EmailDownload._save_message(email_id, content, email_address, options, mailbox)
+        total_deduplicated, total_saved = AttachmentStore.totals()
+        return {
+            'attachments': attachments,
+            'bytes': size,
+            'seconds': time.perf_counter() - started,
+            'deduplicated': total_deduplicated - deduplicated,
+            'bytes_saved': total_saved - bytes_saved
+        }
+
+
+class AsyncIMAPClient:
+    """基于asyncio的最小IMAP4rev1客户端
+    
+    只实现下载流程需要的命令(LOGIN/SELECT/UID/LOGOUT)。同一连接上可以连续发送
+    多条命令而不等待前一条完成(流水线)；服务器按顺序处理命令，但可能在前一条命令完成前
+    就开始返回后续命令的数据，因此FETCH响应按其中的UID分给请求了该UID的UID FETCH命令，
+    其他无标签响应归属于最早未完成的命令。返回数据的格式与imaplib一致，可直接交给
+    Tools.parse_fetch_response；超过SPOOL_THRESHOLD的字面量同样暂存到临时文件。
+    """
+
+    LINE_LIMIT = 16 * 1024 * 1024
+    _LITERAL_RE = re.compile(rb'\{(\d+)\}\r?\n$')
+    _UNTAGGED_RE = re.compile(rb'\* (?:(\d+) )?([A-Za-z-]+)(?: (.*))?$', re.S)
+    _FETCH_UID_RE = re.compile(rb'\bUID (\d+)')
+
+    class _Literal:
+        """以同步字面量发送的命令参数(用于含非ASCII字符的用户名、密码)"""
+
+        def __init__(self, data: bytes):
+            self.data = data
+
+    class _Command:
+        def __init__(self, tag: str, future: asyncio.Future, uids: Optional[UIDSet] = None):
+            self.tag = tag
+            self.future = future
+            self.uids = uids  # UID FETCH请求的UID，用于分配FETCH响应
+            self.responses: Dict[str, List[Any]] = {}
+
+    def __init__(self, host: str, port: int = 993, timeout: float = 30, use_ssl: bool = True):
+        """初始化
+        
+        Args:
+            host: IMAP服务器地址
+            port: 端口
+            timeout: 等待服务器响应的超时时间(秒)
+            use_ssl: 是否使用SSL(只有本地测试服务器才会关闭)
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.use_ssl = use_ssl
+        self.uidvalidity: Optional[int] = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._tags = itertools.count(1)
+        self._commands: collections.deque = collections.deque()
+        self._send_lock = asyncio.Lock()
+        self._continuation: Optional[asyncio.Future] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._error: Optional[BaseException] = None
+
+    async def connect(self) -> None:
+        """建立SSL连接并读取服务器问候"""
+        context = (EmailDownload.SSL_CONTEXT or ssl.create_default_context()) if self.use_ssl else None
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context, limit=self.LINE_LIMIT),
+            self.timeout
+        )
+        greeting = await asyncio.wait_for(self._reader.readline(), self.timeout)
+        if not greeting.startswith((b'* OK', b'* PREAUTH')):
+            raise ConnectionError(f"IMAP服务器问候异常: {greeting!r}")
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+
+    async def login(self, user: str, password: str) -> None:
+        status, data = await self.command('LOGIN', self._quote(user), self._quote(password))
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"登录失败: {data}")
+
+    async def select(self, mailbox: str = "INBOX") -> None:
+        """选中邮箱文件夹并记录UIDVALIDITY"""
+        status, data = await self.command('SELECT', self._quote(mailbox))
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"选择邮箱 {mailbox} 失败: {data}")
+        for item in data.get('OK', []):
+            match = re.search(rb'\[UIDVALIDITY (\d+)\]', item if isinstance(item, bytes) else item[0])
+            if match:
+                self.uidvalidity = int(match.group(1))
+
+    async def uid(self, command: str, *args: str) -> Tuple[str, List[Any]]:
+        """发送UID命令
+        
+        Returns:
+            (状态, 数据列表)，与imaplib.IMAP4.uid的返回值格式相同
+        """
+        uids = UIDSet.parse(args[0]) if command.upper() == 'FETCH' and args else None
+        status, data = await self.command('UID', command, *args, uids=uids)
+        name = 'FETCH' if command.upper() in ('FETCH', 'STORE') else command.upper()
+        return status, data.get(name, []) if status == 'OK' else data.get(status, [])
+
+    async def logout(self) -> None:
+        """注销并关闭连接，忽略关闭过程中的错误"""
+        try:
+            if self._error is None and self._writer is not None:
+                await asyncio.wait_for(self.command('LOGOUT'), self.timeout)
+        except Exception as e:
+            logger.debug(f"注销IMAP连接时出错: {e}")
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                # 等待连接真正关闭后再归还名额，否则服务器可能仍把它计入连接数
+                await asyncio.wait_for(self._writer.wait_closed(), self.timeout)
+            except Exception as e:
+                logger.debug(f"关闭IMAP连接时出错: {e}")
+
+    async def command(
+        self, name: str, *args: Any, uids: Optional[UIDSet] = None
+    ) -> Tuple[str, Dict[str, List[Any]]]:
+        """发送一条带标签的命令并等待其完成
+        
+        Args:
+            name: 命令名
+            *args: 命令参数
+            uids: UID FETCH请求的UID集合，携带这些UID的FETCH响应归属于本命令
+        
+        Returns:
+            (状态, 按类型分组的无标签响应)
+        """
+        if self._error is not None:
+            raise ConnectionError(f"IMAP连接已断开: {self._error}")
+        tag = f"A{next(self._tags):04d}"
+        command = self._Command(tag, asyncio.get_running_loop().create_future(), uids)
+        async with self._send_lock:
+            self._commands.append(command)
+            try:
+                self._writer.write(f"{tag} {name}".encode())
+                for arg in args:
+                    if isinstance(arg, self._Literal):
+                        self._continuation = asyncio.get_running_loop().create_future()
+                        self._writer.write(f" {{{len(arg.data)}}}\r\n".encode())
+                        await self._writer.drain()
+                        await asyncio.wait_for(self._continuation, self.timeout)
+                        self._writer.write(arg.data)
+                    else:
+                        self._writer.write(b' ' + arg.encode())
+                self._writer.write(b'\r\n')
+                await self._writer.drain()
+            except BaseException:
+                # 发送失败时不再等待结果，避免连接断开后future的异常无人读取
+                command.future.cancel()
+                raise
+        return await command.future
+
+    @classmethod
+    def _quote(cls, value: str) -> Any:
+        if value.isascii() and '\r' not in value and '\n' not in value:
+            return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        return cls._Literal(value.encode('utf-8'))
+
+    async def _readline(self) -> bytes:
+        # 只在有命令等待响应时限制超时，空闲连接可以一直等待
+        timeout = self.timeout if self._commands else None
+        line = await asyncio.wait_for(self._reader.readline(), timeout)
+        if not line:
+            raise ConnectionError("服务器关闭了连接")
+        return line
+
+    async def _read_literal(self, size: int) -> Union[bytes, BinaryIO]:
+        if size <= SpoolingIMAP4_SSL.SPOOL_THRESHOLD:
+            return await self._reader.readexactly(size)
+        spool = tempfile.TemporaryFile()
+        remaining = size
+        while remaining:
+            chunk = await asyncio.wait_for(
+                self._reader.readexactly(min(remaining, EmailDownload.CHUNK_SIZE)), self.timeout
+            )
+            spool.write(chunk)
+            remaining -= len(chunk)
+        spool.seek(0)
+        return spool
+
+    async def _read_loop(self) -> None:
+        """读取服务器响应并分发给等待中的命令"""
+        try:
+            while True:
+                line = await self._readline()
+                if line.startswith(b'* '):
+                    await self._handle_untagged(line)
+                elif line.startswith(b'+'):
+                    if self._continuation is not None and not self._continuation.done():
+                        self._continuation.set_result(line)
+                else:
+                    tag, _, rest = line.rstrip(b'\r\n').partition(b' ')
+                    status, _, text = rest.partition(b' ')
+                    command = self._commands.popleft() if self._commands else None
+                    if command is None or command.tag != tag.decode(errors='replace'):
+                        raise imaplib.IMAP4.abort(f"意外的标签响应: {line!r}")
+                    if status.upper() != b'OK':
+                        command.responses.setdefault(status.upper().decode(), []).append(text)
+                    if not command.future.done():
+                        command.future.set_result((status.upper().decode(), command.responses))
+        except asyncio.CancelledError:
+            self._fail(ConnectionError("连接已关闭"))
+        except Exception as e:
+            self._fail(e)
+
+    async def _handle_untagged(self, line: bytes) -> None:
+        items = []
+        while True:
+            match = self._LITERAL_RE.search(line)
+            if not match:
+                items.append(line.rstrip(b'\r\n'))
+                break
+            literal = await self._read_literal(int(match.group(1)))
+            items.append((line.rstrip(b'\r\n'), literal))
+            line = await self._readline()
+
+        # 与imaplib一致：去掉"* "和响应类型，序号与其余内容以空格连接
+        first = items[0][0] if isinstance(items[0], tuple) else items[0]
+        match = self._UNTAGGED_RE.match(first)
+        if not match:
+            return
+        number, name, rest = match.groups()
+        head = b' '.join(x for x in (number, rest) if x is not None)
+        items[0] = (head, items[0][1]) if isinstance(items[0], tuple) else head
+        if name.upper() == b'BYE':
+            logger.debug(f"IMAP服务器断开连接: {head!r}")
+        if self._commands:
+            self._route(name.upper(), first).responses.setdefault(name.upper().decode(), []).extend(items)
+
+    def _route(self, name: bytes, first: bytes) -> '_Command':
+        """找出无标签响应所属的命令: FETCH响应按UID匹配，其余归属于最早未完成的命令"""
+        if name == b'FETCH':
+            match = self._FETCH_UID_RE.search(first)
+            if match:
+                uid = int(match.group(1))
+                for command in self._commands:
+                    if command.uids is not None and uid in command.uids:
+                        return command
+        return self._commands[0]
+
+    def _fail(self, error: BaseException) -> None:
+        self._error = error
+        while self._commands:
+            command = self._commands.popleft()
+            if not command.future.done():
+                command.future.set_exception(ConnectionError(f"IMAP连接已断开: {error}"))
+
+
+class AsyncDownloadEngine:
+    """asyncio下载引擎
+    
+    在一个事件循环中为每个账号维护多条IMAP连接，每条连接上以流水线方式同时发出
+    多条UID FETCH命令；取回的邮件交给SavePipeline解析和保存，网络等待不占用线程。
+    每个引擎只下载一个账号的一个文件夹；多账号下载(AccountScheduler)时各账号的引擎分别运行在
+    自己的线程和事件循环中，连接经由各自连接池的reserve()占用同一个ConnectionBudget，
+    因此imap_servers.json中各服务器的连接数限制同样生效。
+    
+    给出连接池时，每条连接建立前通过IMAPConnectionPool.reserve()占用名额，与线程引擎及
+    同一账号的其他文件夹共用连接数上限和多账号预算；给出并发控制器时，编号不小于其当前上限的
+    连接暂停，FETCH的耗时和错误同样计入控制器。批次从生成器中按需取出，不会一次展开。
+    
+    Attributes:
+        CONNECTIONS (int): 每个账号的并发连接数
+        PIPELINE_DEPTH (int): 每条连接上同时在途的UID FETCH命令数
+        PAUSE_INTERVAL (float): 连接因并发上限下调而暂停时，重新检查上限的间隔(秒)
+    """
+
+    CONNECTIONS = 8
+    PIPELINE_DEPTH = 3
+    PAUSE_INTERVAL = 0.5
+
+    _NETWORK_ERRORS = (ConnectionError, OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, imaplib.IMAP4.abort)
+
+    def __init__(
+        self,
+        email_address: str,
+        password: str,
+        connections: Optional[int] = None,
+        pipeline_depth: Optional[int] = None,
+        executor: Optional[ThreadPoolExecutor] = None,
+        mailbox: str = "INBOX",
+        pool: Optional[IMAPConnectionPool] = None,
+        controller: Optional[ConcurrencyController] = None
+    ):
+        """初始化
+        
+        Args:
+            email_address: 邮箱地址
+            password: 邮箱密码
+            connections: 并发连接数，默认为CONNECTIONS
+            pipeline_depth: 每条连接的流水线深度，默认为PIPELINE_DEPTH
+            executor: 向SavePipeline交付邮件使用的线程池(流水线写满时在其中阻塞)，默认新建MAX_WORKERS个线程
+            mailbox: 下载的文件夹
+            pool: 占用连接名额和预算的连接池，为None时不限制
+            controller: 并发控制器，为None时始终使用connections条连接
+        """
+        self.email_address = email_address
+        self.mailbox = mailbox
+        self.password = password
+        self.connections = connections or self.CONNECTIONS
+        self.pipeline_depth = pipeline_depth or self.PIPELINE_DEPTH
+        self.executor = executor
+        self.pool = pool
+        self.controller = controller
+        self._alive: Set[int] = set()  # 仍在运行的连接编号
+
+    def run(
+        self,
+        batches: Iterable[List[bytes]],
+        options: DownloadOptions,
+        progress_callback: Optional[Callable[[bool, Optional[bytes]], None]] = None
+    ) -> int:
+        """在新的事件循环中下载所有批次
+        
+        Returns:
+            int: 保存的附件数量
+        """
+        return asyncio.run(self.download(batches, options, progress_callback))
+
+    class _BatchFeed:
+        """按需从批次生成器中取出批次，需要重试的批次优先(只在事件循环中使用，无需加锁)"""
+
+        def __init__(self, batches: Iterable[List[bytes]]):
+            self._batches = iter(batches)
+            self._retry: collections.deque = collections.deque()
+
+        def pop(self) -> Optional[Tuple[List[bytes], int]]:
+            """取出 (批次, 已尝试次数)，没有剩余批次时返回None"""
+            if self._retry:
+                return self._retry.popleft()
+            batch = next(self._batches, None)
+            return None if batch is None else (batch, 0)
+
+        def push(self, batch: List[bytes], attempt: int) -> None:
+            """放回一个需要重试的批次"""
+            self._retry.append((batch, attempt))
+
+        def empty(self) -> bool:
+            if self._retry:
+                return False
+            batch = next(self._batches, None)
+            if batch is None:
+                return True
+            self._batches = itertools.chain([batch], self._batches)
+            return False
+
+    async def download(
+        self,
+        batches: Iterable[List[bytes]],
+        options: DownloadOptions,
+        progress_callback: Optional[Callable[[bool, Optional[bytes]], None]] = None
+    ) -> int:
+        """下载所有批次(协程)
+        
+        Returns:
+            int: 保存的附件数量
+        """
+        feed = self._BatchFeed(batches)
+        self._alive = set(range(self.connections))
+        executor = self.executor or ThreadPoolExecutor(max_workers=EmailDownload.MAX_WORKERS)
+        # 连接池和并发控制器的方法会阻塞(等待名额、注销多余连接)，在单独的线程中调用；
+        # 每条连接最多有一个线程在等待名额，多留一个线程给控制器，不会互相占满
+        control = ThreadPoolExecutor(max_workers=self.connections + 1, thread_name_prefix='imap-control')
+        try:
+            with SavePipeline(self.email_address, options, progress_callback, self.mailbox) as pipeline:
+                counts = await asyncio.gather(*(
+                    self._connection_worker(index, feed, options, progress_callback, executor, control, pipeline)
+                    for index in range(self.connections)
+                ))
+        finally:
+            control.shutdown(wait=True)
+            if executor is not self.executor:
+                executor.shutdown(wait=True)
+
+        # 所有连接都无法建立时剩余的批次逐封记为失败，与download_batch一致
+        while True:
+            item = feed.pop()
+            if item is None:
+                break
+            self._report_failed(item[0], progress_callback)
+        return sum(counts) + pipeline.attachment_count
+
+    async def _connect(self) -> AsyncIMAPClient:
+        domain = self.email_address.split("@")[1]
+        host, port, use_ssl = EmailDownload.server_address(EmailDownload.get_imap_server(domain))
+        client = AsyncIMAPClient(host, port, use_ssl=use_ssl)
+        try:
+            with RunReport.phase('connect'):
+                await client.connect()
+            with RunReport.phase('login'):
+                await client.login(self.email_address, self.password)
+            with RunReport.phase('select'):
+                await client.select(self.mailbox)
+        except BaseException:
+            await client.logout()
+            raise
+        return client
+
+    async def _connection_worker(
+        self,
+        index: int,
+        feed: '_BatchFeed',
+        options: DownloadOptions,
+        progress_callback: Optional[Callable],
+        executor: ThreadPoolExecutor,
+        control: ThreadPoolExecutor,
+        pipeline: 'SavePipeline'
+    ) -> int:
+        """维护第index条连接，连接断开后自动重连，直到没有剩余批次或连续多次连接失败
+        
+        因并发上限下调而暂停的连接在编号更小的连接全部退出后也随之退出
+        (例如服务器拒绝连接时，编号小的连接重试失败退出，上限已降到最低)，剩余批次由download()记为失败。
+        """
+        try:
+            return await self._run_connection(index, feed, options, progress_callback, executor, control, pipeline)
+        finally:
+            self._alive.discard(index)
+
+    async def _run_connection(
+        self,
+        index: int,
+        feed: '_BatchFeed',
+        options: DownloadOptions,
+        progress_callback: Optional[Callable],
+        executor: ThreadPoolExecutor,
+        control: ThreadPoolExecutor,
+        pipeline: 'SavePipeline'
+    ) -> int:
+        loop = asyncio.get_running_loop()
+        attachment_count = 0
+        failures = 0
+        while not feed.empty() and failures < EmailDownload.MAX_RETRIES:
+            if self.controller and index >= self.controller.limit:
+                if not any(other < index for other in self._alive):
+                    break
+                await asyncio.sleep(self.PAUSE_INTERVAL)  # 并发上限已下调，本连接暂停
+                continue
+            if self.pool is not None:
+                await loop.run_in_executor(control, self.pool.reserve)
+            try:
+                if feed.empty():
+                    break  # 等待名额期间其他连接已取完批次
+                try:
+                    client = await self._connect()
+                except Exception as e:
+                    failures += 1
+                    logger.warning(f"建立IMAP连接失败(第 {failures} 次): {e}")
+                    if self.controller:
+                        await loop.run_in_executor(control, self.controller.record_error, e)
+                    await asyncio.sleep(EmailDownload.RETRY_DELAY)
+                    continue
+                failures = 0
+                try:
+                    with Metrics.gauge('connections_open'), Metrics.gauge('connections_active'):
+                        counts = await asyncio.gather(*(
+                            self._pipeline(index, client, feed, options, progress_callback, executor, control, pipeline)
+                            for _ in range(self.pipeline_depth)
+                        ))
+                    attachment_count += sum(counts)
+                finally:
+                    await client.logout()
+            finally:
+                if self.pool is not None:
+                    self.pool.release_reservation()
+        return attachment_count
+
+    async def _pipeline(
+        self,
+        index: int,
+        client: AsyncIMAPClient,
+        feed: '_BatchFeed',
+        options: DownloadOptions,
+        progress_callback: Optional[Callable],
+        executor: ThreadPoolExecutor,
+        control: ThreadPoolExecutor,
+        pipeline: 'SavePipeline'
+    ) -> int:
+        """流水线中的一个槽位：不断取出批次发送UID FETCH，并把结果交给SavePipeline保存"""
+        loop = asyncio.get_running_loop()
+        attachment_count = 0
+        while not (self.controller and index >= self.controller.limit):
+            item = feed.pop()
+            if item is None:
+                break
+            batch, attempt = item
+            Metrics.inc('queue_depth')
+            started = time.monotonic()
+            try:
+                with RunReport.phase('fetch') as sample:
+                    status, data = await client.uid('FETCH', Tools.compress_uids(batch), '(UID RFC822)')
+                    sample['bytes'] = nbytes = Tools.response_size(data)
+            except self._NETWORK_ERRORS as e:
+                Metrics.inc('queue_depth', -1)
+                if self.controller:
+                    await loop.run_in_executor(control, self.controller.record_error, e)
+                if attempt + 1 < EmailDownload.MAX_RETRIES:
+                    Metrics.inc('retries_total')
+                    feed.push(batch, attempt + 1)
+                else:
+                    logger.error(f"批量下载邮件失败(尝试 {EmailDownload.MAX_RETRIES} 次): {e}")
+                    self._report_failed(batch, progress_callback)
+                return attachment_count  # 连接已不可用，由_connection_worker重连
+            Metrics.inc('queue_depth', -1)
+            if status != 'OK':
+                logger.error(f"获取邮件失败: {status} {data}")
+                self._report_failed(batch, progress_callback)
+                continue
+            if self.controller:
+                await loop.run_in_executor(
+                    control, self.controller.record_success, time.monotonic() - started, nbytes
+                )
+            attachment_count += await loop.run_in_executor(
+                executor, self._save_batch, batch, data, options, progress_callback, pipeline
+            )
+        return attachment_count
+
+    def _save_batch(
+        self,
+        batch: List[bytes],
+        data: List[Any],
+        options: DownloadOptions,
+        progress_callback: Optional[Callable],
+        pipeline: Optional['SavePipeline'] = None
+    ) -> int:
+        """在线程池中把一个批次交给流水线(未给出流水线时直接解析并保存)"""
+        pending = {int(email_id): email_id for email_id in batch}
+
+        def report(success: bool, email_id: bytes) -> None:
+            if progress_callback:
+                progress_callback(success, email_id)
+
+        attachment_count = EmailDownload._save_fetched(
+            data, pending, self.email_address, options, report, self.mailbox, pipeline
+        )
+        if pending:
+            logger.warning(f"服务器未返回 {len(pending)} 封邮件，可能已被删除")
+            self._report_failed(list(pending.values()), progress_callback)
+        return attachment_count
+
+    @staticmethod
+    def _report_failed(batch: List[bytes], progress_callback: Optional[Callable]) -> None:
+        if progress_callback:
+            for email_id in batch:
+                progress_callback(False, email_id)
+
+
+class AccountScheduler:
+    """多账号批量下载
+    
+    从accounts.json读取账号列表，所有账号同时下载，连接数由ConnectionBudget统一分配，
+    进度按账号汇总为一个总进度，结束后返回合计的DownloadStats。
+    
+    accounts.json格式:
+        {
+            "max_connections": 16,
+            "accounts": [
+                {"email_address": "a@qq.com", "password": "授权码", "folders": "INBOX", "filter": "has:attachment"}
+            ]
+        }
+    folders和filter可省略，省略时使用下载选项中的文件夹和筛选设置。
+    线程引擎和asyncio引擎的连接都从ConnectionBudget中申请，同一服务器的连接数不超过其限制。
+    设置 "metrics_port" 时在该端口启动指标导出服务(见Metrics)，便于长时间运行时监控。
+    
+    Attributes:
+        CONFIG_FILE (str): 账号列表文件
+        MAX_CONNECTIONS (int): 配置文件未指定时所有账号合计的最大连接数
+    """
+
+    CONFIG_FILE = 'accounts.json'
+    MAX_CONNECTIONS = 16
+
+    def __init__(
+        self,
+        accounts: List[Dict[str, str]],
+        options: DownloadOptions,
+        progress_signal: ProgressSignal,
+        max_connections: Optional[int] = None
+    ):
+        """初始化
+        
+        Args:
+            accounts: 账号列表，每项包含email_address、password，可选folders
+            options: 下载选项
+            progress_signal: 进度信号对象
+            max_connections: 所有账号合计的最大连接数，默认为MAX_CONNECTIONS
+        """
+        self.accounts = accounts
+        self.options = options
+        self.progress_signal = progress_signal
+        self.max_connections = max_connections or self.MAX_CONNECTIONS
+
+    @staticmethod
+    def from_config(options: DownloadOptions, progress_signal: ProgressSignal, path: Optional[str] = None) -> 'AccountScheduler':
+        """从账号列表文件创建调度器
+        
+        Raises:
+            ValueError: 文件中没有有效账号时抛出
+        """
+        with open(path or AccountScheduler.CONFIG_FILE, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        accounts = [
+            account for account in config.get('accounts', [])
+            if account.get('email_address') and account.get('password')
+        ]
+        if not accounts:
+            raise ValueError(f"{path or AccountScheduler.CONFIG_FILE} 中没有有效的账号")
+        if config.get('metrics_port') is not None:
+            try:
+                Metrics.serve(int(config['metrics_port']))
+            except (OSError, ValueError) as e:
+                logger.warning(f"启动指标导出服务失败: {e}")
+        return AccountScheduler(accounts, options, progress_signal, config.get('max_connections'))
+
+    def run(self) -> DownloadStats:
+        """同时下载所有账号，返回合计的统计信息"""
+        budget = ConnectionBudget(self.max_connections)
+        totals = DownloadStats()
+        logger.info(f"批量下载 {len(self.accounts)} 个账号，最多 {self.max_connections} 个连接")
+        with RunReport.session(), ProgressPublisher(self.progress_signal) as publisher, \
+                ThreadPoolExecutor(max_workers=len(self.accounts)) as executor:
+            futures = {
+                executor.submit(
+                    EmailDownload.download_emails,
+                    account['email_address'], account['password'], self.options, publisher,
+                    budget=budget, folders=account.get('folders'), filters=account.get('filter')
+                ): account['email_address'] for account in self.accounts
+            }
+            for future in as_completed(futures):
+                try:
+                    stats = future.result()
+                except Exception as e:
+                    logger.error(f"账号 {futures[future]} 下载失败: {e}")
+                    continue
+                if stats is None:
+                    logger.error(f"账号 {futures[future]} 下载失败")
+                totals.add(stats)
+        self.options.status('下载完成!')
+        logger.info(
+            f"{len(self.accounts)} 个账号下载完成: 共 {totals.total} 封，"
+            f"成功 {totals.success} 封，失败 {totals.failed} 封"
+        )
+        return totals
+
+
+class MailboxWatcher:
+    """持续监视模式
+    
+    用一条专用连接对文件夹保持IMAP IDLE，收到新邮件通知后以增量同步模式
+    调用download_folder，下载完成后重新进入IDLE。IDLE每IDLE_TIMEOUT秒主动结束并重新发出，
+    以免被服务器的30分钟超时断开；服务器不支持IDLE时每POLL_INTERVAL秒轮询一次
+    (增量同步在邮箱无变化时只需一条STATUS命令)。
+    
+    下载使用的连接池在整个监视期间复用；每轮下载的状态都在download_folder内创建和释放，
+    长时间运行时内存占用不随运行时间增长。连接中断后按指数退避重连。
+    每轮有新邮件的同步各写出一份运行报告(见RunReport)。
+    
+    Attributes:
+        IDLE_TIMEOUT (int): 单次IDLE的最长时间(秒)
+        POLL_INTERVAL (int): 不支持IDLE时的轮询间隔(秒)
+        MAX_RECONNECT_DELAY (int): 重连退避的最大间隔(秒)
+    """
+
+    IDLE_TIMEOUT = 25 * 60
+    POLL_INTERVAL = 60
+    MAX_RECONNECT_DELAY = 300
+
+    def __init__(self, email_address: str, password: str, options: DownloadOptions, progress_signal: ProgressSignal, mailbox: str = "INBOX"):
+        """初始化监视器
+        
+        Args:
+            email_address: 邮箱地址
+            password: 邮箱密码
+            options: 下载选项
+            progress_signal: 进度信号对象
+            mailbox: 监视的文件夹
+        """
+        self.email_address = email_address
+        self.password = password
+        self.options = options
+        self.progress_signal = progress_signal
+        self.mailbox = mailbox
+        self._stop = threading.Event()
+
+    def stop(self) -> None:
+        """请求停止监视，当前的IDLE会在1秒内结束"""
+        self._stop.set()
+
+    def run(self) -> None:
+        """运行监视循环，直到stop()被调用"""
+        server = EmailDownload.get_imap_server(self.email_address.split("@")[1])
+        _, max_connections = EmailDownload.get_server_limits(server)
+        # 监视连接单独占用一个会话，下载连接池相应少用一个
+        with IMAPConnectionPool(self.email_address, self.password, max(max_connections - 1, 1)) as pool:
+            failures = 0
+            while not self._stop.is_set():
+                conn = None
+                try:
+                    conn = PooledConnection(EmailDownload._open_connection(self.email_address, self.password))
+                    conn.select(self.mailbox)
+                    failures = 0
+                    # 先补齐监视开始前(或断线期间)到达的邮件
+                    self._sync(pool)
+                    while not self._stop.is_set():
+                        if self._wait(conn):
+                            self._sync(pool)
+                except Exception as e:
+                    failures += 1
+                    delay = min(EmailDownload.RETRY_DELAY * 2 ** failures, self.MAX_RECONNECT_DELAY)
+                    logger.warning(f"监视连接中断，{delay} 秒后重连: {e}")
+                    self._stop.wait(delay)
+                finally:
+                    if conn:
+                        conn.logout()
+        logger.info(f"已停止监视 {self.email_address}")
+
+    def _wait(self, conn: PooledConnection) -> bool:
+        """等待新邮件，返回是否需要同步"""
+        if 'IDLE' in conn.mail.capabilities:
+            return conn.idle(self.IDLE_TIMEOUT, self._stop)
+        if self._stop.wait(self.POLL_INTERVAL):
+            return False
+        if not conn.noop():
+            raise imaplib.IMAP4.abort("NOOP失败")
+        return True
+
+    def _sync(self, pool: IMAPConnectionPool) -> None:
+        self.options.status('正在同步新邮件')
+        with RunReport.session(skip_empty=True):
+            stats = EmailDownload.download_folder(
+                self.email_address, self.password, self.options, self.progress_signal,
+                self.mailbox, pool=pool, incremental=True
+            )
+            RunReport.add_stats(stats)
+        if not self._stop.is_set():
+            self.options.status('监视中')
+
+
+def _add_download_arguments(parser: argparse.ArgumentParser) -> None:
+    """download和batch共用的下载选项"""
+    parser.add_argument('--folder', action='append', default=None,
+                        help='文件夹筛选模式，可重复指定，以!开头的为排除，默认INBOX')
+    parser.add_argument('--filter', default='', help='邮件筛选规则，如 "from:张三 since:2024-01-01 has:attachment"')
+    parser.add_argument('--no-resume', dest='resume', action='store_false', help='不使用断点续传')
+    parser.add_argument('--html', action='store_true', help='保存HTML正文')
+    parser.add_argument('--seen', action='store_true', help='下载后标记为已读')
+    parser.add_argument('--selective', action='store_true', help='只获取需要的MIME部分')
+    parser.add_argument('--incremental', action='store_true', help='增量同步')
+    parser.add_argument('--engine', choices=('thread', 'asyncio'), default=None, help='下载引擎')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='解析和保存邮件使用的子进程数，多核机器上附件较多时可以加快速度，默认0(不使用子进程)')
+    parser.add_argument('--dedup', action='store_true',
+                        help='附件按内容去重，相同附件只保存一份，各邮件目录中为硬链接(修改其中一个会影响所有副本)')
+    parser.add_argument('--metrics-port', type=int, default=None, help='在该端口启动指标导出服务')
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """命令行入口
+    
+    Returns:
+        int: 退出码，全部下载成功为0，有失败的邮件或下载出错为1
+    """
+    parser = argparse.ArgumentParser(prog='python -m emailCore', description='邮箱下载工具(命令行)')
+    parser.add_argument('--log-file', default='email_downloader.log', help='日志文件')
+    commands = parser.add_subparsers(dest='command', required=True)
+    download = commands.add_parser('download', help='下载一个账号')
+    download.add_argument('--account', required=True, help='邮箱地址')
+    download.add_argument('--password', default=None,
+                          help='IMAP密码(授权码)，默认读取环境变量MAILBOX_PASSWORD，都没有时在终端中输入')
+    _add_download_arguments(download)
+    batch = commands.add_parser('batch', help='按账号列表批量下载')
+    batch.add_argument('--config', default=AccountScheduler.CONFIG_FILE, help='账号列表文件')
+    _add_download_arguments(batch)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.FileHandler(args.log_file, encoding='utf-8'), logging.StreamHandler()]
+    )
+    options = DownloadOptions(
+        folders=','.join(args.folder or ['INBOX']),
+        search_filter=args.filter,
+        resume=args.resume,
+        download_html=args.html,
+        seen_after_download=args.seen,
+        selective_fetch=args.selective,
+        incremental=args.incremental,
+        processes=args.processes,
+        dedup_attachments=args.dedup
+    )
+    if args.engine:
+        EmailDownload.ENGINE = args.engine
+    if args.metrics_port is not None:
+        Metrics.serve(args.metrics_port)
+    progress = ProgressSignal()
+    progress.error_occurred.connect(lambda message: logger.error(message))
+
+    try:
+        if args.command == 'batch':
+            stats = AccountScheduler.from_config(options, progress, args.config).run()
+        else:
+            password = args.password or os.environ.get('MAILBOX_PASSWORD')
+            if not password:
+                if not sys.stdin.isatty():
+                    parser.error('未提供密码: 使用--password或环境变量MAILBOX_PASSWORD')
+                password = getpass.getpass(f'{args.account} 的IMAP密码: ')
+            stats = EmailDownload.download_emails(args.account, password, options, progress)
+    except (OSError, ValueError) as e:
+        logger.error(f"下载失败: {e}")
+        return 1
+    except KeyboardInterrupt:
+        logger.warning("下载已中断")
+        return 130
+    return 0 if stats is not None and not stats.failed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
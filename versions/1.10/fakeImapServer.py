@@ -0,0 +1,1243 @@
+"""本地IMAP测试服务器
+
+在进程内运行的IMAP4rev1服务器，不需要真实邮箱、账号和网络即可测试下载速度、
+重试和断点续传。
+
+功能:
+- 按MailboxSpec生成可复现的邮箱(邮件数量、附件大小、字符集、内嵌邮件层数)
+- 支持SSL(自动生成自签名证书)和不加密两种连接
+- 按NetworkProfile模拟网络(延迟、带宽、连接数上限、随机断线)
+- 实现下载流程用到的命令: LOGIN/LIST/LSUB/SELECT/EXAMINE/STATUS/SEARCH/FETCH/STORE/IDLE，
+  以及ESEARCH和CONDSTORE扩展
+
+用法:
+    with FakeIMAPServer(MailboxSpec(messages=500), network=NetworkProfile(latency=0.05)) as server:
+        EmailDownload.SSL_CONTEXT = server.client_context
+        with open('imap_servers.json', 'w') as f:
+            json.dump(server.server_config('example.com'), f)
+        ...
+
+    python fakeImapServer.py --messages 1000 --port 1993 --latency 0.05
+
+作者: Himalaya
+"""
+
+import argparse
+import base64
+import bisect
+import email
+import email.header
+import email.policy
+import email.utils
+import logging
+import math
+import os
+import random
+import re
+import select
+import shutil
+import socket
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from email.mime.application import MIMEApplication
+from email.mime.message import MIMEMessage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.parser import BytesParser
+from typing import Optional, Tuple, Dict, List, Union, Callable, Any, Iterable, Sequence, Set
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class MailboxSpec:
+    """生成邮箱内容的参数，相同参数总是生成相同的邮件
+    
+    Attributes:
+        messages: 每个文件夹的邮件数量
+        folders: 文件夹名称(可以包含中文和"/"分隔的层级)
+        attachment_counts: 每封邮件的附件数量，从中均匀抽取
+        attachment_size: 附件大小的上下限(字节)，在对数尺度上均匀分布
+        charsets: 正文和邮件头使用的字符集，从中均匀抽取
+        nesting: 内嵌转发邮件(message/rfc822)的最大层数
+        html_ratio: 带HTML正文(multipart/alternative)的邮件比例
+        seen_ratio: 已读邮件的比例
+        seed: 随机数种子
+    """
+    messages: int = 100
+    folders: Sequence[str] = ('INBOX',)
+    attachment_counts: Sequence[int] = (0, 0, 1, 1, 2)
+    attachment_size: Tuple[int, int] = (1024, 512 * 1024)
+    charsets: Sequence[str] = ('utf-8', 'gbk', 'us-ascii')
+    nesting: int = 1
+    html_ratio: float = 0.5
+    seen_ratio: float = 0.0
+    seed: int = 0
+
+
+@dataclass
+class NetworkProfile:
+    """模拟的网络状况
+    
+    Attributes:
+        latency: 每条命令的往返延迟(秒)
+        bandwidth: 每个连接的下行带宽(字节/秒)，None为不限制
+        max_connections: 同时在线的连接数上限，超出时以BYE拒绝，None为不限制
+        disconnect_rate: 每条命令随机断开连接的概率；FETCH会在响应中途断开
+        seed: 随机断线使用的随机数种子
+    """
+    latency: float = 0.0
+    bandwidth: Optional[int] = None
+    max_connections: Optional[int] = None
+    disconnect_rate: float = 0.0
+    seed: int = 0
+
+
+@dataclass
+class FakeMessage:
+    uid: int
+    raw: bytes
+    flags: Set[str] = field(default_factory=set)
+    internaldate: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+    modseq: int = 1
+    _tree: Optional['_MimePart'] = field(default=None, repr=False)
+
+    @property
+    def tree(self) -> '_MimePart':
+        if self._tree is None:
+            self._tree = _MimePart(self.raw)
+        return self._tree
+
+
+class FakeFolder:
+    """服务器上的一个文件夹，邮件按UID升序保存，只追加不删除"""
+
+    def __init__(self, name: str, uidvalidity: int):
+        self.name = name
+        self.wire_name = _encode_folder_name(name)
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.modseq = 1
+        self.messages: List[FakeMessage] = []
+        self.uids: List[int] = []
+
+    def append(self, raw: bytes, flags: Iterable[str] = (), internaldate: Optional[datetime] = None) -> FakeMessage:
+        message = FakeMessage(self.uidnext, raw, set(flags), internaldate or datetime.now(timezone.utc), self.modseq)
+        self.uidnext += 1
+        self.messages.append(message)
+        self.uids.append(message.uid)
+        return message
+
+    def select(self, ranges: List[Tuple[int, int]], uid: bool) -> List[Tuple[int, FakeMessage]]:
+        """返回序列集合选中的 (序号, 邮件)，按序号升序"""
+        count = len(self.messages)
+        picked: Set[int] = set()
+        for start, end in ranges:
+            if uid:
+                lo = bisect.bisect_left(self.uids, start, 0, count)
+                hi = bisect.bisect_right(self.uids, end, 0, count)
+            else:
+                lo, hi = max(start, 1) - 1, min(end, count)
+            picked.update(range(lo, hi))
+        return [(index + 1, self.messages[index]) for index in sorted(picked)]
+
+
+class _MimePart:
+    """按原始字节切分的MIME结构，各部分的大小和内容与RFC822原文完全一致"""
+
+    def __init__(self, raw: bytes):
+        match = re.match(rb'\r?\n', raw) or re.search(rb'\r?\n\r?\n', raw)
+        split = match.end() if match else len(raw)
+        self.header = raw[:split]
+        self.body = raw[split:]
+        self.headers = BytesParser(policy=email.policy.compat32).parsebytes(self.header, headersonly=True)
+        self.content_type = self.headers.get_content_type()
+        self.children: List['_MimePart'] = []
+        if self.headers.get_content_maintype() == 'multipart':
+            boundary = self.headers.get_param('boundary')
+            if boundary:
+                self.children = [_MimePart(part) for part in self._split(self.body, boundary.encode('ascii', 'replace'))]
+        elif self.content_type == 'message/rfc822':
+            self.children = [_MimePart(self.body)]
+
+    @property
+    def is_multipart(self) -> bool:
+        return self.headers.get_content_maintype() == 'multipart'
+
+    @staticmethod
+    def _split(body: bytes, boundary: bytes) -> List[bytes]:
+        delimiter = re.compile(rb'(?:^|\r?\n)--' + re.escape(boundary) + rb'(--)?[ \t]*(?:\r?\n|$)')
+        parts = []
+        start = None
+        for match in delimiter.finditer(body):
+            if start is not None:
+                parts.append(body[start:match.start()])
+            if match.group(1):
+                break
+            start = match.end()
+        return parts
+
+    def find(self, numbers: List[int]) -> '_MimePart':
+        """按IMAP分段编号(如[2, 1])找到对应的部分"""
+        node, in_message = self, True
+        for number in numbers:
+            if node.content_type == 'message/rfc822' and not in_message:
+                node, in_message = node.children[0], True
+            if node.is_multipart:
+                if not 0 < number <= len(node.children):
+                    raise ValueError(f"no such part: {number}")
+                node, in_message = node.children[number - 1], False
+            elif in_message and number == 1:
+                in_message = False
+            else:
+                raise ValueError(f"no such part: {number}")
+        return node
+
+
+class _Disconnect(Exception):
+    """模拟断线时用于结束会话"""
+
+
+class FakeIMAPServer:
+    """在后台线程中运行的IMAP4rev1测试服务器
+    
+    Attributes:
+        CAPABILITIES (tuple): 默认声明的服务器能力
+        folders: 文件夹名称到FakeFolder的映射
+        stats: 运行统计(连接数、峰值连接数、各命令次数、发送字节数、断线和拒绝次数)
+        client_context: 信任本服务器自签名证书的客户端SSL上下文(不加密时为None)
+    """
+
+    CAPABILITIES = ('IMAP4rev1', 'IDLE', 'ESEARCH', 'CONDSTORE', 'ENABLE', 'UNSELECT')
+
+    _contexts: Dict[str, Tuple[ssl.SSLContext, ssl.SSLContext]] = {}
+    _contexts_lock = threading.Lock()
+
+    def __init__(
+        self,
+        mailbox: Optional[MailboxSpec] = None,
+        users: Optional[Dict[str, str]] = None,
+        network: Optional[NetworkProfile] = None,
+        use_ssl: bool = True,
+        host: str = '127.0.0.1',
+        port: int = 0,
+        capabilities: Optional[Iterable[str]] = None
+    ):
+        """初始化并生成邮箱内容
+        
+        Args:
+            mailbox: 邮箱内容参数，默认为MailboxSpec()
+            users: 允许登录的 {用户名: 密码}，为None时接受任意账号
+            network: 网络状况，默认为不受限的本地连接
+            use_ssl: 是否使用SSL
+            host: 监听地址
+            port: 监听端口，0为自动分配
+            capabilities: 声明的服务器能力，默认为CAPABILITIES
+        """
+        self.spec = mailbox or MailboxSpec()
+        self.users = users
+        self.network = network or NetworkProfile()
+        self.use_ssl = use_ssl
+        self.host = host
+        self.port = port
+        self.capabilities = tuple(capabilities or self.CAPABILITIES)
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.stats: Dict[str, Any] = {
+            'connections': 0, 'active': 0, 'peak': 0, 'rejected': 0,
+            'disconnects': 0, 'bytes_sent': 0, 'commands': Counter()
+        }
+        self.server_context: Optional[ssl.SSLContext] = None
+        self.client_context: Optional[ssl.SSLContext] = None
+        self._random = random.Random(self.network.seed)
+        self._server: Optional[socketserver.ThreadingTCPServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self._sessions: Set['_IMAPHandler'] = set()
+
+        self.folders: Dict[str, FakeFolder] = {}
+        for index, name in enumerate(self.spec.folders):
+            folder = FakeFolder(name, 1000 + index)
+            for number in range(self.spec.messages):
+                self._generate(folder, number)
+            self.folders[folder.wire_name] = folder
+
+    def __enter__(self) -> 'FakeIMAPServer':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    @property
+    def url(self) -> str:
+        """供imap_servers.json使用的服务器地址"""
+        return f"{'imaps' if self.use_ssl else 'imap'}://{self.host}:{self.port}"
+
+    def server_config(self, *domains: str, max_connections: Optional[int] = None) -> Dict[str, Any]:
+        """生成把指定邮箱域名指向本服务器的imap_servers.json内容"""
+        limit = max_connections or self.network.max_connections or 8
+        return {
+            'servers': {domain: self.url for domain in domains},
+            'limits': {self.url: {'min_connections': 1, 'max_connections': limit}}
+        }
+
+    def start(self) -> 'FakeIMAPServer':
+        if self.use_ssl and self.server_context is None:
+            self.server_context, self.client_context = self.create_ssl_contexts(self.host)
+        self._server = _ThreadingServer((self.host, self.port), _IMAPHandler)
+        self._server.fake = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='FakeIMAPServer', daemon=True)
+        self._thread.start()
+        logger.info(f"测试IMAP服务器已启动: {self.url}")
+        return self
+
+    def stop(self) -> None:
+        """停止监听并断开所有连接"""
+        if not self._server:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        with self.lock:
+            sessions = list(self._sessions)
+            self.changed.notify_all()
+        for session in sessions:
+            session.close()
+        self._thread.join(timeout=5)
+        self._server = None
+
+    def deliver(self, folder: str = 'INBOX', count: int = 1) -> List[int]:
+        """向文件夹投递新邮件(正在IDLE的连接会收到EXISTS)
+        
+        Returns:
+            list: 新邮件的UID
+        """
+        with self.lock:
+            target = self.folders[_encode_folder_name(folder)]
+            uids = [self._generate(target, len(target.messages)).uid for _ in range(count)]
+            self.changed.notify_all()
+        return uids
+
+    def disconnect_all(self) -> None:
+        """立即断开所有连接(模拟服务器重启)"""
+        with self.lock:
+            sessions = list(self._sessions)
+        for session in sessions:
+            session.close()
+
+    def find_folder(self, name: str) -> Optional[FakeFolder]:
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        return self.folders.get(name)
+
+    def should_disconnect(self) -> bool:
+        if self.network.disconnect_rate <= 0:
+            return False
+        with self.lock:
+            return self._random.random() < self.network.disconnect_rate
+
+    def random_cut(self) -> int:
+        with self.lock:
+            return self._random.randint(0, 64 * 1024)
+
+    @staticmethod
+    def create_ssl_contexts(host: str = '127.0.0.1') -> Tuple[ssl.SSLContext, ssl.SSLContext]:
+        """用openssl生成自签名证书
+        
+        Returns:
+            (服务器端上下文, 信任该证书的客户端上下文)
+        """
+        with FakeIMAPServer._contexts_lock:
+            if host in FakeIMAPServer._contexts:
+                return FakeIMAPServer._contexts[host]
+            directory = tempfile.mkdtemp(prefix='fakeimap-')
+            try:
+                cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+                san = f"IP:{host},DNS:localhost" if re.fullmatch(r'[\d.]+|[0-9a-fA-F:]+', host) else f"DNS:{host}"
+                subprocess.run(
+                    ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2',
+                     '-subj', '/CN=localhost', '-addext', f'subjectAltName={san}', '-keyout', key, '-out', cert],
+                    check=True, capture_output=True
+                )
+                server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+                server_context.load_cert_chain(cert, key)
+                client_context = ssl.create_default_context(cafile=cert)
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+            FakeIMAPServer._contexts[host] = (server_context, client_context)
+            return server_context, client_context
+
+    def _generate(self, folder: FakeFolder, number: int) -> FakeMessage:
+        rng = random.Random(f"{self.spec.seed}:{folder.name}:{number}")
+        date = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(hours=number)
+        message = _build_message(rng, self.spec, number, self.spec.nesting, date)
+        message['Message-ID'] = f"<{number}.{folder.uidvalidity}@fake.invalid>"
+        raw = message.as_bytes(policy=email.policy.compat32.clone(linesep='\r\n'))
+        flags = {'\\Seen'} if rng.random() < self.spec.seen_ratio else set()
+        return folder.append(raw, flags, date)
+
+    def _register(self, session: '_IMAPHandler') -> bool:
+        with self.lock:
+            limit = self.network.max_connections
+            if limit is not None and self.stats['active'] >= limit:
+                self.stats['rejected'] += 1
+                return False
+            self._sessions.add(session)
+            self.stats['connections'] += 1
+            self.stats['active'] += 1
+            self.stats['peak'] = max(self.stats['peak'], self.stats['active'])
+            return True
+
+    def _unregister(self, session: '_IMAPHandler') -> None:
+        with self.lock:
+            if session in self._sessions:
+                self._sessions.discard(session)
+                self.stats['active'] -= 1
+
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    fake: FakeIMAPServer
+
+
+class _IMAPHandler(socketserver.BaseRequestHandler):
+    """一条客户端连接上的IMAP会话"""
+
+    LINE_LIMIT = 1024 * 1024
+    CHUNK_SIZE = 16 * 1024
+    _LITERAL_RE = re.compile(rb'\{(\d+)(\+?)\}\r?\n$')
+
+    server: _ThreadingServer
+
+    def setup(self) -> None:
+        self.fake = self.server.fake
+        self.folder: Optional[FakeFolder] = None
+        self.readonly = False
+        self.exists = 0
+        self.authenticated = False
+        self.closed = False
+        self._ready = time.monotonic()
+        self._cut: Optional[int] = None
+        self.rfile = None
+
+    def handle(self) -> None:
+        try:
+            if self.fake.use_ssl:
+                self.request = self.fake.server_context.wrap_socket(self.request, server_side=True)
+        except (OSError, ssl.SSLError):
+            return self.close()
+        if not self.fake._register(self):
+            try:
+                self._write_raw(b'* BYE [UNAVAILABLE] Too many connections\r\n')
+            except OSError:
+                pass
+            return self.close()
+        try:
+            self.rfile = self.request.makefile('rb')
+            capabilities = ' '.join(self.fake.capabilities)
+            self._send(f'* OK [CAPABILITY {capabilities}] Fake IMAP server ready\r\n'.encode())
+            while not self.closed:
+                command = self._read_command()
+                if command is None:
+                    break
+                self._dispatch(*command)
+        except _Disconnect:
+            with self.fake.lock:
+                self.fake.stats['disconnects'] += 1
+        except (OSError, ValueError, ssl.SSLError):
+            pass
+        finally:
+            self.fake._unregister(self)
+            self.close()
+
+    def close(self) -> None:
+        self.closed = True
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.request.close()
+        except OSError:
+            pass
+
+    # ---- 读取与解析命令 ----
+
+    def _read_command(self) -> Optional[Tuple[str, str, List[Any]]]:
+        text, literals = [], []
+        while True:
+            line = self.rfile.readline(self.LINE_LIMIT)
+            if not line:
+                return None
+            match = self._LITERAL_RE.search(line)
+            if not match:
+                text.append(line.rstrip(b'\r\n'))
+                break
+            text.append(line[:match.start()] + b'\x00' + str(len(literals)).encode() + b'\x00')
+            if not match.group(2):
+                self._send(b'+ Ready for literal data\r\n')
+            literals.append(self.rfile.read(int(match.group(1))))
+        try:
+            tokens = _tokenize(b''.join(text).decode('utf-8', 'replace'), literals)
+        except (ValueError, IndexError):
+            tokens = []
+        if len(tokens) < 2 or not isinstance(tokens[0], str) or not isinstance(tokens[1], str):
+            self._send(b'* BAD Invalid command\r\n')
+            return '', '', []
+        return tokens[0], tokens[1].upper(), tokens[2:]
+
+    def _dispatch(self, tag: str, name: str, args: List[Any]) -> None:
+        if not tag:
+            return
+        uid = name == 'UID'
+        if uid:
+            if not args:
+                return self._tagged(tag, 'BAD', 'UID requires a command')
+            name, args = str(args[0]).upper(), args[1:]
+        with self.fake.lock:
+            self.fake.stats['commands'][f"UID {name}" if uid else name] += 1
+        if self.fake.network.latency:
+            time.sleep(self.fake.network.latency)
+        if self.authenticated and name not in ('LOGOUT', 'IDLE') and self.fake.should_disconnect():
+            if name != 'FETCH':
+                raise _Disconnect()
+            self._cut = self.fake.random_cut()
+
+        handler = getattr(self, f"_cmd_{name.lower()}", None)
+        if handler is None:
+            return self._tagged(tag, 'BAD', f"Unknown command {name}")
+        if name not in ('CAPABILITY', 'NOOP', 'LOGOUT', 'LOGIN') and not self.authenticated:
+            return self._tagged(tag, 'NO', 'Not authenticated')
+        if name in ('FETCH', 'SEARCH', 'STORE', 'CLOSE', 'UNSELECT', 'IDLE', 'CHECK') and self.folder is None:
+            return self._tagged(tag, 'BAD', 'No mailbox selected')
+        try:
+            handler(tag, args, uid) if name in ('FETCH', 'SEARCH', 'STORE') else handler(tag, args)
+        except (_Disconnect, OSError):
+            raise
+        except Exception as e:
+            logger.debug(f"命令 {name} 出错: {e}", exc_info=True)
+            self._tagged(tag, 'BAD', str(e))
+
+    # ---- 发送 ----
+
+    def _send(self, data: bytes) -> None:
+        """按带宽限制发送数据；需要模拟中途断线时只发送一部分"""
+        bandwidth = self.fake.network.bandwidth
+        view = memoryview(data)
+        for offset in range(0, len(view), self.CHUNK_SIZE):
+            chunk = view[offset:offset + self.CHUNK_SIZE]
+            if self._cut is not None:
+                if self._cut < len(chunk):
+                    self._write_raw(chunk[:self._cut])
+                    raise _Disconnect()
+                self._cut -= len(chunk)
+            if bandwidth:
+                self._ready = max(self._ready, time.monotonic()) + len(chunk) / bandwidth
+                delay = self._ready - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self._write_raw(chunk)
+
+    def _write_raw(self, data: Union[bytes, memoryview]) -> None:
+        self.request.sendall(data)
+        with self.fake.lock:
+            self.fake.stats['bytes_sent'] += len(data)
+
+    def _tagged(self, tag: str, status: str, text: str) -> None:
+        if self._cut is not None:
+            # 响应比断线位置短时在完成应答前断开
+            raise _Disconnect()
+        self._send(f"{tag} {status} {text}\r\n".encode())
+
+    def _untagged(self, text: Union[str, bytes]) -> None:
+        self._send(b'* ' + (text.encode() if isinstance(text, str) else text) + b'\r\n')
+
+    def _report_exists(self) -> None:
+        """向客户端报告文件夹中新到达的邮件"""
+        if self.folder is not None and len(self.folder.messages) != self.exists:
+            self.exists = len(self.folder.messages)
+            self._untagged(f"{self.exists} EXISTS")
+
+    # ---- 命令 ----
+
+    def _cmd_capability(self, tag: str, args: List[Any]) -> None:
+        self._untagged('CAPABILITY ' + ' '.join(self.fake.capabilities))
+        self._tagged(tag, 'OK', 'CAPABILITY completed')
+
+    def _cmd_noop(self, tag: str, args: List[Any]) -> None:
+        self._report_exists()
+        self._tagged(tag, 'OK', 'NOOP completed')
+
+    _cmd_check = _cmd_noop
+
+    def _cmd_enable(self, tag: str, args: List[Any]) -> None:
+        self._tagged(tag, 'OK', 'ENABLE completed')
+
+    def _cmd_logout(self, tag: str, args: List[Any]) -> None:
+        self._untagged('BYE Logging out')
+        self._tagged(tag, 'OK', 'LOGOUT completed')
+        self.closed = True
+
+    def _cmd_login(self, tag: str, args: List[Any]) -> None:
+        if len(args) != 2:
+            return self._tagged(tag, 'BAD', 'LOGIN requires user and password')
+        user, password = (_text(arg) for arg in args)
+        users = self.fake.users
+        if users is not None and users.get(user) != password:
+            return self._tagged(tag, 'NO', '[AUTHENTICATIONFAILED] Invalid credentials')
+        self.authenticated = True
+        self._tagged(tag, 'OK', 'LOGIN completed')
+
+    def _cmd_select(self, tag: str, args: List[Any], readonly: bool = False) -> None:
+        folder = self.fake.find_folder(_text(args[0])) if args else None
+        if folder is None:
+            self.folder = None
+            return self._tagged(tag, 'NO', '[NONEXISTENT] No such mailbox')
+        self.folder, self.readonly = folder, readonly
+        self.exists = len(folder.messages)
+        self._untagged(r'FLAGS (\Answered \Flagged \Deleted \Seen \Draft)')
+        self._untagged(f"{self.exists} EXISTS")
+        self._untagged('0 RECENT')
+        self._untagged(f"OK [UIDVALIDITY {folder.uidvalidity}] UIDs valid")
+        self._untagged(f"OK [UIDNEXT {folder.uidnext}] Predicted next UID")
+        if 'CONDSTORE' in self.fake.capabilities:
+            self._untagged(f"OK [HIGHESTMODSEQ {folder.modseq}] Highest")
+        self._tagged(tag, 'OK', f"[{'READ-ONLY' if readonly else 'READ-WRITE'}] SELECT completed")
+
+    def _cmd_examine(self, tag: str, args: List[Any]) -> None:
+        self._cmd_select(tag, args, readonly=True)
+
+    def _cmd_close(self, tag: str, args: List[Any]) -> None:
+        self.folder = None
+        self._tagged(tag, 'OK', 'CLOSE completed')
+
+    _cmd_unselect = _cmd_close
+
+    def _cmd_list(self, tag: str, args: List[Any], command: str = 'LIST') -> None:
+        if len(args) < 2:
+            return self._tagged(tag, 'BAD', f"{command} requires reference and pattern")
+        reference, pattern = _text(args[0]), _text(args[1])
+        if not pattern:
+            self._untagged(f'{command} (\\Noselect) "/" ""')
+            return self._tagged(tag, 'OK', f"{command} completed")
+        regex = re.compile(
+            ''.join('.*' if c == '*' else '[^/]*' if c == '%' else re.escape(c) for c in reference + pattern),
+            re.IGNORECASE
+        )
+        for folder in list(self.fake.folders.values()):
+            if regex.fullmatch(folder.wire_name):
+                self._untagged(f'{command} (\\HasNoChildren) "/" {_quote(folder.wire_name).decode()}')
+        self._tagged(tag, 'OK', f"{command} completed")
+
+    def _cmd_lsub(self, tag: str, args: List[Any]) -> None:
+        self._cmd_list(tag, args, 'LSUB')
+
+    def _cmd_status(self, tag: str, args: List[Any]) -> None:
+        folder = self.fake.find_folder(_text(args[0])) if args else None
+        if folder is None:
+            return self._tagged(tag, 'NO', '[NONEXISTENT] No such mailbox')
+        items = args[1] if len(args) > 1 and isinstance(args[1], list) else args[1:]
+        values = {
+            'MESSAGES': len(folder.messages),
+            'RECENT': 0,
+            'UIDNEXT': folder.uidnext,
+            'UIDVALIDITY': folder.uidvalidity,
+            'UNSEEN': sum(1 for message in folder.messages if '\\Seen' not in message.flags),
+            'HIGHESTMODSEQ': folder.modseq
+        }
+        reply = ' '.join(f"{item.upper()} {values[item.upper()]}" for item in items if item.upper() in values)
+        self._untagged(f"STATUS {_quote(folder.wire_name).decode()} ({reply})")
+        self._tagged(tag, 'OK', 'STATUS completed')
+
+    def _cmd_idle(self, tag: str, args: List[Any]) -> None:
+        self._send(b'+ idling\r\n')
+        self._report_exists()
+        while not self.closed:
+            if self._readable(0.2):
+                line = self.rfile.readline(self.LINE_LIMIT)
+                if not line:
+                    raise _Disconnect()
+                if line.strip().upper() == b'DONE':
+                    break
+                return self._tagged(tag, 'BAD', 'Expected DONE')
+            with self.fake.lock:
+                if len(self.folder.messages) == self.exists:
+                    self.fake.changed.wait(0.2)
+            self._report_exists()
+        self._tagged(tag, 'OK', 'IDLE terminated')
+
+    def _readable(self, timeout: float) -> bool:
+        """读缓冲区和SSL层中可能已有数据，先非阻塞地窥视，再对套接字select"""
+        sock = self.request
+        previous_timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            if self.rfile.peek(1):
+                return True
+        except (ssl.SSLWantReadError, BlockingIOError):
+            pass
+        finally:
+            sock.settimeout(previous_timeout)
+        return bool(select.select([sock], [], [], timeout)[0])
+
+    def _cmd_search(self, tag: str, args: List[Any], uid: bool) -> None:
+        charset = 'utf-8'
+        returns = None
+        while args and isinstance(args[0], str) and args[0].upper() in ('CHARSET', 'RETURN'):
+            if args[0].upper() == 'CHARSET':
+                charset, args = _text(args[1]), args[2:]
+            else:
+                returns = [str(option).upper() for option in args[1]] or ['ALL']
+                args = args[2:]
+        messages = list(enumerate(self.folder.messages[:len(self.folder.messages)], 1))
+        predicate = _SearchParser(args, charset, len(messages), self.folder).parse()
+        found = [message.uid if uid else seq for seq, message in messages if predicate(seq, message)]
+        if returns is None or 'ESEARCH' not in self.fake.capabilities:
+            self._untagged('SEARCH' + ''.join(f" {n}" for n in found))
+        else:
+            reply = f'ESEARCH (TAG "{tag}")' + (' UID' if uid else '')
+            if found and 'MIN' in returns:
+                reply += f" MIN {found[0]}"
+            if found and 'MAX' in returns:
+                reply += f" MAX {found[-1]}"
+            if 'COUNT' in returns:
+                reply += f" COUNT {len(found)}"
+            if found and 'ALL' in returns:
+                reply += f" ALL {_compress(found)}"
+            self._untagged(reply)
+        self._tagged(tag, 'OK', 'SEARCH completed')
+
+    def _cmd_fetch(self, tag: str, args: List[Any], uid: bool) -> None:
+        if len(args) < 2:
+            return self._tagged(tag, 'BAD', 'FETCH requires a sequence set and items')
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        items = [str(item) for item in items]
+        macros = {
+            'ALL': ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE', 'ENVELOPE'],
+            'FAST': ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE'],
+            'FULL': ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE', 'ENVELOPE', 'BODY']
+        }
+        if len(items) == 1 and items[0].upper() in macros:
+            items = macros[items[0].upper()]
+        if uid and not any(item.upper() == 'UID' for item in items):
+            items.insert(0, 'UID')
+        selected = self.folder.select(_parse_set(str(args[0]), self._set_max(uid)), uid)
+        for seq, message in selected:
+            self._send(b'* ' + str(seq).encode() + b' FETCH (' + self._fetch_items(message, items) + b')\r\n')
+        self._tagged(tag, 'OK', 'FETCH completed')
+
+    def _fetch_items(self, message: FakeMessage, items: List[str]) -> bytes:
+        out: List[bytes] = []
+        seen = False
+        for item in items:
+            upper = item.upper()
+            if upper == 'UID':
+                out.append(f"UID {message.uid}".encode())
+            elif upper == 'FLAGS':
+                out.append(b'FLAGS (' + ' '.join(sorted(message.flags)).encode() + b')')
+            elif upper == 'INTERNALDATE':
+                out.append(b'INTERNALDATE "' + message.internaldate.strftime('%d-%b-%Y %H:%M:%S %z').encode() + b'"')
+            elif upper == 'RFC822.SIZE':
+                out.append(f"RFC822.SIZE {len(message.raw)}".encode())
+            elif upper == 'MODSEQ':
+                out.append(f"MODSEQ ({message.modseq})".encode())
+            elif upper == 'ENVELOPE':
+                out.append(b'ENVELOPE ' + _envelope(message.tree.headers))
+            elif upper in ('BODYSTRUCTURE', 'BODY'):
+                out.append(upper.encode() + b' ' + _structure(message.tree, upper == 'BODYSTRUCTURE'))
+            elif upper in ('RFC822', 'RFC822.HEADER', 'RFC822.TEXT'):
+                data = {'RFC822': message.raw, 'RFC822.HEADER': message.tree.header, 'RFC822.TEXT': message.tree.body}[upper]
+                out.append(upper.encode() + b' ' + _literal(data))
+                seen = seen or upper != 'RFC822.HEADER'
+            elif upper.startswith(('BODY[', 'BODY.PEEK[')):
+                match = re.fullmatch(r'BODY(\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?', item, re.IGNORECASE)
+                if not match:
+                    raise ValueError(f"invalid fetch item {item}")
+                data = _section(message, match.group(2))
+                name = f"BODY[{match.group(2)}]"
+                if match.group(3) is not None:
+                    origin = int(match.group(3))
+                    data = data[origin:origin + int(match.group(4))]
+                    name += f"<{origin}>"
+                out.append(name.encode() + b' ' + _literal(data))
+                seen = seen or not match.group(1)
+            else:
+                raise ValueError(f"unsupported fetch item {item}")
+        if seen and not self.readonly and '\\Seen' not in message.flags:
+            with self.fake.lock:
+                message.flags.add('\\Seen')
+                self.folder.modseq += 1
+                message.modseq = self.folder.modseq
+            if not any(item.upper() == 'FLAGS' for item in items):
+                out.append(b'FLAGS (' + ' '.join(sorted(message.flags)).encode() + b')')
+        return b' '.join(out)
+
+    def _cmd_store(self, tag: str, args: List[Any], uid: bool) -> None:
+        if len(args) < 3:
+            return self._tagged(tag, 'BAD', 'STORE requires a sequence set, an action and flags')
+        if self.readonly:
+            return self._tagged(tag, 'NO', 'Mailbox is read-only')
+        action = str(args[1]).upper()
+        flags = {str(flag) for flag in (args[2] if isinstance(args[2], list) else args[2:])}
+        silent = action.endswith('.SILENT')
+        action = action.split('.')[0]
+        selected = self.folder.select(_parse_set(str(args[0]), self._set_max(uid)), uid)
+        for seq, message in selected:
+            with self.fake.lock:
+                before = set(message.flags)
+                if action == '+FLAGS':
+                    message.flags |= flags
+                elif action == '-FLAGS':
+                    message.flags -= flags
+                elif action == 'FLAGS':
+                    message.flags = set(flags)
+                else:
+                    raise ValueError(f"invalid STORE action {action}")
+                if message.flags != before:
+                    self.folder.modseq += 1
+                    message.modseq = self.folder.modseq
+            if not silent:
+                reply = (f"UID {message.uid} " if uid else '') + f"FLAGS ({' '.join(sorted(message.flags))})"
+                self._untagged(f"{seq} FETCH ({reply})")
+        self._tagged(tag, 'OK', 'STORE completed')
+
+    def _set_max(self, uid: bool) -> int:
+        if uid:
+            return self.folder.uids[-1] if self.folder.uids else 0
+        return len(self.folder.messages)
+
+
+class _SearchParser:
+    """把SEARCH参数解析为 (序号, 邮件) -> bool 的判断函数"""
+
+    _FLAG_KEYS = {
+        'SEEN': ('\\Seen', True), 'UNSEEN': ('\\Seen', False),
+        'ANSWERED': ('\\Answered', True), 'UNANSWERED': ('\\Answered', False),
+        'FLAGGED': ('\\Flagged', True), 'UNFLAGGED': ('\\Flagged', False),
+        'DELETED': ('\\Deleted', True), 'UNDELETED': ('\\Deleted', False),
+        'DRAFT': ('\\Draft', True), 'UNDRAFT': ('\\Draft', False)
+    }
+    _HEADER_KEYS = {'FROM': 'From', 'TO': 'To', 'CC': 'Cc', 'BCC': 'Bcc', 'SUBJECT': 'Subject'}
+
+    def __init__(self, tokens: List[Any], charset: str, count: int, folder: FakeFolder):
+        self.tokens = tokens
+        self.pos = 0
+        self.charset = charset
+        self.count = count
+        self.folder = folder
+
+    def parse(self) -> Callable[[int, FakeMessage], bool]:
+        predicates = []
+        while self.pos < len(self.tokens):
+            predicates.append(self._key())
+        return lambda seq, message: all(p(seq, message) for p in predicates)
+
+    def _next(self) -> Any:
+        if self.pos >= len(self.tokens):
+            raise ValueError("unexpected end of search criteria")
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def _string(self) -> str:
+        return _text(self._next(), self.charset).casefold()
+
+    def _key(self) -> Callable[[int, FakeMessage], bool]:
+        token = self._next()
+        if isinstance(token, list):
+            inner = _SearchParser(token, self.charset, self.count, self.folder).parse()
+            return inner
+        key = str(token).upper()
+        if key == 'ALL':
+            return lambda seq, message: True
+        if key in self._FLAG_KEYS:
+            flag, present = self._FLAG_KEYS[key]
+            return lambda seq, message: (flag in message.flags) == present
+        if key in ('KEYWORD', 'UNKEYWORD'):
+            flag = str(self._next())
+            return lambda seq, message: (flag in message.flags) == (key == 'KEYWORD')
+        if key == 'NOT':
+            inner = self._key()
+            return lambda seq, message: not inner(seq, message)
+        if key == 'OR':
+            left, right = self._key(), self._key()
+            return lambda seq, message: left(seq, message) or right(seq, message)
+        if key == 'UID':
+            ranges = _parse_set(str(self._next()), self.folder.uids[-1] if self.folder.uids else 0)
+            return lambda seq, message: any(lo <= message.uid <= hi for lo, hi in ranges)
+        if key in ('LARGER', 'SMALLER'):
+            size = int(self._next())
+            if key == 'LARGER':
+                return lambda seq, message: len(message.raw) > size
+            return lambda seq, message: len(message.raw) < size
+        if key in ('SINCE', 'BEFORE', 'ON', 'SENTSINCE', 'SENTBEFORE', 'SENTON'):
+            day = datetime.strptime(_text(self._next()), '%d-%b-%Y').date()
+            sent = key.startswith('SENT')
+            compare = {
+                'SINCE': lambda d: d >= day, 'BEFORE': lambda d: d < day, 'ON': lambda d: d == day
+            }[key[4:] if sent else key]
+            return lambda seq, message: compare(_message_date(message, sent))
+        if key in self._HEADER_KEYS:
+            name, value = self._HEADER_KEYS[key], self._string()
+            return lambda seq, message: value in _header_text(message, name)
+        if key == 'HEADER':
+            name, value = _text(self._next()), self._string()
+            return lambda seq, message: value in _header_text(message, name)
+        if key in ('BODY', 'TEXT'):
+            value = self._string()
+            return lambda seq, message: value in _decoded_text(message, key == 'TEXT')
+        if key == 'MODSEQ':
+            modseq = int(self._next())
+            return lambda seq, message: message.modseq >= modseq
+        if key == 'X-GM-RAW':
+            query = self._string()
+            if 'has:attachment' in query:
+                return lambda seq, message: 'attachment' in message.raw[:1024 * 1024].lower().decode('ascii', 'replace')
+            return lambda seq, message: True
+        if re.fullmatch(r'[\d*:,]+', key):
+            ranges = _parse_set(key, self.count)
+            return lambda seq, message: any(lo <= seq <= hi for lo, hi in ranges)
+        raise ValueError(f"unsupported search key {key}")
+
+
+# ---- 邮件生成 ----
+
+_SUBJECTS = [
+    '季度报告', 'Quarterly report', '会议纪要', 'Meeting notes', '发票', 'Invoice',
+    '项目进度更新', 'Project update', '合同草案', 'Draft contract', '周报', 'Weekly summary'
+]
+_NAMES = ['张三', '李四', '王五', 'Alice Smith', 'Bob Jones', 'Carol Lee']
+_WORDS = {
+    'cjk': '数据显示本季度收入增长明显请查阅附件中的详细内容如有问题请及时联系',
+    'latin': 'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor'
+}
+_ATTACHMENT_TYPES = [('application', 'pdf', 'pdf'), ('application', 'octet-stream', 'bin'),
+                     ('image', 'png', 'png'), ('application', 'zip', 'zip')]
+
+
+def _text_for(rng: random.Random, charset: str, words: int) -> str:
+    if charset.lower() in ('us-ascii', 'ascii', 'iso-8859-1', 'latin-1'):
+        vocabulary = _WORDS['latin'].split()
+        return ' '.join(rng.choice(vocabulary) for _ in range(words))
+    vocabulary = _WORDS['cjk']
+    return ''.join(rng.choice(vocabulary) for _ in range(words * 2))
+
+
+def _header(value: str, charset: str) -> str:
+    try:
+        value.encode('ascii')
+        return value
+    except UnicodeEncodeError:
+        charset = 'utf-8' if charset.lower() in ('us-ascii', 'ascii') else charset
+        return email.header.Header(value, charset).encode()
+
+
+def _build_message(rng: random.Random, spec: MailboxSpec, number: int, depth: int, date: datetime) -> MIMEMultipart:
+    charset = rng.choice(list(spec.charsets))
+    subject = f"{rng.choice(_SUBJECTS)} #{number}"
+    if charset.lower() in ('us-ascii', 'ascii'):
+        subject = subject.encode('ascii', 'ignore').decode().strip() or f"Message #{number}"
+    sender = rng.choice(_NAMES)
+
+    text = _text_for(rng, charset, rng.randint(20, 200))
+    body: Any = MIMEText(text, 'plain', charset)
+    if rng.random() < spec.html_ratio:
+        body = MIMEMultipart('alternative', _subparts=[body, MIMEText(f"<html><body><p>{text}</p></body></html>", 'html', charset)])
+
+    parts: List[Any] = []
+    low, high = spec.attachment_size
+    for index in range(rng.choice(list(spec.attachment_counts)) if spec.attachment_counts else 0):
+        size = int(round(2 ** rng.uniform(math.log2(max(low, 1)), math.log2(max(high, 1)))))
+        maintype, subtype, ext = rng.choice(_ATTACHMENT_TYPES)
+        attachment = MIMEApplication(rng.randbytes(size), subtype) if maintype == 'application' else MIMEApplication(rng.randbytes(size))
+        if maintype != 'application':
+            attachment.replace_header('Content-Type', f"{maintype}/{subtype}")
+        name = f"附件{index + 1}_{number}.{ext}" if rng.random() < 0.5 else f"attachment{index + 1}_{number}.{ext}"
+        attachment.add_header('Content-Disposition', 'attachment', filename=_header(name, 'utf-8'))
+        parts.append(attachment)
+    if depth > 0 and rng.random() < 0.2:
+        forwarded = _build_message(rng, spec, number, depth - 1, date - timedelta(days=1))
+        parts.append(MIMEMessage(forwarded))
+
+    message = MIMEMultipart('mixed', _subparts=[body] + parts) if parts else body
+    message['Subject'] = _header(subject, charset)
+    message['From'] = email.utils.formataddr((_header(sender, charset), f"user{number % 50}@fake.invalid"))
+    message['To'] = 'me@fake.invalid'
+    message['Date'] = email.utils.format_datetime(date)
+    return message
+
+
+# ---- 协议辅助函数 ----
+
+def _tokenize(text: str, literals: List[bytes]) -> List[Any]:
+    """把命令行切分为原子、字符串、字面量和括号列表"""
+    stack: List[List[Any]] = [[]]
+    pos = 0
+    while pos < len(text):
+        char = text[pos]
+        if char == ' ':
+            pos += 1
+        elif char == '(':
+            stack.append([])
+            pos += 1
+        elif char == ')':
+            if len(stack) == 1:
+                raise ValueError("unbalanced parenthesis")
+            inner = stack.pop()
+            stack[-1].append(inner)
+            pos += 1
+        elif char == '"':
+            pos += 1
+            value = []
+            while pos < len(text) and text[pos] != '"':
+                if text[pos] == '\\' and pos + 1 < len(text):
+                    pos += 1
+                value.append(text[pos])
+                pos += 1
+            stack[-1].append(''.join(value))
+            pos += 1
+        elif char == '\x00':
+            end = text.index('\x00', pos + 1)
+            stack[-1].append(literals[int(text[pos + 1:end])])
+            pos = end + 1
+        else:
+            start, depth = pos, 0
+            while pos < len(text):
+                char = text[pos]
+                if char == '[':
+                    depth += 1
+                elif char == ']':
+                    depth -= 1
+                elif depth == 0 and char in ' ()':
+                    break
+                pos += 1
+            stack[-1].append(text[start:pos])
+    return stack[0]
+
+
+def _text(value: Any, charset: str = 'utf-8') -> str:
+    if isinstance(value, bytes):
+        return value.decode(charset, 'replace')
+    return str(value)
+
+
+def _quote(value: Optional[str]) -> bytes:
+    """生成IMAP字符串：可打印ASCII用引号，其它用字面量"""
+    if value is None:
+        return b'NIL'
+    data = value.encode('utf-8')
+    if all(0x20 <= byte < 0x7f for byte in data):
+        return b'"' + data.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+    return _literal(data)
+
+
+def _literal(data: bytes) -> bytes:
+    return b'{' + str(len(data)).encode() + b'}\r\n' + data
+
+
+def _parse_set(text: str, maximum: int) -> List[Tuple[int, int]]:
+    ranges = []
+    for item in filter(None, text.split(',')):
+        start, _, end = item.partition(':')
+        lo = maximum if start == '*' else int(start)
+        hi = lo if not end else maximum if end == '*' else int(end)
+        ranges.append((min(lo, hi), max(lo, hi)))
+    return ranges
+
+
+def _compress(numbers: List[int]) -> str:
+    ranges: List[List[int]] = []
+    for number in numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ','.join(str(lo) if lo == hi else f"{lo}:{hi}" for lo, hi in ranges)
+
+
+def _encode_folder_name(name: str) -> str:
+    """编码为IMAP的modified UTF-7(RFC 3501 5.1.3)"""
+    out, pending = [], []
+
+    def flush() -> None:
+        if pending:
+            encoded = base64.b64encode(''.join(pending).encode('utf-16-be')).decode('ascii')
+            out.append('&' + encoded.rstrip('=').replace('/', ',') + '-')
+            pending.clear()
+
+    for char in name:
+        if 0x20 <= ord(char) <= 0x7e:
+            flush()
+            out.append('&-' if char == '&' else char)
+        else:
+            pending.append(char)
+    flush()
+    return ''.join(out)
+
+
+def _section(message: FakeMessage, section: str) -> bytes:
+    """取出BODY[section]的内容"""
+    tree = message.tree
+    match = re.fullmatch(r'((?:\d+\.)*\d+)?\.?(HEADER\.FIELDS(?:\.NOT)?\s*\(([^)]*)\)|HEADER|TEXT|MIME)?', section.strip(), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"invalid section {section}")
+    numbers, specifier, fields = match.group(1), (match.group(2) or '').upper(), match.group(3)
+    node = tree.find([int(n) for n in numbers.split('.')]) if numbers else tree
+    if not specifier:
+        return node.body if numbers else message.raw
+    if specifier == 'MIME':
+        if not numbers:
+            raise ValueError("MIME requires a part number")
+        return node.header
+    if numbers:
+        if node.content_type != 'message/rfc822':
+            raise ValueError(f"{specifier} requires a message/rfc822 part")
+        node = node.children[0]
+    if specifier == 'TEXT':
+        return node.body
+    if specifier == 'HEADER':
+        return node.header
+    names = {name.upper() for name in fields.split()}
+    exclude = specifier.startswith('HEADER.FIELDS.NOT')
+    lines = re.split(rb'\r?\n(?![ \t])', node.header.rstrip(b'\r\n'))
+    kept = [line for line in lines if (line.split(b':', 1)[0].strip().decode('ascii', 'replace').upper() in names) != exclude]
+    return b''.join(line + b'\r\n' for line in kept) + b'\r\n'
+
+
+def _params(pairs: List[Tuple[str, str]]) -> bytes:
+    if not pairs:
+        return b'NIL'
+    return b'(' + b' '.join(_quote(key.upper()) + b' ' + _quote(str(value)) for key, value in pairs) + b')'
+
+
+def _structure(node: _MimePart, extended: bool = True) -> bytes:
+    """生成BODYSTRUCTURE(extended为False时为不含扩展数据的BODY)"""
+    headers = node.headers
+    if node.is_multipart:
+        out = b'(' + b''.join(_structure(child, extended) for child in node.children)
+        out += b' ' + _quote(headers.get_content_subtype().upper())
+        if extended:
+            params = [(k, v) for k, v in (headers.get_params() or [])[1:]]
+            out += b' ' + _params(params) + b' ' + _disposition(headers) + b' NIL NIL'
+        return out + b')'
+    params = [(k, v) for k, v in (headers.get_params() or [])[1:]]
+    encoding = (headers.get('Content-Transfer-Encoding') or '7BIT').strip().upper()
+    fields = [
+        _quote(headers.get_content_maintype().upper()), _quote(headers.get_content_subtype().upper()),
+        _params(params), _quote(headers.get('Content-ID')), _quote(headers.get('Content-Description')),
+        _quote(encoding), str(len(node.body)).encode()
+    ]
+    if node.content_type == 'message/rfc822' and node.children:
+        encapsulated = node.children[0]
+        fields += [_envelope(encapsulated.headers), _structure(encapsulated, extended), str(node.body.count(b'\n')).encode()]
+    elif headers.get_content_maintype() == 'text':
+        fields.append(str(node.body.count(b'\n')).encode())
+    if extended:
+        fields += [b'NIL', _disposition(headers), b'NIL', b'NIL']
+    return b'(' + b' '.join(fields) + b')'
+
+
+def _disposition(headers: email.message.Message) -> bytes:
+    value = headers.get('Content-Disposition')
+    if not value:
+        return b'NIL'
+    kind = value.split(';', 1)[0].strip().upper()
+    params = headers.get_params(header='content-disposition') or []
+    return b'(' + _quote(kind) + b' ' + _params([(k, v) for k, v in params[1:]]) + b')'
+
+
+def _envelope(headers: email.message.Message) -> bytes:
+    def addresses(name: str) -> bytes:
+        values = headers.get_all(name)
+        if not values:
+            return b'NIL'
+        items = []
+        for display, address in email.utils.getaddresses(values):
+            mailbox, _, host = address.partition('@')
+            items.append(b'(' + b' '.join([_quote(display or None), b'NIL', _quote(mailbox or None), _quote(host or None)]) + b')')
+        return b'(' + b''.join(items) + b')'
+
+    sender = addresses('From')
+    return b'(' + b' '.join([
+        _quote(headers.get('Date')), _quote(headers.get('Subject')), sender,
+        addresses('Sender') if headers.get('Sender') else sender,
+        addresses('Reply-To') if headers.get('Reply-To') else sender,
+        addresses('To'), addresses('Cc'), addresses('Bcc'),
+        _quote(headers.get('In-Reply-To')), _quote(headers.get('Message-ID'))
+    ]) + b')'
+
+
+def _decode(value: Optional[str]) -> str:
+    if not value:
+        return ''
+    try:
+        return str(email.header.make_header(email.header.decode_header(value)))
+    except Exception:
+        return value
+
+
+def _header_text(message: FakeMessage, name: str) -> str:
+    return ' '.join(_decode(value) for value in message.tree.headers.get_all(name) or []).casefold()
+
+
+def _decoded_text(message: FakeMessage, include_headers: bool) -> str:
+    parsed = email.message_from_bytes(message.raw)
+    texts = []
+    for part in parsed.walk():
+        if part.get_content_maintype() == 'text':
+            payload = part.get_payload(decode=True) or b''
+            texts.append(payload.decode(part.get_content_charset() or 'utf-8', 'replace'))
+    if include_headers:
+        texts.extend(_decode(value) for value in parsed.values())
+    return ' '.join(texts).casefold()
+
+
+def _message_date(message: FakeMessage, sent: bool) -> Any:
+    if sent:
+        try:
+            return email.utils.parsedate_to_datetime(message.tree.headers.get('Date')).date()
+        except Exception:
+            pass
+    return message.internaldate.date()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='本地IMAP测试服务器')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1993)
+    parser.add_argument('--plain', action='store_true', help='不使用SSL')
+    parser.add_argument('--messages', type=int, default=100, help='每个文件夹的邮件数量')
+    parser.add_argument('--folders', default='INBOX', help='文件夹，以逗号分隔')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='每条命令的延迟(秒)')
+    parser.add_argument('--bandwidth', type=int, default=None, help='每个连接的带宽(字节/秒)')
+    parser.add_argument('--max-connections', type=int, default=None)
+    parser.add_argument('--disconnect-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    server = FakeIMAPServer(
+        MailboxSpec(messages=args.messages, folders=tuple(args.folders.split(',')), seed=args.seed),
+        network=NetworkProfile(args.latency, args.bandwidth, args.max_connections, args.disconnect_rate, args.seed),
+        use_ssl=not args.plain, host=args.host, port=args.port
+    )
+    server.start()
+    logger.info("按Ctrl+C停止")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
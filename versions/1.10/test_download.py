@@ -0,0 +1,254 @@
+"""
+下载流程测试
+
+用 fakeImapServer.FakeIMAPServer 在本机启动明文IMAP服务器，驱动 download_emails
+走完搜索、下载计划、FETCH、解析和保存的完整流程，线程引擎和asyncio引擎各跑一遍；
+另外覆盖UIDSet、SearchFilter、断点续传日志、增量同步和流式解码等不需要网络的部分。
+
+运行: 在 versions/1.10 目录下执行 python -m pytest -q
+"""
+
+import filecmp
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+import emailCore
+from emailCore import (
+    AsyncIMAPClient, DownloadOptions, EmailDownload, ProgressSignal, ResumeJournal, SearchFilter, UIDSet
+)
+from fakeImapServer import FakeIMAPServer, MailboxSpec, NetworkProfile
+
+ACCOUNT = 'tester@example.com'
+PASSWORD = 'secret'
+ENGINES = ('thread', 'asyncio')
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """在临时目录中运行，下载目录、报告和imap_servers.json都写在这里"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def start_server(spec: MailboxSpec, network: NetworkProfile = None) -> FakeIMAPServer:
+    """启动测试服务器，并把它写入当前目录的imap_servers.json"""
+    server = FakeIMAPServer(spec, users={ACCOUNT: PASSWORD}, network=network or NetworkProfile(), use_ssl=False)
+    server.start()
+    with open('imap_servers.json', 'w', encoding='utf-8') as f:
+        json.dump(server.server_config('example.com'), f)
+    return server
+
+
+def mark_unseen(server: FakeIMAPServer) -> None:
+    """清除所有邮件的已读标记(下载时FETCH RFC822会把邮件标记为已读)"""
+    for folder in server.folders.values():
+        for message in folder.messages:
+            message.flags.discard('\\Seen')
+
+
+def download(engine: str, **options) -> emailCore.DownloadStats:
+    return EmailDownload.download_emails(
+        ACCOUNT, PASSWORD, DownloadOptions(**options), ProgressSignal(), engine=engine
+    )
+
+
+def saved_messages(mailbox: str = 'INBOX') -> int:
+    """文件夹下载目录中的邮件目录数"""
+    directory = EmailDownload.folder_directory(ACCOUNT, mailbox)
+    return sum(1 for entry in directory.iterdir() if entry.is_dir() and not entry.name.startswith('.'))
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_download_folder(workdir, engine):
+    server = start_server(MailboxSpec(messages=30, seed=1))
+    try:
+        stats = download(engine)
+    finally:
+        server.stop()
+    assert (stats.total, stats.success, stats.failed) == (30, 30, 0)
+    assert saved_messages() == 30
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_folders_share_connection_limit(workdir, engine):
+    """多个文件夹同时下载时，连接数不超过imap_servers.json中的限制，服务器不会拒绝连接"""
+    spec = MailboxSpec(messages=20, folders=('INBOX', 'Archive', 'Work'), seed=2)
+    server = start_server(spec, NetworkProfile(max_connections=2))
+    try:
+        stats = download(engine, folders='*')
+    finally:
+        server.stop()
+    assert (stats.total, stats.success, stats.failed) == (60, 60, 0)
+    assert server.stats['peak'] <= 2
+    assert server.stats['rejected'] == 0
+    for mailbox in spec.folders[1:]:
+        assert saved_messages(mailbox) == 20
+    # 其他文件夹的下载目录位于INBOX的目录之下
+    assert saved_messages('INBOX') == 20 + len(spec.folders) - 1
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_resume_skips_completed_messages(workdir, engine, monkeypatch):
+    server = start_server(MailboxSpec(messages=12, seed=3))
+    try:
+        download(engine)
+        mark_unseen(server)
+        fetched = []
+        original = EmailDownload.download_batch
+        monkeypatch.setattr(EmailDownload, 'download_batch', staticmethod(
+            lambda batch, *args: fetched.append(batch) or original(batch, *args)
+        ))
+        monkeypatch.setattr(emailCore.AsyncDownloadEngine, '_save_batch', lambda *args: pytest.fail('不应重新下载'))
+        stats = download(engine)
+    finally:
+        server.stop()
+    assert (stats.total, stats.success, stats.failed) == (12, 12, 0)
+    assert fetched == []
+    with ResumeJournal(EmailDownload.folder_directory(ACCOUNT, 'INBOX')) as journal:
+        assert len(journal.completed) == 12
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_incremental_sync_downloads_only_new_messages(workdir, engine):
+    server = start_server(MailboxSpec(messages=10, seed=4))
+    try:
+        first = download(engine, incremental=True)
+        server.deliver('INBOX', 3)
+        second = download(engine, incremental=True)
+        third = download(engine, incremental=True)
+    finally:
+        server.stop()
+    assert (first.total, first.success) == (10, 10)
+    assert (second.total, second.success) == (3, 3)
+    assert third.total == 0
+    assert saved_messages() == 13
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_spooled_messages_are_saved_like_in_memory(workdir, engine, monkeypatch):
+    """暂存到磁盘后流式解码保存的结果与在内存中解析保存的结果相同"""
+    spec = MailboxSpec(messages=15, attachment_counts=(0, 1, 2), seed=5)
+    server = start_server(spec)
+    try:
+        download(engine)
+        os.rename('downloads', 'in_memory')
+        mark_unseen(server)
+        monkeypatch.setattr(emailCore.SpoolingIMAP4_SSL, 'SPOOL_THRESHOLD', 0)
+        monkeypatch.setattr(emailCore.SpoolingIMAP4, 'SPOOL_THRESHOLD', 0)
+        download(engine, resume=False)
+    finally:
+        server.stop()
+    assert_same_tree(Path('in_memory'), Path('downloads'))
+
+
+def assert_same_tree(left: Path, right: Path) -> None:
+    """比较两次下载的邮件目录(忽略断点续传日志、运行报告等运行状态文件)"""
+    comparison = filecmp.dircmp(left, right, ignore=[ResumeJournal.FILENAME, 'reports', '.attachments'])
+    pending = [comparison]
+    while pending:
+        current = pending.pop()
+        assert not current.left_only and not current.right_only, (current.left, current.left_only, current.right_only)
+        _, mismatch, errors = filecmp.cmpfiles(current.left, current.right, current.common_files, shallow=False)
+        assert not mismatch and not errors, (current.left, mismatch, errors)
+        pending.extend(current.subdirs.values())
+
+
+def test_uid_set():
+    uids = UIDSet.parse('1:5,9,12:10')
+    assert str(uids) == '1:5,9:12'
+    assert len(uids) == 9
+    assert 9 in uids and 8 not in uids
+    assert list(UIDSet.from_search([b'3 4 5 7'])) == [3, 4, 5, 7]
+    assert str(UIDSet([b'7', '3', 4, 5])) == '3:5,7'
+
+
+def test_search_filter_criteria():
+    search_filter = SearchFilter.parse('since:2024-01-01 from:a@x.com from:b@x.com larger:100K has:attachment')
+    assert search_filter.criteria() == [
+        'SINCE', '01-Jan-2024', 'LARGER', '102399', 'OR', 'FROM', '"a@x.com"', 'FROM', '"b@x.com"'
+    ]
+    # 没有X-GM-EXT-1时"有附件"只能在邮件头上判断；Gmail可以直接交给服务器
+    assert search_filter.needs_headers(('IMAP4REV1',))
+    assert search_filter.criteria(('X-GM-EXT-1',))[-2:] == ['X-GM-RAW', '"has:attachment"']
+    # imaplib只能发送ASCII命令，中文主题在邮件头上判断
+    assert SearchFilter.parse('subject:发票').criteria() == []
+    assert not SearchFilter.parse('')
+
+
+def test_resume_journal_reload(tmp_path):
+    with ResumeJournal(tmp_path) as journal:
+        journal.set_uidvalidity(7)
+        journal.record(1, True)
+        journal.record(2, False)
+        journal.record(3, True)
+        journal.record(2, True)
+        journal.record(4, False)
+    with ResumeJournal(tmp_path) as journal:
+        journal.set_uidvalidity(7)
+        assert list(journal.completed) == [1, 2, 3]
+        assert list(journal.failed) == [4]
+        # UIDVALIDITY变化后原有记录作废
+        journal.set_uidvalidity(8)
+        assert not journal.completed and not journal.failed
+
+
+def test_async_client_routes_fetch_by_uid():
+    """流水线中多条UID FETCH同时在途时，FETCH响应按UID分给请求它的命令"""
+    client = AsyncIMAPClient('127.0.0.1')
+    first = AsyncIMAPClient._Command('A0001', None, UIDSet.parse('1:10'))
+    second = AsyncIMAPClient._Command('A0002', None, UIDSet.parse('11:20'))
+    client._commands.extend([first, second])
+    assert client._route(b'FETCH', b'* 3 FETCH (UID 15 RFC822 {100}') is second
+    assert client._route(b'FETCH', b'* 1 FETCH (UID 2 RFC822 {100}') is first
+    assert client._route(b'FETCH', b'* 5 FETCH (FLAGS (\\Seen))') is first
+    assert client._route(b'EXISTS', b'* 42 EXISTS') is first
+
+
+def test_async_engine_gives_up_when_server_refuses(workdir, monkeypatch):
+    """服务器一直拒绝连接时asyncio引擎在重试后结束，每个UID都记为失败(不因暂停的连接而一直等待)"""
+    async def refuse(self):
+        raise ConnectionRefusedError('connection refused')
+
+    monkeypatch.setattr(emailCore.AsyncDownloadEngine, '_connect', refuse)
+    monkeypatch.setattr(EmailDownload, 'RETRY_DELAY', 0)
+    monkeypatch.setattr(emailCore.AsyncDownloadEngine, 'PAUSE_INTERVAL', 0.01)
+    batches = [[str(uid).encode() for uid in range(start, start + 5)] for start in range(1, 51, 5)]
+    results = []
+    engine = emailCore.AsyncDownloadEngine(
+        ACCOUNT, PASSWORD, 8, controller=emailCore.ConcurrencyController(1, 8, 4)
+    )
+    engine.run(iter(batches), DownloadOptions(), lambda success, email_id: results.append((success, email_id)))
+    assert sorted(int(email_id) for _, email_id in results) == list(range(1, 51))
+    assert not any(success for success, _ in results)
+
+
+def test_prefetch_falls_back_per_chunk(workdir, monkeypatch):
+    """下载计划分组获取邮件头，某一组失败时只有这一组不在计划内，其余邮件照常规划和筛选"""
+    server = start_server(MailboxSpec(messages=25, seed=6))
+    original = emailCore.SpoolingIMAP4.uid
+
+    def uid(self, command, *args):
+        if command == 'FETCH' and 'RFC822.SIZE' in args[-1] and args[0].startswith('11:'):
+            return 'NO', [b'temporary failure']
+        return original(self, command, *args)
+
+    monkeypatch.setattr(emailCore.SpoolingIMAP4, 'uid', uid)
+    monkeypatch.setattr(emailCore.DownloadPlan, 'PREFETCH_CHUNK', 10)
+    try:
+        pool = emailCore.IMAPConnectionPool(ACCOUNT, PASSWORD, 1)
+        with pool.lease('INBOX') as conn:
+            _, uids = EmailDownload._uid_search(conn.mail, 'ALL')
+            plan = emailCore.DownloadPlan.prefetch(
+                conn.mail, uids, ACCOUNT, accept=lambda message: message.uid % 2 == 0
+            )
+        pool.close()
+    finally:
+        server.stop()
+    assert [uid for uid in range(1, 26) if plan.message(uid)] == [2, 4, 6, 8, 10, 22, 24]
+    assert list(plan.rejected) == [1, 3, 5, 7, 9, 21, 23, 25]
+    assert plan.directory(4) is not None and plan.size(4) > 0
+    assert plan.directory(12) is None and plan.size(12) == 0
+    assert plan.total_bytes == sum(plan.size(uid) for uid in (2, 4, 6, 8, 10, 22, 24))
@@ -224,6 +224,42 @@ class Ui_MainWindow(object):
         self.optionsLayout.setContentsMargins(15, 15, 15, 15)
         self.optionsLayout.setSpacing(12)
         
+        # 文件夹选择
+        self.folderLayout = QHBoxLayout()
+        self.folderLayout.setSpacing(8)
+        
+        self.folderPatterns_Lab = QLabel(u"文件夹:", self.centralwidget)
+        self.folderPatterns_Lab.setFixedWidth(80)
+        
+        self.folderPatterns = QLineEdit(self.centralwidget)
+        self.folderPatterns.setText(u"INBOX")
+        self.folderPatterns.setPlaceholderText(u"如 INBOX, 工作/*, !垃圾邮件")
+        self.folderPatterns.setToolTip(u"逗号分隔的文件夹名称或通配符，以!开头表示排除，* 表示所有文件夹")
+        self.folderPatterns.setStyleSheet(self.mailAddress.styleSheet())
+        
+        self.folderLayout.addWidget(self.folderPatterns_Lab)
+        self.folderLayout.addWidget(self.folderPatterns)
+        
+        # 邮件筛选
+        self.filterLayout = QHBoxLayout()
+        self.filterLayout.setSpacing(8)
+        
+        self.searchFilter_Lab = QLabel(u"筛选:", self.centralwidget)
+        self.searchFilter_Lab.setFixedWidth(80)
+        
+        self.searchFilter = QLineEdit(self.centralwidget)
+        self.searchFilter.setPlaceholderText(u"如 since:2024-01-01 from:boss@example.com subject:发票 larger:1M has:attachment")
+        self.searchFilter.setToolTip(
+            u"多个条件同时满足，同一条件写多次表示满足其一\n"
+            u"since:/before: 日期(YYYY-MM-DD)  from: 发件人  subject: 主题关键词\n"
+            u"larger:/smaller: 邮件大小(如 500K、20M)  has:attachment 带附件"
+        )
+        self.searchFilter.setClearButtonEnabled(True)
+        self.searchFilter.setStyleSheet(self.mailAddress.styleSheet())
+        
+        self.filterLayout.addWidget(self.searchFilter_Lab)
+        self.filterLayout.addWidget(self.searchFilter)
+        
         # 第一行选项
         self.optionsRow1 = QHBoxLayout()
         self.optionsRow1.setSpacing(15)
@@ -238,11 +274,37 @@ class Ui_MainWindow(object):
         self.resumeDownload.setToolTip(u"支持从中断处继续下载未完成的邮件")
         self.resumeDownload.setChecked(True)
         
+        self.dedupAttachments = QCheckBox(u"附件去重", self.centralwidget)
+        self.dedupAttachments.setToolTip(u"内容相同的附件只保存一份，各邮件目录中为硬链接；修改其中一个文件会同时改变所有副本")
+        
         self.optionsRow1.addWidget(self.downloadHTML)
         self.optionsRow1.addWidget(self.seenAfterDownload)
         self.optionsRow1.addWidget(self.resumeDownload)
+        self.optionsRow1.addWidget(self.dedupAttachments)
         self.optionsRow1.addStretch()
         
+        # 第二行选项
+        self.optionsRow2 = QHBoxLayout()
+        self.optionsRow2.setSpacing(15)
+        
+        self.selectiveFetch = QCheckBox(u"按需获取邮件内容", self.centralwidget)
+        self.selectiveFetch.setToolTip(u"先读取邮件结构，只下载需要保存的正文和附件，跳过不需要的HTML等内容")
+        
+        self.incrementalSync = QCheckBox(u"增量同步", self.centralwidget)
+        self.incrementalSync.setToolTip(u"只下载上次同步后新到达的邮件(不论是否已读)，邮箱无变化时立即结束")
+        
+        self.watchMode = QCheckBox(u"持续监视新邮件", self.centralwidget)
+        self.watchMode.setToolTip(u"下载完成后保持连接，新邮件到达后几秒内自动下载，直到点击停止")
+        
+        self.batchAccounts = QCheckBox(u"批量下载多个账号", self.centralwidget)
+        self.batchAccounts.setToolTip(u"同时下载 accounts.json 中列出的所有账号，忽略上面填写的邮箱地址和密码")
+        
+        self.optionsRow2.addWidget(self.selectiveFetch)
+        self.optionsRow2.addWidget(self.incrementalSync)
+        self.optionsRow2.addWidget(self.watchMode)
+        self.optionsRow2.addWidget(self.batchAccounts)
+        self.optionsRow2.addStretch()
+        
         # 统计信息
         self.statsLayout = QHBoxLayout()
         self.statsLayout.setSpacing(15)
@@ -257,7 +319,10 @@ class Ui_MainWindow(object):
         self.statsLayout.addWidget(self.resumeLabel)
         self.statsLayout.addStretch()
         
+        self.optionsLayout.addLayout(self.folderLayout)
+        self.optionsLayout.addLayout(self.filterLayout)
         self.optionsLayout.addLayout(self.optionsRow1)
+        self.optionsLayout.addLayout(self.optionsRow2)
         self.optionsLayout.addLayout(self.statsLayout)
 
         # 进度条和按钮